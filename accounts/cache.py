@@ -0,0 +1,67 @@
+"""
+Shared cache of the public bits of a user's profile (username, full name,
+avatar URL), used on the chat hot paths instead of loading UserProfile rows.
+
+Entries live in the default cache (Redis when REDIS_URL is set, local memory
+otherwise) and are invalidated whenever a User or UserProfile is saved.
+"""
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+# Seconds a cached profile stays valid (invalidation on save makes this a safety net)
+PROFILE_CACHE_TIMEOUT = 60 * 60
+
+
+def profile_cache_key(user_id):
+    return f'accounts:profile:{user_id}'
+
+
+def build_profile_summary(user):
+    """Profile summary of a User loaded with its userprofile"""
+    profile = getattr(user, 'userprofile', None)
+    return {
+        'id': user.id,
+        'username': user.username,
+        'full_name': user.get_full_name(),
+        'profile_picture_url': profile.get_profile_picture_url() if profile and profile.profile_picture else None,
+    }
+
+
+def get_profile_summaries(user_ids):
+    """Return ``{user_id: summary}``, loading cache misses in a single query"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+
+    cached = cache.get_many([profile_cache_key(user_id) for user_id in user_ids])
+    summaries = {summary['id']: summary for summary in cached.values()}
+
+    missing = user_ids - summaries.keys()
+    if missing:
+        loaded = {
+            user.id: build_profile_summary(user)
+            for user in User.objects.filter(id__in=missing).select_related('userprofile')
+        }
+        cache.set_many(
+            {profile_cache_key(user_id): summary for user_id, summary in loaded.items()},
+            PROFILE_CACHE_TIMEOUT
+        )
+        summaries.update(loaded)
+
+    return summaries
+
+
+def get_profile_summary(user_id):
+    """Return the cached profile summary of one user (None if the user does not exist)"""
+    return get_profile_summaries([user_id]).get(user_id)
+
+
+def invalidate_profile(user_id):
+    """
+    Drop a cached profile now and again once the surrounding transaction
+    commits, so a concurrent reader cannot re-cache the old row in between.
+    """
+    key = profile_cache_key(user_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
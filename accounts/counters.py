@@ -0,0 +1,174 @@
+"""
+Per-user counts shown in the navbar: pending friend requests received and
+unread messages.
+
+Instead of two COUNT queries on every page, each user has a UserCounters row
+that is updated, with F() expressions so concurrent updates add up, in the
+same transaction as the change it counts:
+
+- a friend request turns pending or stops being pending (accepted, rejected,
+  cancelled or deleted): the receivers in accounts/models.py;
+- a message is sent (``Message.save`` and the write combiner), read
+  (``mark_conversation_read``) or deleted while still unread: chat/models.py
+  and chat/services.py.
+
+Reading a user's counts is two cache lookups (the version of the user's
+cached counts, then the counts), or one query on a miss. Invalidating drops
+the version, so counts read before an update and cached after its
+invalidation are never read again. A user without a row gets one on first
+read: the row is created first, so updates from then on are not skipped, and
+then counted from the source tables with the row locked.
+``manage.py reconcile_counters`` rewrites rows that drifted (e.g. after rows
+were inserted or deleted with raw SQL or ``bulk_create``).
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+import uuid
+
+COUNTER_FIELDS = ('pending_friend_requests', 'unread_messages')
+
+# Seconds cached counts stay valid (invalidation on update makes this a safety net)
+COUNTERS_CACHE_TIMEOUT = 60 * 60
+
+
+def counters_cache_key(user_id):
+    """Key of the version of a user's cached counts: deleting it invalidates them"""
+    return f'accounts:counters:{user_id}'
+
+
+def _counts_cache_key(user_id):
+    key = counters_cache_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, COUNTERS_CACHE_TIMEOUT):
+            version = cache.get(key) or version
+    return f'{key}:{version}'
+
+
+def get_counts(user_id):
+    """Return ``{field: count}`` of a user's counters"""
+    # Import here to avoid circular imports
+    from .models import UserCounters
+
+    key = _counts_cache_key(user_id)
+    counts = cache.get(key)
+    if counts is None:
+        counts = UserCounters.objects.filter(user_id=user_id).values(*COUNTER_FIELDS).first()
+        if counts is None:
+            counts = create(user_id)
+            key = _counts_cache_key(user_id)
+        cache.set(key, counts, COUNTERS_CACHE_TIMEOUT)
+    return counts
+
+
+def create(user_id):
+    """Create a user's counters row counted from the source tables and return the counts"""
+    # Import here to avoid circular imports
+    from .models import UserCounters
+
+    # The row exists before counting, so add() updates it from now on
+    UserCounters.objects.bulk_create([UserCounters(user_id=user_id)], ignore_conflicts=True)
+    with transaction.atomic():
+        # Changes that already updated the row commit before it is counted,
+        # later ones wait for the count and are added on top of it
+        list(UserCounters.objects.select_for_update().filter(user_id=user_id).values('pk'))
+        counts = count_from_source([user_id])[user_id]
+        UserCounters.objects.filter(user_id=user_id).update(**counts)
+    # Counts read from the row while it was being counted are stale
+    invalidate([user_id])
+    return counts
+
+
+def add(field, user_ids, delta):
+    """
+    Add ``delta`` (a number or an expression) to ``field`` of the users'
+    counters, never going below zero. Users without a row are skipped:
+    their row is created and counted from the source tables when first read.
+    """
+    # Import here to avoid circular imports
+    from .models import UserCounters
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    UserCounters.objects.filter(user_id__in=user_ids).update(
+        **{field: Greatest(F(field) + delta, Value(0))}
+    )
+    invalidate(user_ids)
+
+
+def invalidate(user_ids):
+    """Drop cached counts now and again once the surrounding transaction commits"""
+    keys = [counters_cache_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def count_from_source(user_ids):
+    """Return ``{user_id: {field: count}}`` counted from the friend request and message tables"""
+    # Import here to avoid circular imports
+    from chat.models import Conversation, ConversationReadState, Message
+    from .models import FriendRequest
+
+    counts = {user_id: dict.fromkeys(COUNTER_FIELDS, 0) for user_id in user_ids}
+
+    pending = FriendRequest.objects.filter(
+        to_user_id__in=counts, status='pending'
+    ).order_by().values('to_user').annotate(count=Count('pk')).values_list('to_user', 'count')
+    for user_id, count in pending:
+        counts[user_id]['pending_friend_requests'] = count
+
+    # Unread messages per conversation membership, as in get_conversation_list
+    cursor = ConversationReadState.objects.filter(
+        conversation=OuterRef(OuterRef('conversation_id')),
+        user=OuterRef(OuterRef('user_id'))
+    ).values('last_read_message_id')[:1]
+    unread_messages = Message.objects.filter(
+        conversation=OuterRef('conversation_id'),
+        id__gt=Coalesce(Subquery(cursor), 0)
+    ).exclude(
+        sender=OuterRef('user_id')
+    ).order_by().values('conversation').annotate(count=Count('pk')).values('count')
+    memberships = Conversation.participants.through.objects.filter(
+        user_id__in=counts
+    ).annotate(
+        unread=Coalesce(Subquery(unread_messages, output_field=IntegerField()), 0)
+    ).values_list('user_id', 'unread')
+    for user_id, unread in memberships:
+        counts[user_id]['unread_messages'] += unread
+
+    return counts
+
+
+def rebuild(user_ids):
+    """
+    Rewrite the users' counters from the source tables. Returns
+    ``{user_id: (stored, counted)}`` for the users whose row was missing
+    (stored is None) or wrong.
+    """
+    # Import here to avoid circular imports
+    from .models import UserCounters
+
+    counted = count_from_source(user_ids)
+    stored = {
+        row['user']: {field: row[field] for field in COUNTER_FIELDS}
+        for row in UserCounters.objects.filter(user_id__in=counted).values('user', *COUNTER_FIELDS)
+    }
+    changed = {
+        user_id: (stored.get(user_id), counts)
+        for user_id, counts in counted.items()
+        if stored.get(user_id) != counts
+    }
+    if changed:
+        with transaction.atomic():
+            UserCounters.objects.bulk_create(
+                [UserCounters(user_id=user_id, **counts) for user_id, (_, counts) in changed.items()],
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=list(COUNTER_FIELDS),
+            )
+        invalidate(changed)
+    return changed
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from accounts import counters
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the navbar counters (pending friend requests, unread messages) from the source tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Users rebuilt per transaction (default: 1000)',
+        )
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            dest='user_ids',
+            help='Only rebuild this user id (can be repeated)',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        users = User.objects.order_by('id')
+        if options['user_ids']:
+            users = users.filter(id__in=options['user_ids'])
+        user_ids = list(users.values_list('id', flat=True))
+
+        checked = 0
+        fixed = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            changed = counters.rebuild(batch)
+            checked += len(batch)
+            fixed += len(changed)
+            for user_id, (stored, counted) in changed.items():
+                if stored is None:
+                    self.stdout.write(f'  - User {user_id}: created {counted}')
+                else:
+                    self.stdout.write(f'  - User {user_id}: {stored} -> {counted}')
+
+        if fixed:
+            self.stdout.write(self.style.WARNING(f'Rebuilt counters of {fixed} of {checked} users'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Counters of all {checked} users are correct'))
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.7 on 2026-10-18 13:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('accounts', '0004_alter_userprofile_profile_picture'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counters', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('pending_friend_requests', models.PositiveIntegerField(default=0)),
+                ('unread_messages', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:20
+
+from django.db import migrations, models
+from django.db.models.functions import Upper
+
+# Columns of auth_user searched by prefix in the user list (see accounts.views.user_list)
+SEARCH_INDEXES = [
+    models.Index(Upper(column), name=f'auth_user_upper_{column}_idx')
+    for column in ('username', 'first_name', 'last_name', 'email')
+]
+
+
+def add_search_indexes(apps, schema_editor):
+    """Index UPPER() of the searched columns; auth.User itself cannot declare them"""
+    User = apps.get_model('auth', 'User')
+    for index in SEARCH_INDEXES:
+        schema_editor.add_index(User, index)
+
+
+def remove_search_indexes(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    for index in SEARCH_INDEXES:
+        schema_editor.remove_index(User, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('accounts', '0005_usercounters'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_indexes, remove_search_indexes),
+    ]
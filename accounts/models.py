@@ -1,8 +1,12 @@
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from PIL import Image
+from . import counters
+from .cache import invalidate_profile
+from datetime import timedelta
 import os
 
 class UserProfile(models.Model):
@@ -21,8 +25,19 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored deletion setting so save() can tell when it changes
+        instance._saved_message_deletion_hours = instance.__dict__.get('message_deletion_hours')
+        return instance
+    
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
+        saved_hours = getattr(self, '_saved_message_deletion_hours', None)
+        if saved_hours is not None and saved_hours != self.message_deletion_hours:
+            self.reschedule_message_expiry()
+        self._saved_message_deletion_hours = self.message_deletion_hours
         # Only perform local image resize if using FileSystemStorage (not S3)
         from django.core.files.storage import default_storage
         from django.core.files.storage import FileSystemStorage
@@ -40,6 +55,14 @@ class UserProfile(models.Model):
             except Exception as e:
                 print(f"Error processing profile picture: {e}")
     
+    def reschedule_message_expiry(self):
+        """Recompute expires_at of this user's messages from message_deletion_hours"""
+        # Import here to avoid circular imports
+        from chat.models import Message
+        Message.objects.filter(sender_id=self.user_id).update(
+            expires_at=F('timestamp') + timedelta(hours=self.message_deletion_hours)
+        )
+    
     def get_profile_picture_url(self):
         """Return the URL of the profile picture or None if not available"""
         if self.profile_picture and hasattr(self.profile_picture, 'url'):
@@ -58,6 +81,20 @@ def save_user_profile(sender, instance, **kwargs):
     else:
         UserProfile.objects.create(user=instance)
 
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_profile_cache(sender, instance, **kwargs):
+    invalidate_profile(instance.id)
+
+@receiver(post_delete, sender=User)
+def invalidate_user_counters_cache(sender, instance, **kwargs):
+    counters.invalidate([instance.id])
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_profile_cache(sender, instance, **kwargs):
+    invalidate_profile(instance.user_id)
+
 class FriendRequest(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -76,3 +113,35 @@ class FriendRequest(models.Model):
     
     def __str__(self):
         return f"{self.from_user.username} -> {self.to_user.username} ({self.status})"
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored status so the receivers can tell when it changes
+        instance._saved_status = instance.__dict__.get('status')
+        return instance
+
+class UserCounters(models.Model):
+    """
+    Navbar counts of a user, kept up to date as requests and messages come
+    and go (see accounts/counters.py) instead of counted on every page
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name='counters', on_delete=models.CASCADE)
+    pending_friend_requests = models.PositiveIntegerField(default=0)
+    unread_messages = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.user_id}: {self.pending_friend_requests} requests, {self.unread_messages} unread"
+
+@receiver(post_save, sender=FriendRequest)
+def count_saved_friend_request(sender, instance, created, **kwargs):
+    was_pending = not created and getattr(instance, '_saved_status', None) == 'pending'
+    is_pending = instance.status == 'pending'
+    if was_pending != is_pending:
+        counters.add('pending_friend_requests', [instance.to_user_id], 1 if is_pending else -1)
+    instance._saved_status = instance.status
+
+@receiver(post_delete, sender=FriendRequest)
+def count_deleted_friend_request(sender, instance, **kwargs):
+    if getattr(instance, '_saved_status', instance.status) == 'pending':
+        counters.add('pending_friend_requests', [instance.to_user_id], -1)
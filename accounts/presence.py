@@ -0,0 +1,268 @@
+"""
+Presence: who is online, tracked outside the database.
+
+Every open WebSocket increments a per-user connection count in the default
+cache (Redis when REDIS_URL is set, local memory otherwise), so a user with
+several tabs stays online until the last one closes. Changes to
+``UserProfile.is_online``/``last_seen`` are queued in memory and written by a
+background flush in one UPDATE per batch, so connecting and disconnecting
+never write to the database synchronously. A flush only overwrites rows whose
+``last_seen`` is older than the queued change, so a process flushing late
+cannot undo a newer change already written by another process.
+
+Transitions are pushed to the user's friends over their ``notifications_<id>``
+groups by ``announce``, debounced so a reconnect storm produces at most one
+event per user per PRESENCE_DEBOUNCE_SECONDS.
+"""
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Case, Q, Value, When
+from django.utils import timezone
+import asyncio
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds a connection count survives without a new connect (guards against
+# counts left behind by a process that died without running disconnect)
+PRESENCE_TIMEOUT = 24 * 60 * 60
+
+# Profiles written per UPDATE statement
+PRESENCE_FLUSH_BATCH_SIZE = 500
+
+# group_send calls awaited together during a presence fan-out
+PRESENCE_FANOUT_CHUNK_SIZE = 100
+
+_pending = {}
+_pending_lock = threading.Lock()
+_flush_timer = None
+# Keeps running announcements referenced until they finish
+_announcements = set()
+
+
+def presence_cache_key(user_id):
+    return f'accounts:presence:{user_id}'
+
+
+def user_connected(user_id):
+    """Count a new connection. Returns True if the user just came online."""
+    key = presence_cache_key(user_id)
+    cache.add(key, 0, PRESENCE_TIMEOUT)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # The key expired between add() and incr()
+        cache.set(key, 1, PRESENCE_TIMEOUT)
+        count = 1
+    cache.touch(key, PRESENCE_TIMEOUT)
+    if count == 1:
+        _queue(user_id, True)
+    return count == 1
+
+
+def user_disconnected(user_id):
+    """Count a closed connection. Returns True if it was the user's last one."""
+    key = presence_cache_key(user_id)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        count = 0
+    if count > 0:
+        return False
+    cache.delete(key)
+    _queue(user_id, False)
+    return True
+
+
+def online_user_ids(user_ids):
+    """Return the subset of ``user_ids`` with at least one open connection"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+    counts = cache.get_many([presence_cache_key(user_id) for user_id in user_ids])
+    return {
+        user_id for user_id in user_ids
+        if counts.get(presence_cache_key(user_id), 0) > 0
+    }
+
+
+def is_online(user_id):
+    return user_id in online_user_ids([user_id])
+
+
+def _queue(user_id, online):
+    # Later transitions of the same user replace earlier ones, so a flapping
+    # connection costs one row in the next flush
+    with _pending_lock:
+        _pending[user_id] = (online, timezone.now())
+    _schedule_flush()
+
+
+def _schedule_flush():
+    global _flush_timer
+    with _pending_lock:
+        if _flush_timer is not None:
+            return
+        _flush_timer = threading.Timer(
+            getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 5), _flush_in_background
+        )
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def _flush_in_background():
+    global _flush_timer
+    with _pending_lock:
+        _flush_timer = None
+    try:
+        flush()
+    except Exception as e:
+        logger.error(f"Error flushing presence: {e}")
+    finally:
+        # The timer thread is not a request, so don't keep its connection open
+        connection.close()
+
+
+def flush():
+    """Write queued presence changes to UserProfile. Returns the number of users written."""
+    # Import here to avoid circular imports
+    from .models import UserProfile
+
+    global _flush_timer
+    with _pending_lock:
+        # Everything queued is written now, so the scheduled flush has nothing left to do
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return 0
+
+    user_ids = list(pending)
+    written = 0
+    for start in range(0, len(user_ids), PRESENCE_FLUSH_BATCH_SIZE):
+        batch = user_ids[start:start + PRESENCE_FLUSH_BATCH_SIZE]
+        queued_at = Case(
+            *[When(user_id=user_id, then=Value(pending[user_id][1])) for user_id in batch]
+        )
+        # Rows already written with a newer change (by another process) are left alone
+        written += UserProfile.objects.filter(
+            Q(last_seen__lt=queued_at) | Q(last_seen__isnull=True), user_id__in=batch
+        ).update(
+            is_online=Case(
+                *[When(user_id=user_id, then=Value(pending[user_id][0])) for user_id in batch]
+            ),
+            last_seen=queued_at,
+        )
+    return written
+
+
+def reconcile():
+    """
+    Bring UserProfile.is_online back in line with the connection counts, e.g.
+    after a process died without flushing. Returns the number of users fixed.
+    """
+    # Import here to avoid circular imports
+    from .models import UserProfile
+
+    flagged = set(UserProfile.objects.filter(is_online=True).values_list('user_id', flat=True))
+    stale = flagged - online_user_ids(flagged)
+    if stale:
+        UserProfile.objects.filter(user_id__in=stale).update(is_online=False)
+    return len(stale)
+
+
+def presence_announced_key(user_id):
+    return f'accounts:presence:announced:{user_id}'
+
+
+def presence_debounce_key(user_id):
+    return f'accounts:presence:debounce:{user_id}'
+
+
+def get_presence_audience(user_id):
+    """
+    Ids of the friends (accepted friend requests) to tell about a user's
+    presence, or an empty list if the user hides their online status
+    """
+    # Import here to avoid circular imports
+    from .models import FriendRequest, UserProfile
+
+    if not UserProfile.objects.filter(user_id=user_id, show_online_status=True).exists():
+        return []
+    sent = FriendRequest.objects.filter(
+        from_user_id=user_id, status='accepted'
+    ).values_list('to_user_id', flat=True)
+    received = FriendRequest.objects.filter(
+        to_user_id=user_id, status='accepted'
+    ).values_list('from_user_id', flat=True)
+    return list(sent.union(received))
+
+
+def presence_event(user_id, online):
+    return {
+        'type': 'presence_update',
+        'user_id': user_id,
+        'is_online': online,
+        'last_seen': timezone.now().isoformat(),
+    }
+
+
+async def announce(user_id, channel_layer):
+    """
+    Push a user's presence to their friends once the debounce window closes.
+
+    Call after a transition from user_connected/user_disconnected, in a
+    background task: the first transition in a window waits it out, later ones
+    are absorbed, and only a state that differs from the last announced one is
+    sent (so a quick reconnect announces nothing).
+    """
+    window = getattr(settings, 'PRESENCE_DEBOUNCE_SECONDS', 10)
+    if not await sync_to_async(cache.add, thread_sensitive=False)(
+        presence_debounce_key(user_id), True, window
+    ):
+        return 0
+    await asyncio.sleep(window)
+
+    online = await sync_to_async(is_online, thread_sensitive=False)(user_id)
+    announced_key = presence_announced_key(user_id)
+    if await sync_to_async(cache.get, thread_sensitive=False)(announced_key) == online:
+        return 0
+    await sync_to_async(cache.set, thread_sensitive=False)(announced_key, online, PRESENCE_TIMEOUT)
+
+    friend_ids = await database_sync_to_async(get_presence_audience)(user_id)
+    event = presence_event(user_id, online)
+    # Send in chunks of concurrent group_sends instead of one at a time
+    for start in range(0, len(friend_ids), PRESENCE_FANOUT_CHUNK_SIZE):
+        chunk = friend_ids[start:start + PRESENCE_FANOUT_CHUNK_SIZE]
+        results = await asyncio.gather(
+            *[channel_layer.group_send(f'notifications_{friend_id}', event) for friend_id in chunk],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error sending presence of user {user_id}: {result}")
+    return len(friend_ids)
+
+
+def announce_in_background(user_id, channel_layer):
+    """Schedule ``announce`` on the running event loop without waiting for it"""
+    task = asyncio.ensure_future(announce(user_id, channel_layer))
+    _announcements.add(task)
+    task.add_done_callback(_announcements.discard)
+    return task
+
+
+async def wait_for_announcements():
+    """Wait for every scheduled announcement to finish"""
+    while _announcements:
+        await asyncio.gather(*list(_announcements), return_exceptions=True)
+
+
+atexit.register(flush)
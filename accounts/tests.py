@@ -1,3 +1,339 @@
-from django.test import TestCase
+import asyncio
+import unittest
 
-# Create your tests here.
+from datetime import timedelta
+from io import StringIO
+
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.template import RequestContext, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from kothakow.context_processors import navbar_counts
+from . import counters, presence
+from .cache import get_profile_summaries, get_profile_summary
+from .models import FriendRequest, UserCounters, UserProfile
+
+
+class ProfileCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username='alice', first_name='Alice')
+        self.friend = User.objects.create_user(username='bob')
+
+    def test_summaries_are_cached(self):
+        with self.assertNumQueries(1):
+            summaries = get_profile_summaries([self.user.id, self.friend.id])
+        self.assertEqual(summaries[self.user.id]['full_name'], 'Alice')
+        self.assertEqual(summaries[self.friend.id]['profile_picture_url'], '/media/profile_pics/default.svg')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_profile_summary(self.friend.id)['username'], 'bob')
+
+    def test_saving_user_or_profile_invalidates(self):
+        get_profile_summary(self.user.id)
+        self.user.username = 'alice2'
+        self.user.save()
+        self.assertEqual(get_profile_summary(self.user.id)['username'], 'alice2')
+
+        profile = self.user.userprofile
+        profile.profile_picture = 'profile_pics/alice.png'
+        profile.save()
+        self.assertEqual(get_profile_summary(self.user.id)['profile_picture_url'], '/media/profile_pics/alice.png')
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(presence.flush)
+
+    def test_connections_are_reference_counted(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(presence.user_connected(self.user.id))
+            self.assertFalse(presence.user_connected(self.user.id))
+            self.assertFalse(presence.user_disconnected(self.user.id))
+
+        # One tab closed, one still open
+        self.assertEqual(presence.online_user_ids([self.user.id, self.friend.id]), {self.user.id})
+
+        self.assertTrue(presence.user_disconnected(self.user.id))
+        self.assertFalse(presence.is_online(self.user.id))
+
+    def test_flush_coalesces_changes_into_one_update(self):
+        for _ in range(3):
+            presence.user_connected(self.user.id)
+            presence.user_disconnected(self.user.id)
+        presence.user_connected(self.user.id)
+        presence.user_connected(self.friend.id)
+        presence.user_disconnected(self.friend.id)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(presence.flush(), 2)
+        self.assertTrue(UserProfile.objects.get(user=self.user).is_online)
+        self.assertFalse(UserProfile.objects.get(user=self.friend).is_online)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(presence.flush(), 0)
+
+    def test_flush_cancels_the_scheduled_flush(self):
+        presence.user_connected(self.user.id)
+        timer = presence._flush_timer
+        self.assertIsNotNone(timer)
+
+        presence.flush()
+        self.assertIsNone(presence._flush_timer)
+        timer.join(1)
+        self.assertFalse(timer.is_alive())
+
+    def test_flush_keeps_newer_changes_of_other_processes(self):
+        # This process queues a disconnect, then another process flushes a later reconnect
+        presence.user_connected(self.user.id)
+        presence.user_disconnected(self.user.id)
+        UserProfile.objects.filter(user=self.user).update(
+            is_online=True, last_seen=timezone.now() + timedelta(seconds=1)
+        )
+
+        self.assertEqual(presence.flush(), 0)
+        self.assertTrue(UserProfile.objects.get(user=self.user).is_online)
+
+    def test_reconcile_clears_stale_online_flags(self):
+        UserProfile.objects.filter(user__in=[self.user, self.friend]).update(is_online=True)
+        presence.user_connected(self.user.id)
+        presence.flush()
+
+        self.assertEqual(presence.reconcile(), 1)
+        self.assertEqual(
+            set(UserProfile.objects.filter(is_online=True).values_list('user_id', flat=True)),
+            {self.user.id}
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE_SECONDS=0.05,
+)
+class PresenceFanoutTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice')
+        self.friends = [User.objects.create_user(username=f'friend{i}') for i in range(3)]
+        FriendRequest.objects.create(from_user=self.user, to_user=self.friends[0], status='accepted')
+        FriendRequest.objects.create(from_user=self.friends[1], to_user=self.user, status='accepted')
+        FriendRequest.objects.create(from_user=self.user, to_user=self.friends[2], status='pending')
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(presence.flush)
+
+    def test_audience_is_accepted_friends(self):
+        self.assertEqual(
+            set(presence.get_presence_audience(self.user.id)), {self.friends[0].id, self.friends[1].id}
+        )
+        UserProfile.objects.filter(user=self.user).update(show_online_status=False)
+        self.assertEqual(presence.get_presence_audience(self.user.id), [])
+
+    async def listen(self, channel_layer, friend):
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(f'notifications_{friend.id}', channel)
+        return channel
+
+    async def test_transitions_are_pushed_to_friends(self):
+        channel_layer = get_channel_layer()
+        channel = await self.listen(channel_layer, self.friends[0])
+        stranger_channel = await self.listen(channel_layer, self.friends[2])
+
+        presence.user_connected(self.user.id)
+        self.assertEqual(await presence.announce(self.user.id, channel_layer), 2)
+
+        event = await channel_layer.receive(channel)
+        self.assertEqual((event['type'], event['user_id'], event['is_online']), ('presence_update', self.user.id, True))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(stranger_channel), 0.05)
+
+    async def test_reconnect_storm_is_debounced(self):
+        channel_layer = get_channel_layer()
+        channel = await self.listen(channel_layer, self.friends[1])
+
+        # Already announced online, then the user flaps several times within one window
+        presence.user_connected(self.user.id)
+        await presence.announce(self.user.id, channel_layer)
+        await channel_layer.receive(channel)
+        for _ in range(5):
+            presence.user_disconnected(self.user.id)
+            presence.announce_in_background(self.user.id, channel_layer)
+            presence.user_connected(self.user.id)
+            presence.announce_in_background(self.user.id, channel_layer)
+        await presence.wait_for_announcements()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel), 0.05)
+
+        presence.user_disconnected(self.user.id)
+        presence.announce_in_background(self.user.id, channel_layer)
+        presence.announce_in_background(self.user.id, channel_layer)
+        await presence.wait_for_announcements()
+        self.assertFalse((await channel_layer.receive(channel))['is_online'])
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.other = User.objects.create_user(username='carol')
+
+    def test_missing_row_is_counted_then_cached(self):
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        # Read, insert, then lock, count and update the row in a savepoint
+        with self.assertNumQueries(8):
+            counts = counters.get_counts(self.user.id)
+        self.assertEqual(counts, {'pending_friend_requests': 1, 'unread_messages': 0})
+        self.assertEqual(
+            UserCounters.objects.filter(user=self.user).values('pending_friend_requests').get(),
+            {'pending_friend_requests': 1}
+        )
+        with self.assertNumQueries(0):
+            counters.get_counts(self.user.id)
+
+    def test_counts_cached_after_an_invalidation_are_not_read(self):
+        counters.get_counts(self.user.id)
+        # A reader looks up the cache key, then an update invalidates before it caches what it read
+        key = counters._counts_cache_key(self.user.id)
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        cache.set(key, {'pending_friend_requests': 0, 'unread_messages': 0})
+        self.assertEqual(counters.get_counts(self.user.id)['pending_friend_requests'], 1)
+
+    def test_pending_requests_follow_status(self):
+        counters.get_counts(self.user.id)
+        request = FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        FriendRequest.objects.create(from_user=self.other, to_user=self.user, status='accepted')
+        FriendRequest.objects.create(from_user=self.user, to_user=self.other)
+        self.assertEqual(counters.get_counts(self.user.id)['pending_friend_requests'], 1)
+
+        request = FriendRequest.objects.get(pk=request.pk)
+        request.status = 'accepted'
+        request.save()
+        self.assertEqual(counters.get_counts(self.user.id)['pending_friend_requests'], 0)
+
+        FriendRequest.objects.filter(from_user=self.friend).delete()
+        declined = FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        self.assertEqual(counters.get_counts(self.user.id)['pending_friend_requests'], 1)
+        declined.delete()
+        self.assertEqual(counters.get_counts(self.user.id)['pending_friend_requests'], 0)
+
+    def test_navbar_reads_counters(self):
+        self.client.force_login(self.user)
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        counters.get_counts(self.user.id)
+        response = self.client.get(reverse('accounts:friend_requests'))
+        self.assertEqual(response.context['navbar_friend_request_count'], 1)
+        self.assertEqual(response.context['navbar_unread_message_count'], 0)
+
+    def test_navbar_counts_are_looked_up_once_when_rendered(self):
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        counters.get_counts(self.user.id)
+        cache.delete(counters.counters_cache_key(self.user.id))
+        request = RequestFactory().get('/')
+        request.user = self.user
+        template = Template('{{ navbar_friend_request_count }}/{{ navbar_unread_message_count }}')
+
+        with self.assertNumQueries(0):
+            navbar_counts(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(template.render(RequestContext(request)), '1/0')
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(RequestContext(request)), '1/0')
+
+    def test_reconcile_rewrites_drifted_counters(self):
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        counters.get_counts(self.user.id)
+        UserCounters.objects.filter(user=self.user).update(pending_friend_requests=7, unread_messages=3)
+
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('Rebuilt counters of 3 of 3 users', out.getvalue())
+        self.assertEqual(
+            counters.get_counts(self.user.id),
+            {'pending_friend_requests': 1, 'unread_messages': 0}
+        )
+
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('Counters of all 3 users are correct', out.getvalue())
+
+
+class UserListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice')
+        self.client.force_login(self.user)
+
+    def listed(self, **params):
+        response = self.client.get(reverse('accounts:user_list'), params)
+        return [row['user'].username for row in response.context['user_data']], response.context['next_after']
+
+    def test_requested_and_friends_are_excluded(self):
+        pending_sent = User.objects.create_user(username='bob')
+        pending_received = User.objects.create_user(username='carol')
+        friend = User.objects.create_user(username='dave')
+        User.objects.create_user(username='erin')
+        FriendRequest.objects.create(from_user=self.user, to_user=pending_sent)
+        FriendRequest.objects.create(from_user=pending_received, to_user=self.user)
+        FriendRequest.objects.create(from_user=friend, to_user=self.user, status='accepted')
+        self.assertEqual(self.listed(), (['erin'], None))
+
+    def test_pages_follow_the_cursor(self):
+        for i in range(45):
+            User.objects.create_user(username=f'user{i:02}')
+
+        seen = []
+        after = None
+        while True:
+            names, after = self.listed(**({'after': after} if after else {}))
+            seen.extend(names)
+            if after is None:
+                break
+        self.assertEqual(seen, [f'user{i:02}' for i in range(45)])
+
+    def test_queries_do_not_grow_with_users(self):
+        for i in range(5):
+            User.objects.create_user(username=f'user{i}')
+        self.client.get(reverse('accounts:user_list'))
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse('accounts:user_list'))
+        for i in range(5, 50):
+            User.objects.create_user(username=f'user{i}')
+        with self.assertNumQueries(len(few)):
+            self.client.get(reverse('accounts:user_list'))
+
+    def test_search_matches_names_and_email(self):
+        User.objects.create_user(username='bob', first_name='Robert')
+        User.objects.create_user(username='carol', email='carol@example.com')
+        User.objects.create_user(username='robin')
+        self.assertEqual(self.listed(search='rob'), (['bob', 'robin'], None))
+        self.assertEqual(self.listed(search='CAROL@example.com'), (['carol'], None))
+
+    def test_search_pages_follow_the_cursor(self):
+        for i in range(25):
+            User.objects.create_user(username=f'Rob{i:02}')
+        User.objects.create_user(username='carob')
+        names, after = self.listed(search='rob')
+        self.assertEqual(names, [f'Rob{i:02}' for i in range(20)])
+        self.assertEqual(self.listed(search='rob', after=after), ([f'Rob{i:02}' for i in range(20, 25)], None))
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Reads the SQLite query plan')
+    def test_search_uses_the_upper_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('accounts:user_list'), {'search': 'rob', 'after': 1})
+        sql = next(query['sql'] for query in queries if 'UPPER' in query['sql'])
+        with connection.cursor() as cursor:
+            plan = ' '.join(row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall())
+        for column in ('username', 'first_name', 'last_name', 'email'):
+            self.assertIn(f'USING INDEX auth_user_upper_{column}_idx', plan)
@@ -5,15 +5,25 @@ from django.contrib.auth.models import User
 from django.contrib import messages
 from django.http import JsonResponse
 from django.views.decorators.http import require_POST
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Concat, Upper
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from typing import Optional, Dict, Any
 
 from .forms import SignUpForm, UserUpdateForm, ProfileUpdateForm
+from . import presence
 from .models import UserProfile, FriendRequest
 from chat.models import Conversation
 
+# Number of users per page of the user list
+USER_PAGE_SIZE = 20
+
+# Sorts after every character, so [prefix, prefix + PREFIX_END] holds every
+# string starting with prefix
+PREFIX_END = '\U0010ffff'
+
 def signup(request):
     if request.method == 'POST':
         form = SignUpForm(request.POST, request.FILES)
@@ -49,47 +59,83 @@ def profile_settings(request):
 
 @login_required
 def user_list(request):
-    # Get all users except current user
-    users = User.objects.exclude(id=request.user.id).select_related('userprofile')
-    
-    # Get friend requests status
-    sent_requests = FriendRequest.objects.filter(
-        from_user=request.user
-    ).values_list('to_user_id', 'status')
-    
-    received_requests = FriendRequest.objects.filter(
-        to_user=request.user
-    ).values_list('from_user_id', 'status')
-    
-    # Create dictionaries for easy lookup
-    sent_status = {user_id: status for user_id, status in sent_requests}
-    received_status = {user_id: status for user_id, status in received_requests}
-    
-    # Exclude users with pending or accepted requests (sent or received)
-    exclude_ids = set()
-    for user_id, status in sent_requests:
-        if status in ['pending', 'accepted']:
-            exclude_ids.add(user_id)
-    for user_id, status in received_requests:
-        if status in ['pending', 'accepted']:
-            exclude_ids.add(user_id)
-    
-    filtered_users = [user for user in users if user.id not in exclude_ids]
+    """
+    People the user could send a friend request to, USER_PAGE_SIZE at a time
+    in id order. ``after`` is the id of the last user of the previous page
+    and ``search`` matches the start of a name or username, or an email,
+    ignoring case.
+
+    Without a search a page reads USER_PAGE_SIZE rows in primary key order.
+    A search is an index range scan per column (UPPER(column) between the
+    upper-cased prefix and the prefix followed by PREFIX_END, or equal to it
+    for the email), so it reads the users matching the search, sorted by id,
+    rather than the whole table.
+    """
+    search = request.GET.get('search', '').strip()
+    after = request.GET.get('after', '')
+    after = int(after) if after.isdigit() else None
+
+    # Users with a pending or accepted request either way are filtered out in SQL
+    sent = FriendRequest.objects.filter(from_user=request.user, to_user=OuterRef('pk'))
+    received = FriendRequest.objects.filter(from_user=OuterRef('pk'), to_user=request.user)
+    users = User.objects.exclude(
+        id=request.user.id
+    ).exclude(
+        Exists(sent.filter(status__in=['pending', 'accepted']))
+    ).exclude(
+        Exists(received.filter(status__in=['pending', 'accepted']))
+    ).annotate(
+        sent_status=Subquery(sent.values('status')[:1]),
+        received_status=Subquery(received.values('status')[:1])
+    ).select_related('userprofile').order_by('id')
+
+    if search:
+        # Prefix ranges on UPPER() of each column, served by the expression
+        # indexes of accounts/migrations/0006_user_search_indexes.py
+        prefix = Upper(Value(search))
+        prefix_end = Concat(prefix, Value(PREFIX_END))
+        # The cursor goes inside each range: on its own it leads SQLite to walk
+        # the primary key from ``after`` instead of using the indexes
+        cursor = Q(id__gt=after) if after is not None else Q()
+        users = users.alias(
+            username_upper=Upper('username'),
+            first_name_upper=Upper('first_name'),
+            last_name_upper=Upper('last_name'),
+            email_upper=Upper('email'),
+        ).filter(
+            Q(cursor, username_upper__gte=prefix, username_upper__lte=prefix_end)
+            | Q(cursor, first_name_upper__gte=prefix, first_name_upper__lte=prefix_end)
+            | Q(cursor, last_name_upper__gte=prefix, last_name_upper__lte=prefix_end)
+            | Q(cursor, email_upper=prefix)
+        )
+    elif after is not None:
+        users = users.filter(id__gt=after)
+
+    page = list(users[:USER_PAGE_SIZE + 1])
+    has_more = len(page) > USER_PAGE_SIZE
+    page = page[:USER_PAGE_SIZE]
     
-    # Add status to each user
+    # Add status and presence to each user
+    online_ids = presence.online_user_ids(user.id for user in page)
     user_data = []
-    for user in filtered_users:
+    for user in page:
         status = 'none'
-        if user.id in sent_status:
-            status = f'sent_{sent_status[user.id]}'
-        elif user.id in received_status:
-            status = f'received_{received_status[user.id]}'
+        if user.sent_status:
+            status = f'sent_{user.sent_status}'
+        elif user.received_status:
+            status = f'received_{user.received_status}'
         user_data.append({
             'user': user,
-            'status': status
+            'status': status,
+            'is_online': user.id in online_ids and user.userprofile.show_online_status
         })
     
-    return render(request, 'accounts/user_list.html', {'user_data': user_data})
+    return render(request, 'accounts/user_list.html', {
+        'user_data': user_data,
+        'search': search,
+        'is_first_page': after is None,
+        'next_after': page[-1].id if has_more else None,
+    })
 
 @login_required
 @require_POST
@@ -245,6 +291,7 @@ def user_profile(request, user_id):
     
     context = {
         'profile_user': user,
+        'profile_user_is_online': presence.is_online(user.id),
         'friendship_status': friendship_status,
         'friend_request': friend_request
     }
@@ -260,8 +307,14 @@ def delete_account(request):
     # Log out the user
     logout(request)
     
-    # Delete the user (this will cascade delete related objects)
+    # Import here to avoid circular imports
+    from chat import room_buffer
+    
+    # Delete the user (this will cascade delete related objects) and drop
+    # the buffered rooms still holding their messages
+    conversation_ids = list(user.conversations.values_list('id', flat=True))
     user.delete()
+    room_buffer.invalidate(conversation_ids)
     
     # Add a success message
     messages.success(request, 'Your account has been successfully deleted.')
@@ -290,7 +343,6 @@ def unfriend_user(request):
     try:
         # Import here to avoid circular imports
         from chat.models import Conversation, Message
-        import os
         
         # Get conversations between the two users
         conversations = Conversation.objects.filter(
@@ -299,31 +351,18 @@ def unfriend_user(request):
             participants=friend
         )
         
-        # Delete all messages and their media files before deleting conversations
-        for conversation in conversations:
-            messages = conversation.messages.all()
-            for message in messages:
-                # Delete media files if they exist
-                if message.image and os.path.exists(message.image.path):
-                    try:
-                        os.remove(message.image.path)
-                    except OSError:
-                        pass  # File might already be deleted
-                
-                if message.video and os.path.exists(message.video.path):
-                    try:
-                        os.remove(message.video.path)
-                    except OSError:
-                        pass  # File might already be deleted
-                
-                # Delete the message (this will also delete MessageReadStatus due to CASCADE)
-                message.delete()
+        # Messages, conversations and the friend request go together or not at
+        # all; the media reaper only removes the files once this commits
+        with transaction.atomic():
+            # Delete all messages in one statement; their media files are
+            # removed from storage in the background by the media reaper
+            Message.objects.filter(conversation__in=conversations).delete_with_media()
             
-            # Delete the conversation
-            conversation.delete()
-        
-        # Delete the friend request
-        friend_request.delete()
+            # Delete the conversations
+            conversations.delete()
+            
+            # Delete the friend request
+            friend_request.delete()
         
         return JsonResponse({'success': True, 'message': 'Unfriended successfully. All conversations and media files have been permanently deleted.'})
         
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Conversation, Message, MessageReadStatus
+from .models import Conversation, Message, ConversationReadState
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
@@ -15,10 +15,10 @@ class MessageInline(admin.TabularInline):
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'get_participants', 'get_message_count', 'created_at', 'updated_at')
+    list_display = ('id', 'get_participants', 'get_message_count', 'last_message_at', 'created_at', 'updated_at')
     list_filter = ('created_at', 'updated_at')
     search_fields = ('participants__username',)
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('created_at', 'updated_at', 'last_message_id', 'last_message_at', 'last_message_preview')
     inlines = [MessageInline]
     
     def get_participants(self, obj):
@@ -73,15 +73,14 @@ class MessageAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('sender', 'conversation')
 
-@admin.register(MessageReadStatus)
-class MessageReadStatusAdmin(admin.ModelAdmin):
-    list_display = ('message', 'user', 'is_read')
-    list_filter = ('is_read',)
-    search_fields = ('message__content', 'user__username')
-    readonly_fields = ()
+@admin.register(ConversationReadState)
+class ConversationReadStateAdmin(admin.ModelAdmin):
+    list_display = ('conversation', 'user', 'last_read_message_id', 'last_read_at')
+    search_fields = ('user__username',)
+    readonly_fields = ('last_read_at',)
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('message', 'user')
+        return super().get_queryset(request).select_related('conversation', 'user')
 
 # Custom admin site configuration
 admin.site.site_header = "Kotha Kow Admin"
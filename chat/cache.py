@@ -0,0 +1,44 @@
+"""
+Shared cache of conversation membership, used to authorize WebSocket
+connections and message sends without a participants query each time.
+
+Entries are invalidated when a conversation's participants change or the
+conversation is deleted (see the receivers in chat/models.py).
+"""
+from django.core.cache import cache
+from django.db import transaction
+
+# Seconds cached membership stays valid (invalidation makes this a safety net)
+MEMBERSHIP_CACHE_TIMEOUT = 60 * 60
+
+
+def membership_cache_key(conversation_id):
+    return f'chat:members:{conversation_id}'
+
+
+def get_participant_ids(conversation_id):
+    """Return the set of user ids taking part in a conversation (empty if it does not exist)"""
+    # Import here to avoid circular imports
+    from .models import Conversation
+
+    key = membership_cache_key(conversation_id)
+    participant_ids = cache.get(key)
+    if participant_ids is None:
+        participant_ids = list(
+            Conversation.participants.through.objects.filter(
+                conversation_id=conversation_id
+            ).values_list('user_id', flat=True)
+        )
+        cache.set(key, participant_ids, MEMBERSHIP_CACHE_TIMEOUT)
+    return set(participant_ids)
+
+
+def is_participant(conversation_id, user_id):
+    return user_id in get_participant_ids(conversation_id)
+
+
+def invalidate_membership(conversation_id):
+    """Drop cached membership now and again once the surrounding transaction commits"""
+    key = membership_cache_key(conversation_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
@@ -1,10 +1,33 @@
+import asyncio
 import json
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from .models import Conversation, Message, MessageReadStatus
-from accounts.models import UserProfile
+from . import rate_limit, write_combiner
+from .cache import is_participant
+from .models import Message
+from .services import (
+    get_resume_delta,
+    mark_conversation_read,
+    read_receipt_event,
+    serialize_message_event_row,
+)
+from .wire import (
+    MSGPACK_SUBPROTOCOL,
+    batch_frames,
+    client_frame,
+    decode_frame,
+    encode_frame,
+    event_frame,
+    prepare_event,
+)
+from accounts import presence
+from accounts.cache import get_profile_summary
+from django.conf import settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -13,6 +36,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
         logger.warning(f"WebSocket connect attempt: user={self.scope['user']} authenticated={self.scope['user'].is_authenticated}")
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
         self.room_group_name = f'chat_{self.conversation_id}'
+        self.typing_broadcast_at = None
+        self.typing_expiry = None
+        # Clients offering the msgpack subprotocol get compact binary frames
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        self.outbox = []
+        self.outbox_flush = None
         
         # AUTH CHECK: Only allow authenticated users
         if not self.scope['user'].is_authenticated:
@@ -20,31 +49,50 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
+        # MEMBERSHIP CHECK: Only participants may join the room. This is resolved
+        # once per connection, so sends don't have to look the conversation up.
+        if not await self.is_conversation_member(self.scope['user'], self.conversation_id):
+            logger.warning(f"WebSocket denied: user={self.scope['user']} is not in conversation {self.conversation_id}")
+            await self.close()
+            return
+        
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
         logger.warning(f"WebSocket accepted for user={self.scope['user']}")
         
-        # Update user online status
-        await self.update_user_online_status(self.scope['user'], True)
+        # Count this connection towards the user's presence, telling friends if they just came online
+        if await sync_to_async(presence.user_connected, thread_sensitive=False)(self.scope['user'].id):
+            presence.announce_in_background(self.scope['user'].id, self.channel_layer)
     
     async def disconnect(self, close_code):
+        if not getattr(self, 'is_member', False):
+            return  # Rejected in connect, never joined the room
+        
+        # Don't leave the others looking at a typing indicator of a closed socket
+        await self.stop_typing()
+        if self.outbox_flush is not None:
+            self.outbox_flush.cancel()
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
         
-        # Update user online status
-        if self.scope['user'].is_authenticated:
-            await self.update_user_online_status(self.scope['user'], False)
+        # Release this connection from the user's presence, telling friends if it was the last one
+        if await sync_to_async(presence.user_disconnected, thread_sensitive=False)(self.scope['user'].id):
+            presence.announce_in_background(self.scope['user'].id, self.channel_layer)
     
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            text_data_json = decode_frame(bytes_data)
+        else:
+            text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type')
 
         if message_type == 'chat_message':
@@ -54,15 +102,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if not content:
                 return  # Ignore empty messages
 
-            # Save the message to the database
-            message = await self.save_message(
-                self.scope['user'],
-                self.conversation_id,
-                content
-            )
+            if await self.refuse_if_rate_limited('message', message_data.get('client_id')):
+                return
+
+            # Receivers drop the typing indicator when the message arrives
+            await self.stop_typing(broadcast=False)
+
+            # Save the message to the database, batched with other sockets'
+            # messages when CHAT_WRITE_BATCH_WINDOW is set
+            if write_combiner.enabled():
+                message = await write_combiner.save_message(
+                    self.conversation_id,
+                    self.scope['user'],
+                    content
+                )
+            else:
+                message = await self.save_message(
+                    self.scope['user'],
+                    self.conversation_id,
+                    content
+                )
             
-            profile = await self.get_user_profile(self.scope['user'])
-            profile_picture_url = profile.get_profile_picture_url() if profile else ''
+            profile_picture_url = (await self.get_sender_profile())['profile_picture_url'] or ''
 
             # Construct the full message payload, consistent with the view
             full_message_payload = {
@@ -79,117 +140,269 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'edited_at': message.edited_at.isoformat() if message.edited_at else None,
             }
 
-            # Send the complete message payload to the room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': full_message_payload
-                }
-            )
+            # Acknowledge to this socket with the persisted message (matched by the
+            # client's temporary id), then send it to the rest of the room
+            await self.send_frame({
+                'type': 'message_ack',
+                'client_id': message_data.get('client_id'),
+                'message': full_message_payload
+            })
+            await self.broadcast({
+                'type': 'chat_message',
+                'message': full_message_payload
+            })
         elif message_type == 'edit_message':
             message_data = text_data_json.get('message', {})
             message_id = message_data.get('id')
             new_content = message_data.get('content', '').strip()
             
             if message_id and new_content:
+                if await self.refuse_if_rate_limited('message'):
+                    return
                 success = await self.edit_message(message_id, self.scope['user'], new_content)
                 if success:
-                    # Broadcast the edit to all users in the room
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'message_edited',
-                            'message': {
-                                'id': message_id,
-                                'content': new_content,
-                                'is_edited': True,
-                                'edited_at': timezone.now().isoformat(),
-                            }
+                    # Confirm the edit to this socket and broadcast it to the rest of the room
+                    event = {
+                        'type': 'message_edited',
+                        'message': {
+                            'id': message_id,
+                            'content': new_content,
+                            'is_edited': True,
+                            'edited_at': timezone.now().isoformat(),
                         }
-                    )
+                    }
+                    await self.send_frame(client_frame(event))
+                    await self.broadcast(event)
         elif message_type == 'unsend_message':
             message_data = text_data_json.get('message', {})
             message_id = message_data.get('id')
             
             if message_id:
+                if await self.refuse_if_rate_limited('message'):
+                    return
                 success = await self.unsend_message(message_id, self.scope['user'])
                 if success:
-                    # Broadcast the unsend to all users in the room
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'message_unsent',
-                            'message': {
-                                'id': message_id,
-                                'is_unsent': True,
-                            }
+                    # Confirm the unsend to this socket and broadcast it to the rest of the room
+                    event = {
+                        'type': 'message_unsent',
+                        'message': {
+                            'id': message_id,
+                            'is_unsent': True,
                         }
-                    )
+                    }
+                    await self.send_frame(client_frame(event))
+                    await self.broadcast(event)
         elif message_type == 'mark_read':
             message_id = text_data_json.get('message_id')
-            if message_id:
-                await self.mark_message_read(message_id, self.scope['user'])
+            # Over the limit the frame is dropped: the next one marks the same messages read
+            if message_id and not await self.rate_limited('mark_read'):
+                last_read_message_id = await self.mark_message_read(message_id, self.scope['user'])
+                if last_read_message_id:
+                    # Let the sender know how far this user has read
+                    await self.broadcast(read_receipt_event(self.scope['user'], last_read_message_id))
+        elif message_type == 'resume':
+            await self.resume(text_data_json.get('last_message_id'), text_data_json.get('since'))
         elif message_type == 'typing':
-            # Broadcast typing indicator to other users in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_typing',
-                    'username': self.scope['user'].username
-                }
-            )
+            # Over the limit typing frames are dropped, the indicator is already shown
+            if not await self.rate_limited('typing'):
+                await self.start_typing()
         elif message_type == 'stop_typing':
-            # Broadcast stop typing indicator to other users in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_stop_typing'
-                }
+            await self.stop_typing()
+    
+    async def rate_limited(self, action):
+        # Seconds until the user may do ``action`` again (0 if allowed now). Buckets
+        # in Redis are checked on a worker thread, not the database thread.
+        if rate_limit.shared():
+            return await sync_to_async(rate_limit.hit, thread_sensitive=False)(
+                action, self.scope['user'].id, self.conversation_id
             )
+        return rate_limit.hit(action, self.scope['user'].id, self.conversation_id)
+    
+    async def refuse_if_rate_limited(self, action, client_id=None):
+        # Tell the client when a message frame is refused, so it can show it as not sent
+        retry_after = await self.rate_limited(action)
+        if retry_after:
+            await self.send_frame({
+                'type': 'error',
+                'code': 'rate_limited',
+                'client_id': client_id,
+                'retry_after': round(retry_after, 2),
+                'message': 'You are sending messages too fast. Please wait a moment.',
+            })
+        return bool(retry_after)
+    
+    async def resume(self, last_message_id, since):
+        # Replay what the client missed while disconnected (messages after the
+        # last one it has, edits and unsends since it was last in sync), then
+        # confirm with the server time to resume from next time. Live events wait
+        # until this is done, since the consumer handles one event at a time.
+        try:
+            last_message_id = int(last_message_id or 0)
+            if since:
+                since = parse_datetime(since)
+                # parse_datetime returns None, rather than raising, for a malformed string
+                if since is None:
+                    raise ValueError('Malformed since')
+                if timezone.is_naive(since):
+                    since = timezone.make_aware(since)
+            else:
+                since = None
+        except (TypeError, ValueError):
+            await self.send_frame({'type': 'resync_required'})
+            return
+        
+        synced_at = timezone.now()
+        new_rows, changed_rows, complete = await database_sync_to_async(get_resume_delta)(
+            self.conversation_id, self.scope['user'], last_message_id, since or synced_at
+        )
+        if not complete:
+            # Too much to replay; the client reloads the page instead
+            await self.send_frame({'type': 'resync_required'})
+            return
+        
+        for row in new_rows:
+            await self.send_frame({'type': 'chat_message', 'message': serialize_message_event_row(row)})
+        for row in changed_rows:
+            if row['is_unsent']:
+                await self.send_frame({
+                    'type': 'message_unsent',
+                    'message': {'id': row['id'], 'is_unsent': True}
+                })
+            else:
+                await self.send_frame({
+                    'type': 'message_edited',
+                    'message': {
+                        'id': row['id'],
+                        'content': row['content'],
+                        'is_edited': True,
+                        'edited_at': row['edited_at'].isoformat() if row['edited_at'] else None,
+                    }
+                })
+        await self.send_frame({'type': 'resumed', 'synced_at': synced_at.isoformat()})
+    
+    async def broadcast(self, event):
+        # Tag the event with this socket so the group handlers don't echo it back;
+        # the sender's own socket is answered directly instead
+        event['sender_channel_name'] = self.channel_name
+        await self.channel_layer.group_send(self.room_group_name, prepare_event(event))
+    
+    def is_own_event(self, event):
+        # Events sent by views (HTTP sends, edits, unsends) have no originating socket
+        return event.get('sender_channel_name') == self.channel_name
     
     async def chat_message(self, event):
         # This handler receives messages from the group and sends them to the client.
-        message_payload = event['message']
-
-        # Send the standardized message payload to the WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': message_payload
-        }))
+        await self.send_event(event)
     
     async def message_edited(self, event):
         # Send message edit notification to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message_edited',
-            'message': event['message']
-        }))
+        await self.send_event(event)
     
     async def message_unsent(self, event):
         # Send message unsend notification to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message_unsent',
-            'message': event['message']
-        }))
+        await self.send_event(event)
+    
+    async def read_receipt(self, event):
+        # Send read receipt (new read cursor of a participant) to WebSocket
+        await self.send_event(event)
     
     async def user_typing(self, event):
         # Send typing indicator to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'typing',
-            'username': event['username']
-        }))
+        await self.send_event(event)
     
     async def user_stop_typing(self, event):
         # Send stop typing indicator to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'stop_typing'
-        }))
+        await self.send_event(event)
+    
+    async def send_event(self, event):
+        # Relay a group event in this socket's wire format (not back to its sender).
+        # Other sockets of this process in the same format reuse the encoded frame.
+        if self.is_own_event(event):
+            return
+        await self.deliver(event_frame(event, self.use_msgpack))
+    
+    async def send_frame(self, frame):
+        # Send a frame meant for this socket only
+        await self.deliver(encode_frame(frame, self.use_msgpack))
+    
+    async def deliver(self, data):
+        # With CHAT_FRAME_BATCH_WINDOW (milliseconds) set, frames are held for
+        # that long and sent as one array frame; otherwise each goes out at once
+        window = settings.CHAT_FRAME_BATCH_WINDOW
+        if not window:
+            await self.send_raw(data)
+            return
+        self.outbox.append(data)
+        if self.outbox_flush is None:
+            self.outbox_flush = asyncio.ensure_future(self.flush_outbox(window / 1000))
+    
+    async def flush_outbox(self, delay):
+        await asyncio.sleep(delay)
+        frames, self.outbox = self.outbox, []
+        self.outbox_flush = None
+        if len(frames) == 1:
+            await self.send_raw(frames[0])
+        elif frames:
+            await self.send_raw(batch_frames(frames, binary=self.use_msgpack))
+    
+    async def send_raw(self, data):
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+    
+    async def start_typing(self):
+        # Typing state lives on the connection: repeated typing frames reach the
+        # group at most once per TYPING_BROADCAST_INTERVAL, and the state expires
+        # by itself after TYPING_TIMEOUT if no stop_typing frame arrives
+        now = time.monotonic()
+        if self.typing_broadcast_at is None or now - self.typing_broadcast_at >= settings.TYPING_BROADCAST_INTERVAL:
+            self.typing_broadcast_at = now
+            await self.broadcast({
+                'type': 'user_typing',
+                'user_id': self.scope['user'].id,
+                'username': self.scope['user'].username,
+                'timeout': settings.TYPING_TIMEOUT
+            })
+        
+        if self.typing_expiry is not None:
+            self.typing_expiry.cancel()
+        self.typing_expiry = asyncio.ensure_future(self.expire_typing())
+    
+    async def expire_typing(self):
+        await asyncio.sleep(settings.TYPING_TIMEOUT)
+        self.typing_expiry = None
+        await self.stop_typing()
+    
+    async def stop_typing(self, broadcast=True):
+        if self.typing_expiry is not None:
+            self.typing_expiry.cancel()
+            self.typing_expiry = None
+        if self.typing_broadcast_at is None:
+            return  # Not typing, nothing to tell the room
+        self.typing_broadcast_at = None
+        
+        if broadcast:
+            await self.broadcast({
+                'type': 'user_stop_typing',
+                'user_id': self.scope['user'].id
+            })
+    
+    @database_sync_to_async
+    def is_conversation_member(self, user, conversation_id):
+        try:
+            conversation_id = int(conversation_id)
+        except ValueError:
+            return False
+        self.conversation_id = conversation_id
+        self.is_member = is_participant(conversation_id, user.id)
+        return self.is_member
     
     @database_sync_to_async
     def save_message(self, user, conversation_id, content):
-        conversation = Conversation.objects.get(id=conversation_id)
+        # Membership was checked at connect, so insert by id without loading the conversation
         message = Message.objects.create(
-            conversation=conversation,
+            conversation_id=conversation_id,
             sender=user,
             content=content
         )
@@ -219,32 +432,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     @database_sync_to_async
     def mark_message_read(self, message_id, user):
-        try:
-            message = Message.objects.get(id=message_id)
-            MessageReadStatus.objects.update_or_create(
-                message=message,
-                user=user,
-                defaults={'is_read': True}
-            )
-        except Message.DoesNotExist:
-            pass
+        return mark_conversation_read(user, self.conversation_id, message_id)
     
-    @database_sync_to_async
-    def update_user_online_status(self, user, is_online):
-        try:
-            profile = user.userprofile
-            profile.is_online = is_online
-            profile.last_seen = timezone.now()
-            profile.save()
-        except UserProfile.DoesNotExist:
-            UserProfile.objects.create(user=user, is_online=is_online)
-
-    @database_sync_to_async
-    def get_user_profile(self, user):
-        try:
-            return user.userprofile
-        except UserProfile.DoesNotExist:
-            return None
+    async def get_sender_profile(self):
+        # The sender is the same for the whole socket lifetime, so the profile
+        # summary is looked up once per connection (through the shared cache)
+        if getattr(self, 'sender_profile', None) is None:
+            self.sender_profile = await database_sync_to_async(get_profile_summary)(self.scope['user'].id)
+        return self.sender_profile
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -258,6 +453,10 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             )
             
             await self.accept()
+            
+            # Count this connection towards the user's presence, telling friends if they just came online
+            if await sync_to_async(presence.user_connected, thread_sensitive=False)(self.scope['user'].id):
+                presence.announce_in_background(self.scope['user'].id, self.channel_layer)
         else:
             await self.close()
     
@@ -268,6 +467,10 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.user_group_name,
                 self.channel_name
             )
+            
+            # Release this connection from the user's presence, telling friends if it was the last one
+            if await sync_to_async(presence.user_disconnected, thread_sensitive=False)(self.scope['user'].id):
+                presence.announce_in_background(self.scope['user'].id, self.channel_layer)
     
     async def friend_request_notification(self, event):
         # Send friend request notification to WebSocket
@@ -286,6 +489,15 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             'message': event['message']
         }))
     
+    async def presence_update(self, event):
+        # Send a friend's online/offline transition to WebSocket
+        await self.send(text_data=json.dumps({
+            'type': 'presence_update',
+            'user_id': event['user_id'],
+            'is_online': event['is_online'],
+            'last_seen': event['last_seen']
+        }))
+    
     async def send_notification(self, event):
         # Send generic notification to WebSocket
         await self.send(text_data=json.dumps(event['notification']))
\ No newline at end of file
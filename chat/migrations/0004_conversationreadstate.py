@@ -0,0 +1,87 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:29
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+
+def collapse_read_statuses(apps, schema_editor):
+    """Turn per-message read rows into one read cursor per (conversation, user)"""
+    MessageReadStatus = apps.get_model('chat', 'MessageReadStatus')
+    ConversationReadState = apps.get_model('chat', 'ConversationReadState')
+
+    cursors = MessageReadStatus.objects.filter(
+        is_read=True
+    ).values(
+        'message__conversation_id', 'user_id'
+    ).annotate(
+        last_read_message_id=Max('message_id'),
+        last_read_at=Max('read_at'),
+    ).order_by()
+
+    ConversationReadState.objects.bulk_create(
+        [
+            ConversationReadState(
+                conversation_id=row['message__conversation_id'],
+                user_id=row['user_id'],
+                last_read_message_id=row['last_read_message_id'],
+                last_read_at=row['last_read_at'],
+            )
+            for row in cursors.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+def expand_read_cursors(apps, schema_editor):
+    """Recreate per-message read rows for every message covered by a cursor"""
+    Message = apps.get_model('chat', 'Message')
+    MessageReadStatus = apps.get_model('chat', 'MessageReadStatus')
+    ConversationReadState = apps.get_model('chat', 'ConversationReadState')
+
+    for state in ConversationReadState.objects.iterator():
+        message_ids = Message.objects.filter(
+            conversation_id=state.conversation_id,
+            id__lte=state.last_read_message_id,
+        ).values_list('id', flat=True)
+        MessageReadStatus.objects.bulk_create(
+            [
+                MessageReadStatus(message_id=message_id, user_id=state.user_id, is_read=True)
+                for message_id in message_ids
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0003_message_edited_at_message_is_edited_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('last_read_at', models.DateTimeField(blank=True, null=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.RunPython(collapse_read_statuses, expand_read_cursors),
+        migrations.DeleteModel(
+            name='MessageReadStatus',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='chat_message_conv_id_idx'),
+        ),
+    ]
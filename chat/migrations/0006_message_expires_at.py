@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:32
+
+from datetime import timedelta
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_expires_at(apps, schema_editor):
+    """Compute expires_at for existing messages from each sender's deletion setting"""
+    Message = apps.get_model('chat', 'Message')
+    UserProfile = apps.get_model('accounts', 'UserProfile')
+
+    deletion_hours = dict(UserProfile.objects.values_list('user_id', 'message_deletion_hours'))
+    sender_ids = Message.objects.values_list('sender_id', flat=True).distinct().order_by()
+    for sender_id in sender_ids:
+        hours = deletion_hours.get(sender_id, 24)
+        Message.objects.filter(sender_id=sender_id).update(
+            expires_at=F('timestamp') + timedelta(hours=hours)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_alter_userprofile_profile_picture'),
+        ('chat', '0005_message_history_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+    ]
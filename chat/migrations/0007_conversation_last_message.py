@@ -0,0 +1,52 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:35
+
+from django.db import migrations, models
+from django.db.models import Case, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Substr
+
+
+def backfill_last_message(apps, schema_editor):
+    """Fill the denormalized last message columns from existing messages"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    latest = Message.objects.filter(
+        conversation=OuterRef('pk')
+    ).order_by('-timestamp', '-id')
+    preview = latest.annotate(
+        preview=Case(
+            When(is_unsent=True, then=Value('')),
+            default=Substr(Coalesce('content', Value('')), 1, 100)
+        )
+    )
+    Conversation.objects.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+        last_message_preview=Coalesce(Subquery(preview.values('preview')[:1]), Value('')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
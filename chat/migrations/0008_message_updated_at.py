@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:46
+
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+
+def backfill_updated_at(apps, schema_editor):
+    """Existing messages were last changed when edited, or else when sent"""
+    Message = apps.get_model('chat', 'Message')
+    Message.objects.update(updated_at=Coalesce(F('edited_at'), F('timestamp')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_conversation_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'updated_at'], name='chat_message_conv_updated_idx'),
+        ),
+    ]
@@ -1,13 +1,62 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Substr
 from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
+from accounts import counters
+from collections import Counter, defaultdict
 from datetime import timedelta
 import os
+from . import room_buffer
+from .cache import get_participant_ids, invalidate_membership
+
+# Used for senders without a profile (matches UserProfile.message_deletion_hours)
+DEFAULT_MESSAGE_DELETION_HOURS = 24
+
+# Length of Conversation.last_message_preview
+MESSAGE_PREVIEW_LENGTH = 100
+
+class ConversationQuerySet(models.QuerySet):
+    def record_message(self, message):
+        """Make ``message`` the last message of the conversations (unless a newer one is recorded)"""
+        return self.filter(
+            models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lte=message.timestamp)
+        ).update(
+            last_message_id=message.id,
+            last_message_at=message.timestamp,
+            last_message_preview=message.preview_text(),
+            updated_at=timezone.now()
+        )
+    
+    def refresh_last_message(self):
+        """Recompute the last message columns from the messages table (e.g. after deletions)"""
+        latest = Message.objects.filter(
+            conversation=models.OuterRef('pk')
+        ).order_by('-timestamp', '-id')
+        preview = latest.annotate(
+            preview=models.Case(
+                models.When(is_unsent=True, then=models.Value('')),
+                default=Substr(Coalesce('content', models.Value('')), 1, MESSAGE_PREVIEW_LENGTH)
+            )
+        )
+        return self.update(
+            last_message_id=models.Subquery(latest.values('id')[:1]),
+            last_message_at=models.Subquery(latest.values('timestamp')[:1]),
+            last_message_preview=Coalesce(models.Subquery(preview.values('preview')[:1]), models.Value(''))
+        )
 
 class Conversation(models.Model):
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized from the latest message, maintained when messages are saved
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_message_preview = models.CharField(max_length=MESSAGE_PREVIEW_LENGTH, blank=True)
+    
+    objects = ConversationQuerySet.as_manager()
     
     class Meta:
         ordering = ['-updated_at']
@@ -20,7 +69,31 @@ class Conversation(models.Model):
         return self.participants.exclude(id=user.id).first()
     
     def last_message(self):
-        return self.messages.order_by('-timestamp').first()
+        if self.last_message_id is None:
+            return None
+        return self.messages.filter(id=self.last_message_id).first()
+
+class MessageQuerySet(models.QuerySet):
+    def expired(self, now=None):
+        """Messages whose deletion time (expires_at) has passed"""
+        return self.filter(expires_at__lt=now or timezone.now())
+    
+    def delete_with_media(self):
+        """
+        Delete the messages in one statement and hand their media files to the
+        media reaper, which removes them from storage in the background.
+        """
+        # Import here to avoid circular imports
+        from core import media_reaper
+        
+        rows = list(self.values_list('id', 'conversation_id', 'sender_id', 'image', 'video'))
+        deleted_count, _ = self.delete()
+        conversation_ids = {row[1] for row in rows}
+        Conversation.objects.filter(id__in=conversation_ids).refresh_last_message()
+        room_buffer.invalidate(conversation_ids)
+        discount_unread([row[:3] for row in rows])
+        media_reaper.enqueue([name for row in rows for name in row[3:] if name])
+        return deleted_count
 
 class Message(models.Model):
     MESSAGE_TYPES = [
@@ -39,9 +112,57 @@ class Message(models.Model):
     is_edited = models.BooleanField(default=False)
     is_unsent = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
+    # When the message is due for deletion, from the sender's message_deletion_hours
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Last save (send, edit or unsend), used to replay changes to reconnecting sockets
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = MessageQuerySet.as_manager()
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['conversation', 'id'], name='chat_message_conv_id_idx'),
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='chat_message_history_idx'),
+            models.Index(fields=['conversation', 'updated_at'], name='chat_message_conv_updated_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding and self.expires_at is None:
+            self.expires_at = self.expiry_for(self.sender)
+        
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                Conversation.objects.filter(pk=self.conversation_id).record_message(self)
+                count_unread(self.conversation_id, self.sender_id)
+            else:
+                # Keep the conversation preview in sync with edits and unsends
+                Conversation.objects.filter(
+                    pk=self.conversation_id,
+                    last_message_id=self.id
+                ).update(last_message_preview=self.preview_text())
+            if room_buffer.enabled():
+                row = room_buffer.message_row(self)
+                transaction.on_commit(
+                    lambda: room_buffer.record_row(self.conversation_id, row, adding)
+                )
+    
+    def preview_text(self):
+        """Short text shown for this message in the conversation list"""
+        if self.is_unsent:
+            return ''
+        return (self.content or '')[:MESSAGE_PREVIEW_LENGTH]
+    
+    @staticmethod
+    def expiry_for(sender, sent_at=None):
+        """Deletion time of a message sent by ``sender`` at ``sent_at`` (default: now)"""
+        try:
+            deletion_hours = sender.userprofile.message_deletion_hours
+        except ObjectDoesNotExist:
+            deletion_hours = DEFAULT_MESSAGE_DELETION_HOURS
+        return (sent_at or timezone.now()) + timedelta(hours=deletion_hours)
     
     def __str__(self):
         if self.message_type == 'text':
@@ -98,46 +219,90 @@ class Message(models.Model):
     
     def should_be_deleted(self):
         """Check if message should be deleted based on user's deletion settings"""
-        deletion_hours = self.sender.userprofile.message_deletion_hours
-        deletion_time = self.timestamp + timedelta(hours=deletion_hours)
+        deletion_time = self.expires_at or self.expiry_for(self.sender, self.timestamp)
         return timezone.now() > deletion_time
     
     def delete_with_media(self):
         """Delete message and associated media files if they exist"""
-        try:
-            # Delete image file if it exists
-            if self.image:
-                # Only use .delete() method of the storage backend (S3 or local)
-                try:
-                    self.image.delete(save=False)
-                except Exception as e:
-                    print(f"Error deleting image via storage: {e}")
-            
-            # Delete video file if it exists
-            if self.video:
-                # Only use .delete() method of the storage backend (S3 or local)
-                try:
-                    self.video.delete(save=False)
-                except Exception as e:
-                    print(f"Error deleting video via storage: {e}")
-            
-            # Delete the message (this will also delete MessageReadStatus due to CASCADE)
-            self.delete()
-            print(f"Successfully deleted message {self.id} with all media files")
-            
-        except Exception as e:
-            print(f"Error in delete_with_media for message {self.id}: {e}")
-            # Still try to delete the message even if media deletion fails
-            self.delete()
+        # Import here to avoid circular imports
+        from core import media_reaper
+        
+        media = [field.name for field in (self.image, self.video) if field]
+        row = (self.id, self.conversation_id, self.sender_id)
+        self.delete()
+        Conversation.objects.filter(pk=self.conversation_id).refresh_last_message()
+        room_buffer.invalidate([self.conversation_id])
+        discount_unread([row])
+        media_reaper.enqueue(media)
 
-class MessageReadStatus(models.Model):
-    message = models.ForeignKey(Message, related_name='messagereadstatus', on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    is_read = models.BooleanField(default=True)
-    read_at = models.DateTimeField(auto_now_add=True)
+class ConversationReadState(models.Model):
+    """Per-user read cursor: every message up to last_read_message_id has been read"""
+    conversation = models.ForeignKey(Conversation, related_name='read_states', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='conversation_read_states', on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
-        unique_together = ('message', 'user')
+        unique_together = ('conversation', 'user')
     
     def __str__(self):
-        return f"{self.user.username} read message at {self.read_at}"
+        return f"{self.user.username} read conversation {self.conversation_id} up to message {self.last_read_message_id}"
+
+def count_unread(conversation_id, sender_id, count=1):
+    """Count ``count`` new messages from ``sender_id`` as unread for the other participants"""
+    counters.add('unread_messages', get_participant_ids(conversation_id) - {sender_id}, count)
+
+def discount_unread(rows):
+    """
+    Take deleted messages, given as (id, conversation_id, sender_id) rows,
+    off the unread counters of the participants who had not read them
+    """
+    if not rows:
+        return
+    cursors = {
+        (conversation_id, user_id): last_read_message_id
+        for conversation_id, user_id, last_read_message_id in ConversationReadState.objects.filter(
+            conversation_id__in={row[1] for row in rows}
+        ).values_list('conversation_id', 'user_id', 'last_read_message_id')
+    }
+    unread = Counter()
+    for message_id, conversation_id, sender_id in rows:
+        for user_id in get_participant_ids(conversation_id) - {sender_id}:
+            if message_id > cursors.get((conversation_id, user_id), 0):
+                unread[user_id] += 1
+    # One update per distinct count rather than per user
+    users_by_count = defaultdict(list)
+    for user_id, count in unread.items():
+        users_by_count[count].append(user_id)
+    for count, user_ids in users_by_count.items():
+        counters.add('unread_messages', user_ids, -count)
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def invalidate_conversation_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_membership(instance.pk)
+    elif pk_set:
+        # user.conversations.add(...) / remove(...): pk_set holds conversation ids
+        for conversation_id in pk_set:
+            invalidate_membership(conversation_id)
+    else:
+        # user.conversations.clear(): invalidate every conversation of the user
+        for conversation_id in instance.conversations.values_list('id', flat=True):
+            invalidate_membership(conversation_id)
+
+@receiver(post_delete, sender=Conversation)
+def invalidate_deleted_conversation_membership(sender, instance, **kwargs):
+    invalidate_membership(instance.pk)
+    room_buffer.invalidate([instance.pk])
+
+@receiver(pre_delete, sender=Conversation)
+def discount_deleted_conversation(sender, instance, **kwargs):
+    # Its messages are deleted by the cascade, without delete_with_media
+    discount_unread(list(instance.messages.values_list('id', 'conversation_id', 'sender_id')))
+
+@receiver(pre_delete, sender=User)
+def discount_deleted_sender(sender, instance, **kwargs):
+    # The messages of a deleted user are deleted by the cascade
+    discount_unread(list(Message.objects.filter(sender=instance).values_list('id', 'conversation_id', 'sender_id')))
@@ -0,0 +1,176 @@
+"""
+Token-bucket rate limits on what clients send: chat messages, typing and read
+frames over the chat socket, and messages POSTed to ``send_message``.
+
+CHAT_RATE_LIMITS maps each action to its buckets, one per scope: ``user``
+(shared by all of a user's sockets and requests) and ``conversation`` (shared
+by everyone in the room). A bucket holds up to ``burst`` tokens and refills at
+``rate`` tokens per second; an action takes one token from each of its
+buckets, and is refused without taking any when one of them is empty.
+
+Buckets live in Redis (CHAT_RATE_LIMIT_REDIS_URL, defaulting to REDIS_URL) so
+limits hold across processes, updated atomically by a Lua script. Without
+Redis, or while it is unreachable, each process keeps its own buckets. A
+Redis call gives up after REDIS_TIMEOUT, and after a failure Redis is left
+alone for REDIS_RETRY_AFTER seconds, so an unresponsive server costs one
+short wait (and one logged error) per process rather than one per frame.
+"""
+from django.conf import settings
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Most buckets kept per process before full ones are dropped
+LOCAL_BUCKET_LIMIT = 10000
+
+# Seconds to wait for Redis (connecting or answering) before using local buckets
+REDIS_TIMEOUT = 0.1
+
+# Seconds local buckets are used after a Redis failure before Redis is tried again
+REDIS_RETRY_AFTER = 30
+
+# KEYS are the buckets, ARGV their burst and rate in pairs. Returns the seconds
+# to wait (as a string, Lua numbers are truncated in replies), '0' if allowed.
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local burst = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'at')
+    local available = burst
+    if state[1] then
+        available = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+    end
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local burst = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    if wait == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call('HSET', key, 'tokens', tokens[i], 'at', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+_buckets = {}
+_lock = threading.Lock()
+_redis = None
+_script = None
+_redis_down_until = 0
+_redis_lock = threading.Lock()
+
+
+def hit(action, user_id, conversation_id=None):
+    """
+    Take a token for ``action`` by ``user_id`` (in ``conversation_id``).
+    Returns 0 when the action is allowed, otherwise the seconds until it
+    would be.
+    """
+    buckets = _buckets_for(action, user_id, conversation_id)
+    if not buckets:
+        return 0
+
+    script = _get_script()
+    if script is not None:
+        try:
+            args = [value for _, burst, rate in buckets for value in (burst, rate)]
+            return float(script(keys=[key for key, _, _ in buckets], args=args))
+        except Exception as e:
+            if _redis_failed():
+                logger.error(
+                    f"Error checking rate limit {action} in Redis, "
+                    f"using local buckets for {REDIS_RETRY_AFTER}s: {e}"
+                )
+    return _hit_local(buckets)
+
+
+def shared():
+    """Whether buckets are kept in Redis (so checking them does network I/O)"""
+    return bool(settings.CHAT_RATE_LIMIT_REDIS_URL)
+
+
+def clear():
+    """Drop every bucket kept by this process"""
+    with _lock:
+        _buckets.clear()
+
+
+def _buckets_for(action, user_id, conversation_id):
+    policy = settings.CHAT_RATE_LIMITS.get(action, {})
+    buckets = []
+    for scope, (burst, rate) in policy.items():
+        if scope == 'user':
+            subject = user_id
+        elif scope == 'conversation':
+            subject = conversation_id
+        else:
+            raise ValueError(f'Unknown rate limit scope {scope!r} for {action!r}')
+        if subject is not None:
+            buckets.append((f'chat:ratelimit:{action}:{scope}:{subject}', burst, rate))
+    return buckets
+
+
+def _hit_local(buckets):
+    now = time.monotonic()
+    with _lock:
+        tokens = []
+        wait = 0
+        for key, burst, rate in buckets:
+            available, at = _buckets.get(key, (burst, now))
+            available = min(burst, available + (now - at) * rate)
+            tokens.append(available)
+            if available < 1:
+                wait = max(wait, (1 - available) / rate)
+        for (key, _, _), available in zip(buckets, tokens):
+            _buckets[key] = (available - 1 if not wait else available, now)
+        if len(_buckets) > LOCAL_BUCKET_LIMIT:
+            _prune(now)
+    return wait
+
+
+def _prune(now):
+    # A bucket idle long enough to be full again holds no state worth keeping
+    for key, (available, at) in list(_buckets.items()):
+        action, scope = key.split(':')[2:4]
+        burst, rate = settings.CHAT_RATE_LIMITS.get(action, {}).get(scope, (0, 1))
+        if available + (now - at) * rate >= burst:
+            del _buckets[key]
+
+
+def _get_script():
+    global _redis, _script
+    url = settings.CHAT_RATE_LIMIT_REDIS_URL
+    if not url:
+        return None
+    with _redis_lock:
+        if time.monotonic() < _redis_down_until:
+            return None
+        if _script is None:
+            import redis
+            _redis = redis.Redis.from_url(
+                url, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+            )
+            _script = _redis.register_script(TOKEN_BUCKET_SCRIPT)
+        return _script
+
+
+def _redis_failed():
+    """Stop using Redis for REDIS_RETRY_AFTER seconds. Returns False if already stopped."""
+    global _redis_down_until
+    with _redis_lock:
+        now = time.monotonic()
+        if now < _redis_down_until:
+            return False
+        _redis_down_until = now + REDIS_RETRY_AFTER
+        return True
@@ -0,0 +1,305 @@
+"""
+Room buffer: the newest messages of each conversation kept in memory, so the
+first page of conversation_detail and get_messages is served without querying
+the message table.
+
+Every process keeps the rows of its CHAT_ROOM_BUFFER_ROOMS most recently
+opened rooms in an LRU, CHAT_ROOM_BUFFER_SIZE messages per room (a ring
+buffer: appending to a full room drops its oldest message). With
+CHAT_ROOM_BUFFER_REDIS_URL set, rooms are also kept in one Redis list per
+room, shared by all processes.
+
+Saved messages are appended or updated in place once their transaction
+commits; purges invalidate the room. A buffered room is only served while its
+newest row is the conversation's ``last_message_id``, so a room that missed an
+append (made by another process, or lost in a race with a refill) is reloaded
+instead of served. Edits made by other processes reach a local copy when it
+expires after CHAT_ROOM_BUFFER_TTL seconds; the Redis copy is dropped on every
+edit. ``snapshot_at`` tells how old the data may be, so clients can resume
+from there.
+"""
+from collections import Counter, OrderedDict
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Message columns kept per buffered row
+BUFFER_FIELDS = (
+    'id', 'sender_id', 'content', 'message_type', 'timestamp',
+    'image', 'video', 'is_edited', 'is_unsent', 'edited_at',
+)
+
+# Seconds a room stays in Redis without being refilled
+SHARED_ROOM_TIMEOUT = 60 * 60
+
+_rooms = OrderedDict()
+_lock = threading.Lock()
+_stats = Counter()
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def enabled():
+    return settings.CHAT_ROOM_BUFFER_SIZE > 0
+
+
+def message_row(message):
+    """Buffered row of a Message instance"""
+    row = {field: getattr(message, field) for field in BUFFER_FIELDS}
+    row['image'] = message.image.name or None
+    row['video'] = message.video.name or None
+    return row
+
+
+def get_rows(conversation):
+    """
+    Return the buffered rows of a conversation as ``(rows, complete,
+    snapshot_at)``, oldest first, loading the room on a miss. ``complete`` is
+    True when the rows are the whole conversation. Rows are shared: copy
+    them before changing them.
+    """
+    room = _get_local(conversation)
+    if room is not None:
+        _stats['local_hits'] += 1
+    else:
+        room = _get_shared(conversation)
+        if room is not None:
+            _stats['shared_hits'] += 1
+        else:
+            _stats['misses'] += 1
+            room = _load(conversation.pk)
+            _store_shared(conversation.pk, room)
+        _store_local(conversation.pk, room)
+
+    rows = room['rows']
+    return list(rows), len(rows) < settings.CHAT_ROOM_BUFFER_SIZE, room['snapshot_at']
+
+
+def record_fallback():
+    """Count a lookup the buffer could not answer (too few visible rows)"""
+    _stats['fallbacks'] += 1
+
+
+def record_row(conversation_id, row, created):
+    """Apply a saved message to its room: append it if new, otherwise replace it"""
+    if not enabled():
+        return
+    with _lock:
+        room = _rooms.get(conversation_id)
+        if room is not None:
+            rows = room['rows']
+            if created:
+                # The room may have been loaded after the message was committed
+                if not any(buffered['id'] == row['id'] for buffered in rows):
+                    rows.append(row)
+                    if len(rows) > 1 and _order(rows[-2]) > _order(row):
+                        rows.sort(key=_order)
+                    del rows[:-settings.CHAT_ROOM_BUFFER_SIZE]
+            else:
+                # Rows are shared with callers of get_rows, so replace rather than update them
+                for index, buffered in enumerate(rows):
+                    if buffered['id'] == row['id']:
+                        rows[index] = row
+                        break
+
+    client = _get_redis()
+    if client is None:
+        return
+    try:
+        key = _shared_rows_key(conversation_id)
+        if created:
+            # Only rooms already in Redis are appended to, so a room is never partially buffered
+            pipe = client.pipeline()
+            pipe.lpushx(key, _dump_row(row))
+            pipe.ltrim(key, 0, settings.CHAT_ROOM_BUFFER_SIZE - 1)
+            pipe.execute()
+        else:
+            client.delete(key, _shared_snapshot_key(conversation_id))
+    except Exception as e:
+        logger.error(f"Error updating room buffer of conversation {conversation_id}: {e}")
+
+
+def invalidate(conversation_ids):
+    """
+    Drop buffered rooms, e.g. after messages were deleted from them, now and
+    again once the surrounding transaction commits
+    """
+    conversation_ids = set(conversation_ids)
+    if not conversation_ids or not enabled():
+        return
+    _drop(conversation_ids)
+    transaction.on_commit(lambda: _drop(conversation_ids))
+
+
+def _drop(conversation_ids):
+    with _lock:
+        for conversation_id in conversation_ids:
+            if _rooms.pop(conversation_id, None) is not None:
+                _stats['invalidations'] += 1
+
+    client = _get_redis()
+    if client is None:
+        return
+    try:
+        client.delete(*[
+            key for conversation_id in conversation_ids
+            for key in (_shared_rows_key(conversation_id), _shared_snapshot_key(conversation_id))
+        ])
+    except Exception as e:
+        logger.error(f"Error invalidating room buffers: {e}")
+
+
+def clear():
+    """Drop every room buffered by this process and reset the statistics"""
+    with _lock:
+        _rooms.clear()
+        _stats.clear()
+
+
+def stats():
+    """Lookup counters of this process, with the hit rate over all lookups"""
+    with _lock:
+        counters = dict(_stats)
+        rooms = len(_rooms)
+    hits = counters.get('local_hits', 0) + counters.get('shared_hits', 0)
+    lookups = hits + counters.get('misses', 0)
+    return {
+        'rooms': rooms,
+        'local_hits': counters.get('local_hits', 0),
+        'shared_hits': counters.get('shared_hits', 0),
+        'misses': counters.get('misses', 0),
+        'fallbacks': counters.get('fallbacks', 0),
+        'evictions': counters.get('evictions', 0),
+        'invalidations': counters.get('invalidations', 0),
+        'hit_rate': hits / lookups if lookups else None,
+    }
+
+
+def _order(row):
+    return row['timestamp'], row['id']
+
+
+def _is_current(rows, conversation):
+    newest_id = rows[-1]['id'] if rows else None
+    return newest_id == conversation.last_message_id
+
+
+def _load(conversation_id):
+    # Import here to avoid circular imports
+    from .models import Message
+
+    # Taken before the query, so the rows are at least as new as the snapshot
+    snapshot_at = timezone.now()
+    rows = list(
+        Message.objects.filter(
+            conversation_id=conversation_id
+        ).order_by('-timestamp', '-id').values(*BUFFER_FIELDS)[:settings.CHAT_ROOM_BUFFER_SIZE]
+    )
+    rows.reverse()
+    return {'rows': rows, 'snapshot_at': snapshot_at}
+
+
+def _get_local(conversation):
+    with _lock:
+        room = _rooms.get(conversation.pk)
+        if room is None:
+            return None
+        if room['expires'] < time.monotonic() or not _is_current(room['rows'], conversation):
+            del _rooms[conversation.pk]
+            return None
+        _rooms.move_to_end(conversation.pk)
+        return room
+
+
+def _store_local(conversation_id, room):
+    with _lock:
+        _rooms[conversation_id] = {
+            'rows': room['rows'],
+            'snapshot_at': room['snapshot_at'],
+            'expires': time.monotonic() + settings.CHAT_ROOM_BUFFER_TTL,
+        }
+        _rooms.move_to_end(conversation_id)
+        while len(_rooms) > settings.CHAT_ROOM_BUFFER_ROOMS:
+            _rooms.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def _get_redis():
+    global _redis
+    url = settings.CHAT_ROOM_BUFFER_REDIS_URL
+    if not url:
+        return None
+    with _redis_lock:
+        if _redis is None:
+            import redis
+            _redis = redis.Redis.from_url(url)
+        return _redis
+
+
+def _shared_rows_key(conversation_id):
+    return f'chat:room:{conversation_id}:rows'
+
+
+def _shared_snapshot_key(conversation_id):
+    return f'chat:room:{conversation_id}:snapshot'
+
+
+def _dump_row(row):
+    return json.dumps({
+        key: value.isoformat() if hasattr(value, 'isoformat') else value
+        for key, value in row.items()
+    })
+
+
+def _load_row(data):
+    row = json.loads(data)
+    row['timestamp'] = parse_datetime(row['timestamp'])
+    if row['edited_at']:
+        row['edited_at'] = parse_datetime(row['edited_at'])
+    return row
+
+
+def _get_shared(conversation):
+    client = _get_redis()
+    if client is None:
+        return None
+    try:
+        pipe = client.pipeline()
+        pipe.lrange(_shared_rows_key(conversation.pk), 0, settings.CHAT_ROOM_BUFFER_SIZE - 1)
+        pipe.get(_shared_snapshot_key(conversation.pk))
+        data, snapshot_at = pipe.execute()
+    except Exception as e:
+        logger.error(f"Error reading room buffer of conversation {conversation.pk}: {e}")
+        return None
+    if snapshot_at is None:
+        return None
+    # The list is kept newest first so appends are a single LPUSHX
+    rows = [_load_row(item) for item in reversed(data)]
+    if not _is_current(rows, conversation):
+        return None
+    return {'rows': rows, 'snapshot_at': parse_datetime(snapshot_at.decode())}
+
+
+def _store_shared(conversation_id, room):
+    client = _get_redis()
+    if client is None:
+        return
+    rows_key = _shared_rows_key(conversation_id)
+    snapshot_key = _shared_snapshot_key(conversation_id)
+    try:
+        pipe = client.pipeline()
+        pipe.delete(rows_key)
+        if room['rows']:
+            pipe.lpush(rows_key, *[_dump_row(row) for row in room['rows']])
+            pipe.expire(rows_key, SHARED_ROOM_TIMEOUT)
+        pipe.set(snapshot_key, room['snapshot_at'].isoformat(), ex=SHARED_ROOM_TIMEOUT)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error filling room buffer of conversation {conversation_id}: {e}")
@@ -0,0 +1,439 @@
+import json
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db.models import (
+    BooleanField, Case, Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Value, When
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from accounts import counters, presence
+from accounts.cache import get_profile_summaries
+from . import room_buffer
+from .models import Conversation, ConversationReadState, Message
+from .wire import prepare_event
+
+# Number of messages per history page (template view and API)
+MESSAGE_PAGE_SIZE = 50
+
+# Most messages (and most changed messages) replayed to a resuming socket
+RESUME_MAX_MESSAGES = 200
+
+
+def read_cursor_subquery(user):
+    """
+    Subquery yielding ``user``'s last read message id for the conversation of
+    the outer message row (0 when nothing has been read yet).
+    """
+    cursor = ConversationReadState.objects.filter(
+        conversation=OuterRef('conversation'),
+        user=user
+    ).values('last_read_message_id')[:1]
+    return Coalesce(Subquery(cursor), 0)
+
+
+def get_read_cursor(user, conversation_id):
+    """Return the id of the last message ``user`` has read in the conversation"""
+    return ConversationReadState.objects.filter(
+        conversation_id=conversation_id,
+        user=user
+    ).values_list('last_read_message_id', flat=True).first() or 0
+
+
+def mark_conversation_read(user, conversation_id, message_id=None):
+    """
+    Advance ``user``'s read cursor in the conversation to ``message_id``
+    (or to the latest message when omitted). The cursor never moves backwards.
+
+    Runs at most five statements regardless of how many messages are being
+    marked (more only when another request moves the cursor at the same
+    time), including taking the newly read messages off the user's unread
+    counter. Returns the new cursor position, or None if it did not move.
+    """
+    messages = Message.objects.filter(conversation_id=conversation_id)
+    if message_id is not None:
+        messages = messages.filter(id__lte=message_id)
+    target_id = messages.order_by('-id').values_list('id', flat=True).first()
+    if target_id is None:
+        return None
+
+    ConversationReadState.objects.bulk_create(
+        [ConversationReadState(conversation_id=conversation_id, user=user)],
+        ignore_conflicts=True
+    )
+    # Move the cursor from where it was read, so each message is counted as read once
+    while True:
+        previous_id = get_read_cursor(user, conversation_id)
+        if previous_id >= target_id:
+            return None
+        if ConversationReadState.objects.filter(
+            conversation_id=conversation_id,
+            user=user,
+            last_read_message_id=previous_id
+        ).update(
+            last_read_message_id=target_id,
+            last_read_at=timezone.now()
+        ):
+            break
+
+    newly_read = Message.objects.filter(
+        conversation_id=conversation_id,
+        id__gt=previous_id,
+        id__lte=target_id
+    ).exclude(
+        sender=user
+    ).order_by().values('conversation').annotate(
+        count=Count('pk')
+    ).values('count')
+    counters.add(
+        'unread_messages', [user.id], -Coalesce(Subquery(newly_read, output_field=IntegerField()), 0)
+    )
+    return target_id
+
+
+def read_receipt_event(user, last_read_message_id):
+    """Channel layer event announcing that ``user`` has read up to a message"""
+    return {
+        'type': 'read_receipt',
+        'user_id': user.id,
+        'last_read_message_id': last_read_message_id,
+    }
+
+
+def broadcast_read_receipt(user, conversation_id, last_read_message_id):
+    """Send a read receipt to everyone connected to the conversation"""
+    try:
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            f'chat_{conversation_id}',
+            prepare_event(read_receipt_event(user, last_read_message_id))
+        )
+    except Exception as e:
+        # Log error but don't prevent the HTTP response
+        print(f"Error sending read receipt via WebSocket: {e}")
+
+
+def _history_queryset(conversation, user, before=None, after=None):
+    """Keyset-filtered and ordered history queryset behind ``get_message_page``"""
+    messages = conversation.messages.filter(
+        Q(is_unsent=False) | Q(sender=user)
+    )
+
+    pivot_id = after if after is not None else before
+    if pivot_id is not None:
+        pivot_rows = Message.objects.filter(pk=pivot_id, conversation=conversation)
+        pivot = Subquery(pivot_rows.values('timestamp')[:1])
+        # The pivot may have been deleted since the page was loaded (expiry
+        # deletes the oldest messages first); ids grow with timestamps, so
+        # the id alone then locates the page
+        pivot_missing = ~Exists(pivot_rows)
+        if after is not None:
+            messages = messages.filter(
+                Q(timestamp__gt=pivot)
+                | Q(timestamp=pivot, id__gt=pivot_id)
+                | (pivot_missing & Q(id__gt=pivot_id))
+            )
+        else:
+            messages = messages.filter(
+                Q(timestamp__lt=pivot)
+                | Q(timestamp=pivot, id__lt=pivot_id)
+                | (pivot_missing & Q(id__lt=pivot_id))
+            )
+
+    if after is not None:
+        return messages.order_by('timestamp', 'id')
+    return messages.order_by('-timestamp', '-id')
+
+
+def _take_page(messages, after, limit):
+    """Evaluate one page plus a look-ahead row and return it oldest first"""
+    page = list(messages[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    if after is None:
+        page.reverse()
+    return page, has_more
+
+
+def get_message_page(conversation, user, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Return one page of conversation history as ``(messages, has_more)``.
+
+    Pages are addressed by message id: ``before`` returns the messages
+    preceding that message, ``after`` the ones following it and neither the
+    latest page. Ordering is keyset based on ``(timestamp, id)`` so every
+    page is an index range scan, however deep into the history it is. A
+    pivot message that no longer exists is located by its id alone.
+    Messages are returned oldest first; unsent messages are only visible to
+    their sender.
+    """
+    messages = _history_queryset(
+        conversation, user, before=before, after=after
+    ).select_related('sender__userprofile')
+    return _take_page(messages, after, limit)
+
+
+def get_message_page_values(conversation, user, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Same page as ``get_message_page`` but as plain rows for the JSON API,
+    fetched in a single query: only the serialized columns are selected,
+    ``is_read`` is computed in the database from ``user``'s read cursor and
+    sender details are read from the profile cache.
+    """
+    messages = _message_values(
+        _history_queryset(conversation, user, before=before, after=after), user
+    )
+    rows, has_more = _take_page(messages, after, limit)
+    _attach_senders(rows)
+    return rows, has_more
+
+
+def get_latest_message_page(conversation, user, limit=MESSAGE_PAGE_SIZE):
+    """
+    The latest page of ``get_message_page`` served from the room buffer, as
+    ``(messages, has_more, snapshot_at)``. Messages are unsaved instances
+    built from the buffered rows, so only ``sender_id`` is set, not
+    ``sender``. ``snapshot_at`` is when the buffered rows were read from the
+    database. Returns None when the buffer cannot answer and the page has to
+    be read from the database.
+    """
+    page = _latest_buffered_rows(conversation, user, limit)
+    if page is None:
+        return None
+    rows, has_more, snapshot_at = page
+    return [Message(conversation=conversation, **row) for row in rows], has_more, snapshot_at
+
+
+def get_latest_message_page_values(conversation, user, limit=MESSAGE_PAGE_SIZE):
+    """
+    The latest page of ``get_message_page_values`` served from the room
+    buffer, as ``(rows, has_more)``, or None when the buffer cannot answer.
+    Only the read cursor is queried.
+    """
+    page = _latest_buffered_rows(conversation, user, limit)
+    if page is None:
+        return None
+    rows, has_more, _ = page
+    last_read_message_id = get_read_cursor(user, conversation.id)
+    rows = [
+        dict(row, is_read=row['sender_id'] == user.id or row['id'] <= last_read_message_id)
+        for row in rows
+    ]
+    _attach_senders(rows)
+    return rows, has_more
+
+
+def _latest_buffered_rows(conversation, user, limit):
+    if not room_buffer.enabled():
+        return None
+    rows, complete, snapshot_at = room_buffer.get_rows(conversation)
+    # Unsent messages are only visible to their sender, as in _history_queryset
+    visible = [row for row in rows if not row['is_unsent'] or row['sender_id'] == user.id]
+    if len(visible) > limit:
+        return visible[-limit:], True, snapshot_at
+    if complete:
+        return visible, False, snapshot_at
+    room_buffer.record_fallback()
+    return None
+
+
+def _message_values(messages, user):
+    """Select the serialized message columns, with ``is_read`` computed for ``user``"""
+    read_by_user = ConversationReadState.objects.filter(
+        conversation=OuterRef('conversation'),
+        user=user,
+        last_read_message_id__gte=OuterRef('id')
+    )
+    return messages.annotate(
+        # Own messages are always read; others are read up to the cursor
+        is_read=Case(
+            When(Q(sender=user) | Q(Exists(read_by_user)), then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField()
+        )
+    ).values(
+        'id', 'content', 'message_type', 'sender_id', 'timestamp', 'is_read',
+        'image', 'video', 'is_edited', 'is_unsent', 'edited_at',
+    )
+
+
+def _attach_senders(rows):
+    # Sender names and avatars come from the profile cache, not a join
+    profiles = get_profile_summaries({row['sender_id'] for row in rows})
+    for row in rows:
+        row['sender'] = profiles.get(row['sender_id']) or {}
+
+
+def get_resume_delta(conversation_id, user, last_message_id, since, limit=RESUME_MAX_MESSAGES):
+    """
+    What a reconnecting socket missed, as ``(new_rows, changed_rows, complete)``:
+    messages after ``last_message_id`` (oldest first, in the shape of
+    ``get_message_page_values``) and earlier messages edited or unsent after
+    ``since``. ``complete`` is False when either list was cut at ``limit``
+    and the client has to reload instead.
+    """
+    visible = Message.objects.filter(
+        conversation_id=conversation_id
+    ).filter(
+        Q(is_unsent=False) | Q(sender=user)
+    )
+    new_rows = list(_message_values(
+        visible.filter(id__gt=last_message_id).order_by('id'), user
+    )[:limit + 1])
+    changed_rows = list(
+        Message.objects.filter(
+            conversation_id=conversation_id,
+            id__lte=last_message_id,
+            updated_at__gt=since
+        ).filter(
+            Q(is_edited=True) | Q(is_unsent=True)
+        ).order_by('updated_at').values(
+            'id', 'content', 'is_edited', 'is_unsent', 'edited_at'
+        )[:limit + 1]
+    )
+    complete = len(new_rows) <= limit and len(changed_rows) <= limit
+    new_rows = new_rows[:limit]
+    _attach_senders(new_rows)
+    return new_rows, changed_rows[:limit], complete
+
+
+def _media_url(name):
+    return default_storage.url(name) if name else None
+
+
+def serialize_message_row(row):
+    """Serialize a row from ``get_message_page_values`` for the JSON API"""
+    return {
+        'id': row['id'],
+        'content': row['content'],
+        'message_type': row['message_type'],
+        'sender_id': row['sender_id'],
+        'sender_username': row['sender'].get('username'),
+        'sender_profile_picture': row['sender'].get('profile_picture_url'),
+        'timestamp': row['timestamp'].isoformat(),
+        'is_read': row['is_read'],
+        'image_url': _media_url(row['image']),
+        'video_url': _media_url(row['video']),
+        'is_edited': row['is_edited'],
+        'is_unsent': row['is_unsent'],
+        'edited_at': row['edited_at'].isoformat() if row['edited_at'] else None,
+    }
+
+
+def serialize_message_event_row(row):
+    """Serialize a row from ``get_message_page_values`` as a chat_message event payload"""
+    return {
+        'id': row['id'],
+        'sender_id': row['sender_id'],
+        'sender_username': row['sender'].get('username'),
+        'sender_profile_picture_url': row['sender'].get('profile_picture_url') or '',
+        'content': row['content'],
+        'timestamp': row['timestamp'].isoformat(),
+        'image_url': _media_url(row['image']),
+        'video_url': _media_url(row['video']),
+        'is_edited': row['is_edited'],
+        'is_unsent': row['is_unsent'],
+        'edited_at': row['edited_at'].isoformat() if row['edited_at'] else None,
+    }
+
+
+def iter_message_page_json(rows, has_more):
+    """Stream a page of message rows as the ``get_messages`` JSON document"""
+    yield '{"messages": ['
+    for index, row in enumerate(rows):
+        if index:
+            yield ', '
+        yield json.dumps(serialize_message_row(row))
+    yield '], "has_more": %s}' % json.dumps(has_more)
+
+
+def get_conversation_list(user):
+    """
+    Return the conversation list for ``user`` as a list of dicts with the
+    other participant, the last message and the unread count.
+
+    Runs a fixed number of queries (conversations, participants, last
+    messages) no matter how many conversations the user has. The last
+    message comes from the denormalized columns on Conversation.
+    """
+    participants = Conversation.participants.through.objects.filter(
+        conversation=OuterRef('pk')
+    ).exclude(user=user)
+
+    unread_messages = Message.objects.filter(
+        conversation=OuterRef('pk'),
+        id__gt=read_cursor_subquery(user)
+    ).exclude(
+        sender=user
+    ).order_by().values('conversation').annotate(
+        count=Count('pk')
+    ).values('count')
+
+    conversations = list(
+        Conversation.objects.filter(
+            participants=user
+        ).annotate(
+            other_participant_id=Subquery(participants.values('user')[:1]),
+            unread_count=Coalesce(
+                Subquery(unread_messages, output_field=IntegerField()), 0
+            ),
+        ).order_by(F('last_message_at').desc(nulls_last=True), '-id')
+    )
+
+    users = User.objects.select_related('userprofile').in_bulk(
+        {conv.other_participant_id for conv in conversations if conv.other_participant_id}
+    )
+    last_messages = Message.objects.in_bulk(
+        {conv.last_message_id for conv in conversations if conv.last_message_id}
+    )
+    online_ids = presence.online_user_ids(users)
+
+    return [
+        {
+            'conversation': conv,
+            'other_participant': users.get(conv.other_participant_id),
+            'is_online': (
+                conv.other_participant_id in online_ids
+                and users[conv.other_participant_id].userprofile.show_online_status
+            ),
+            'unread_count': conv.unread_count,
+            'last_message': last_messages.get(conv.last_message_id),
+        }
+        for conv in conversations
+    ]
+
+
+def serialize_conversation_row(row):
+    """Serialize one entry of ``get_conversation_list`` for the JSON API"""
+    other = row['other_participant']
+    last_message = row['last_message']
+
+    other_data = None
+    if other is not None:
+        other_data = {
+            'id': other.id,
+            'username': other.username,
+            'full_name': other.get_full_name(),
+            'profile_picture_url': other.userprofile.get_profile_picture_url(),
+            'is_online': row['is_online'],
+        }
+
+    last_message_data = None
+    if last_message is not None:
+        last_message_data = {
+            'id': last_message.id,
+            'sender_id': last_message.sender_id,
+            'message_type': last_message.message_type,
+            'content': None if last_message.is_unsent else last_message.content,
+            'timestamp': last_message.timestamp.isoformat(),
+            'is_unsent': last_message.is_unsent,
+        }
+
+    return {
+        'id': row['conversation'].id,
+        'last_message_preview': row['conversation'].last_message_preview,
+        'other_participant': other_data,
+        'last_message': last_message_data,
+        'unread_count': row['unread_count'],
+    }
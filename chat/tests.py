@@ -1,3 +1,825 @@
-from django.test import TestCase
+import json
+import time
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts import counters, presence
+from . import rate_limit, room_buffer, wire, write_combiner
+from .cache import get_participant_ids
+from .models import Conversation, ConversationReadState, Message
+from .routing import websocket_urlpatterns
+from .services import (
+    get_conversation_list,
+    get_latest_message_page,
+    get_latest_message_page_values,
+    get_message_page,
+    get_message_page_values,
+    get_resume_delta,
+    mark_conversation_read,
+    serialize_message_row,
+)
+from .wire import MSGPACK_SUBPROTOCOL, decode_frame, event_frame, prepare_event
+
+
+def unread_from_source(user):
+    """Unread messages of ``user`` counted from the message and read cursor tables"""
+    return counters.count_from_source([user.id])[user.id]['unread_messages']
+
+
+class ConversationListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+
+    def create_conversations(self, count, messages_per_conversation=3):
+        conversations = []
+        for i in range(count):
+            friend = User.objects.create_user(username=f'friend{User.objects.count()}')
+            conversation = Conversation.objects.create()
+            conversation.participants.add(self.user, friend)
+            for j in range(messages_per_conversation):
+                Message.objects.create(
+                    conversation=conversation,
+                    sender=friend,
+                    content=f'message {j}'
+                )
+            conversation.refresh_from_db()
+            conversations.append(conversation)
+        return conversations
+
+    def test_query_count_is_constant(self):
+        self.create_conversations(1)
+        with self.assertNumQueries(3):
+            get_conversation_list(self.user)
+
+        self.create_conversations(20)
+        with self.assertNumQueries(3):
+            rows = get_conversation_list(self.user)
+        self.assertEqual(len(rows), 21)
+
+    def test_rows_carry_other_participant_last_message_and_unread_count(self):
+        conversation, = self.create_conversations(1)
+        first_message = conversation.messages.order_by('timestamp').first()
+        mark_conversation_read(self.user, conversation.id, first_message.id)
+
+        row, = get_conversation_list(self.user)
+        self.assertEqual(row['conversation'], conversation)
+        self.assertEqual(row['other_participant'], conversation.get_other_participant(self.user))
+        self.assertEqual(row['last_message'], conversation.last_message())
+        self.assertEqual(row['unread_count'], 2)
+
+    def test_conversations_endpoint(self):
+        self.create_conversations(2)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('chat:get_conversations'))
+        self.assertEqual(response.status_code, 200)
+        conversations = response.json()['conversations']
+        self.assertEqual(len(conversations), 2)
+        self.assertEqual(conversations[0]['unread_count'], 3)
+        self.assertEqual(conversations[0]['last_message']['content'], 'message 2')
+
+
+class ReadCursorTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.friend, content=f'message {i}')
+            for i in range(5)
+        ]
+
+    def test_own_messages_are_never_unread(self):
+        Message.objects.create(conversation=self.conversation, sender=self.user, content='reply')
+        self.assertEqual(unread_from_source(self.user), 5)
+
+    def test_cursor_only_moves_forward(self):
+        mark_conversation_read(self.user, self.conversation.id, self.messages[3].id)
+        mark_conversation_read(self.user, self.conversation.id, self.messages[1].id)
+        state = ConversationReadState.objects.get(conversation=self.conversation, user=self.user)
+        self.assertEqual(state.last_read_message_id, self.messages[3].id)
+        self.assertEqual(unread_from_source(self.user), 1)
+
+    def test_mark_all_read(self):
+        mark_conversation_read(self.user, self.conversation.id)
+        self.assertEqual(unread_from_source(self.user), 0)
+        self.assertEqual(ConversationReadState.objects.count(), 1)
+
+    def test_mark_read_runs_bounded_statements(self):
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=self.friend, content=f'backlog {i}')
+            for i in range(200)
+        ])
+        with self.assertNumQueries(5):
+            last_read_message_id = mark_conversation_read(self.user, self.conversation.id)
+        self.assertEqual(last_read_message_id, self.conversation.messages.order_by('-id').first().id)
+        self.assertIsNone(mark_conversation_read(self.user, self.conversation.id))
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        counters.get_counts(self.user.id)
+        counters.get_counts(self.friend.id)
+
+    def assert_unread(self, user, count):
+        self.assertEqual(unread_from_source(user), count)
+        self.assertEqual(counters.get_counts(user.id)['unread_messages'], count)
+
+    def send(self, sender, count=1):
+        return [
+            Message.objects.create(conversation=self.conversation, sender=sender, content=f'message {i}')
+            for i in range(count)
+        ]
+
+    def test_sent_messages_are_unread_until_read(self):
+        messages = self.send(self.friend, 4)
+        self.send(self.user)
+        self.assert_unread(self.user, 4)
+        self.assert_unread(self.friend, 1)
+
+        mark_conversation_read(self.user, self.conversation.id, messages[1].id)
+        self.assert_unread(self.user, 2)
+        mark_conversation_read(self.user, self.conversation.id, messages[0].id)
+        self.assert_unread(self.user, 2)
+        mark_conversation_read(self.user, self.conversation.id)
+        self.assert_unread(self.user, 0)
+
+    def test_deleting_unread_messages_discounts_them(self):
+        messages = self.send(self.friend, 4)
+        mark_conversation_read(self.user, self.conversation.id, messages[1].id)
+        Message.objects.filter(id__in=[messages[0].id, messages[2].id]).delete_with_media()
+        self.assert_unread(self.user, 1)
+        messages[3].delete_with_media()
+        self.assert_unread(self.user, 0)
+
+    def test_batched_writes_count_as_unread(self):
+        write_combiner.write_messages([
+            Message(conversation_id=self.conversation.id, sender=sender, content='batched')
+            for sender in (self.friend, self.friend, self.user)
+        ])
+        self.assert_unread(self.user, 2)
+        self.assert_unread(self.friend, 1)
+
+    def test_deleting_sender_or_conversation_discounts_messages(self):
+        self.send(self.friend, 3)
+        self.send(self.user, 2)
+        self.friend.delete()
+        self.assert_unread(self.user, 0)
+
+        other = User.objects.create_user(username='carol')
+        counters.get_counts(other.id)
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, other)
+        self.send(self.user, 2)
+        self.assert_unread(other, 2)
+        self.conversation.delete()
+        self.assert_unread(other, 0)
+
+
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        room_buffer.clear()
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=self.friend, content=f'message {i}')
+            for i in range(120)
+        ])
+        self.ids = list(self.conversation.messages.order_by('timestamp', 'id').values_list('id', flat=True))
+
+    def page_ids(self, **kwargs):
+        messages, has_more = get_message_page(self.conversation, self.user, **kwargs)
+        return [message.id for message in messages], has_more
+
+    def test_latest_page(self):
+        self.assertEqual(self.page_ids(), (self.ids[-50:], True))
+
+    def test_before_and_after(self):
+        self.assertEqual(self.page_ids(before=self.ids[70]), (self.ids[20:70], True))
+        self.assertEqual(self.page_ids(before=self.ids[20]), (self.ids[:20], False))
+        self.assertEqual(self.page_ids(after=self.ids[100]), (self.ids[101:], False))
+
+    def test_deleted_pivot(self):
+        # The oldest loaded message expired before the next page was requested
+        Message.objects.filter(id__in=[self.ids[70], self.ids[100]]).delete()
+        self.assertEqual(self.page_ids(before=self.ids[70]), (self.ids[20:70], True))
+        self.assertEqual(self.page_ids(after=self.ids[100]), (self.ids[101:], False))
+
+    def test_deep_page_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            self.page_ids(before=self.ids[5])
+        # Sender profiles come from the cache once it is warm
+        get_message_page_values(self.conversation, self.user, before=self.ids[5])
+        with self.assertNumQueries(1):
+            get_message_page_values(self.conversation, self.user, before=self.ids[5])
+
+    def test_values_page_matches_model_page(self):
+        mark_conversation_read(self.user, self.conversation.id, self.ids[99])
+        rows, has_more = get_message_page_values(self.conversation, self.user)
+        self.assertTrue(has_more)
+        self.assertEqual([row['id'] for row in rows], self.ids[-50:])
+        self.assertEqual(
+            [row['id'] for row in rows if not row['is_read']], self.ids[100:]
+        )
+        message = serialize_message_row(rows[0])
+        self.assertEqual(message['sender_username'], 'bob')
+        self.assertEqual(message['sender_profile_picture'], '/media/profile_pics/default.svg')
+
+    def test_unsent_messages_hidden_from_other_participants(self):
+        Message.objects.filter(id=self.ids[-1]).update(is_unsent=True)
+        self.assertNotIn(self.ids[-1], self.page_ids()[0])
+        messages, _ = get_message_page(self.conversation, self.friend)
+        self.assertEqual(messages[-1].id, self.ids[-1])
+
+    def test_views(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('chat:conversation_detail', args=[self.conversation.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['has_more'])
+        self.assertEqual(response.context['oldest_message_id'], self.ids[70])
+
+        response = self.client.get(
+            reverse('chat:get_messages', args=[self.conversation.id]), {'before': self.ids[70]}
+        )
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([m['id'] for m in data['messages']], self.ids[20:70])
+        self.assertTrue(all(m['is_read'] for m in data['messages']))
+
+        response = self.client.get(
+            reverse('chat:get_messages', args=[self.conversation.id]), {'after': 'yesterday'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ConversationLastMessageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user)
+
+    def send(self, content):
+        return Message.objects.create(conversation=self.conversation, sender=self.user, content=content)
+
+    def test_sending_updates_last_message_columns(self):
+        self.send('first')
+        message = self.send('second')
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, message.id)
+        self.assertEqual(self.conversation.last_message_at, message.timestamp)
+        self.assertEqual(self.conversation.last_message_preview, 'second')
+        self.assertEqual(self.conversation.last_message(), message)
+
+    def test_edit_and_unsend_update_preview(self):
+        message = self.send('hello')
+        message.edit_message('hello again')
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_preview, 'hello again')
+
+        message.unsend_message()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_preview, '')
+
+    def test_deleting_the_last_message_falls_back_to_the_previous_one(self):
+        first = self.send('first')
+        second = self.send('second')
+        Message.objects.filter(id=second.id).delete_with_media()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, first.id)
+        self.assertEqual(self.conversation.last_message_preview, 'first')
+
+        Message.objects.filter(id=first.id).delete_with_media()
+        self.conversation.refresh_from_db()
+        self.assertIsNone(self.conversation.last_message_id)
+        self.assertIsNone(self.conversation.last_message_at)
+
+
+@override_settings(CHAT_ROOM_BUFFER_REDIS_URL=None)
+class RoomBufferTests(TestCase):
+    def setUp(self):
+        room_buffer.clear()
+        self.addCleanup(room_buffer.clear)
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        self.messages = [self.send(self.friend, f'message {i}') for i in range(3)]
+
+    def send(self, sender, content, commit=True):
+        with self.captureOnCommitCallbacks(execute=commit):
+            message = Message.objects.create(conversation=self.conversation, sender=sender, content=content)
+        self.conversation.refresh_from_db()
+        return message
+
+    def latest_ids(self, user=None, **kwargs):
+        messages, has_more, _ = get_latest_message_page(self.conversation, user or self.user, **kwargs)
+        return [message.id for message in messages], has_more
+
+    def test_second_open_is_served_without_queries(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.latest_ids(), ([m.id for m in self.messages], False))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.latest_ids(), ([m.id for m in self.messages], False))
+        stats = room_buffer.stats()
+        self.assertEqual((stats['local_hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+
+    def test_saved_messages_are_applied_on_commit(self):
+        self.latest_ids()
+        message = self.send(self.friend, 'new')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.messages[0].edit_message('edited')
+        with self.assertNumQueries(0):
+            messages, _, _ = get_latest_message_page(self.conversation, self.user)
+        self.assertEqual(messages[-1].id, message.id)
+        self.assertEqual((messages[0].content, messages[0].is_edited), ('edited', True))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message.unsend_message()
+        self.assertNotIn(message.id, self.latest_ids()[0])
+        self.assertIn(message.id, self.latest_ids(user=self.friend)[0])
+
+    def test_room_missing_the_last_message_is_reloaded(self):
+        self.latest_ids()
+        # Sent by another process: this one never sees the commit
+        message = self.send(self.friend, 'elsewhere', commit=False)
+        self.assertEqual(self.latest_ids()[0][-1], message.id)
+        self.assertEqual(room_buffer.stats()['misses'], 2)
+
+    def test_deleting_messages_drops_the_room(self):
+        self.latest_ids()
+        Message.objects.filter(id=self.messages[0].id).delete_with_media()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.latest_ids()[0], [m.id for m in self.messages[1:]])
+        self.assertEqual(room_buffer.stats()['invalidations'], 1)
+
+    @override_settings(CHAT_ROOM_BUFFER_SIZE=3)
+    def test_full_room_pages_and_falls_back(self):
+        self.send(self.friend, 'fourth')
+        self.assertEqual(self.latest_ids(limit=2)[1], True)
+        # Three buffered rows of which one is hidden cannot fill a page of three
+        with self.captureOnCommitCallbacks(execute=True):
+            self.messages[2].unsend_message()
+        self.assertIsNone(get_latest_message_page(self.conversation, self.user, limit=3))
+        self.assertEqual(room_buffer.stats()['fallbacks'], 1)
+
+    @override_settings(CHAT_ROOM_BUFFER_ROOMS=1)
+    def test_least_recently_used_room_is_evicted(self):
+        other = Conversation.objects.create()
+        get_latest_message_page(other, self.user)
+        self.latest_ids()
+        stats = room_buffer.stats()
+        self.assertEqual((stats['rooms'], stats['evictions']), (1, 1))
+
+    def test_values_page_matches_database_page(self):
+        mark_conversation_read(self.user, self.conversation.id, self.messages[1].id)
+        expected, _ = get_message_page_values(self.conversation, self.user)
+        rows, has_more = get_latest_message_page_values(self.conversation, self.user)
+        self.assertFalse(has_more)
+        self.assertEqual(
+            [serialize_message_row(row) for row in rows],
+            [serialize_message_row(row) for row in expected]
+        )
+
+    def test_stats_are_staff_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('chat:room_buffer_stats')).status_code, 302)
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        response = self.client.get(reverse('chat:room_buffer_stats'))
+        self.assertEqual(response.json()['rooms'], 0)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE_SECONDS=0,
+    CHAT_RATE_LIMITS={
+        'message': {'user': (2, 1), 'conversation': (3, 1)},
+        'typing': {'user': (1, 1)},
+    },
+    CHAT_RATE_LIMIT_REDIS_URL=None,
+)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        rate_limit.clear()
+        self.addCleanup(rate_limit.clear)
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        self.addCleanup(presence.flush)
+
+    def test_user_and_conversation_buckets(self):
+        self.assertEqual(rate_limit.hit('message', self.user.id, self.conversation.id), 0)
+        self.assertEqual(rate_limit.hit('message', self.user.id, self.conversation.id), 0)
+        self.assertGreater(rate_limit.hit('message', self.user.id, self.conversation.id), 0)
+        # The refused message took no token from the room
+        self.assertEqual(rate_limit.hit('message', self.friend.id, self.conversation.id), 0)
+        self.assertGreater(rate_limit.hit('message', self.friend.id, self.conversation.id), 0)
+        # Actions without a policy are not limited
+        self.assertEqual(rate_limit.hit('mark_read', self.user.id, self.conversation.id), 0)
+
+    @override_settings(CHAT_RATE_LIMIT_REDIS_URL='redis://127.0.0.1:1')
+    def test_unreachable_redis_is_left_alone_for_a_while(self):
+        def reset():
+            rate_limit._redis = rate_limit._script = None
+            rate_limit._redis_down_until = 0
+        reset()
+        self.addCleanup(reset)
+
+        with mock.patch.object(rate_limit.logger, 'error') as logged_error:
+            # Local buckets take over, and Redis is not tried again for every action
+            self.assertEqual(rate_limit.hit('message', self.user.id, self.conversation.id), 0)
+            self.assertEqual(rate_limit.hit('message', self.user.id, self.conversation.id), 0)
+            self.assertGreater(rate_limit.hit('message', self.user.id, self.conversation.id), 0)
+        logged_error.assert_called_once()
+        self.assertIsNone(rate_limit._get_script())
+        self.assertEqual(rate_limit._redis.connection_pool.connection_kwargs['socket_timeout'], rate_limit.REDIS_TIMEOUT)
+
+    def test_send_message_over_the_limit(self):
+        self.client.force_login(self.user)
+        for _ in range(2):
+            response = self.client.post(
+                reverse('chat:send_message'), {'conversation_id': self.conversation.id, 'content': 'hi'}
+            )
+            self.assertTrue(response.json()['success'])
+        response = self.client.post(
+            reverse('chat:send_message'), {'conversation_id': self.conversation.id, 'content': 'hi'}
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.conversation.messages.count(), 2)
+
+    async def test_socket_refuses_messages_and_drops_typing(self):
+        sender = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        sender.scope['user'] = self.user
+        await sender.connect()
+        reader = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        reader.scope['user'] = self.friend
+        await reader.connect()
+
+        for i in range(3):
+            await sender.send_json_to({'type': 'chat_message', 'message': {'content': 'hi', 'client_id': f'c{i}'}})
+        frames = [await sender.receive_json_from() for _ in range(3)]
+        self.assertEqual([frame['type'] for frame in frames], ['message_ack', 'message_ack', 'error'])
+        self.assertEqual((frames[2]['code'], frames[2]['client_id']), ('rate_limited', 'c2'))
+        self.assertEqual(len([await reader.receive_json_from() for _ in range(2)]), 2)
+
+        await sender.send_json_to({'type': 'typing'})
+        await sender.send_json_to({'type': 'typing'})
+        self.assertEqual((await reader.receive_json_from())['type'], 'typing')
+        self.assertTrue(await sender.receive_nothing())
+
+        await sender.disconnect()
+        await reader.disconnect()
+        await presence.wait_for_announcements()
+
+
+@override_settings(
+    CHAT_RATE_LIMITS={
+        'message': {'user': (2, 1), 'conversation': (3, 1)},
+        'typing': {'user': (1, 20)},
+    },
+)
+class SharedRateLimitTests(SimpleTestCase):
+    """Buckets in Redis (the Lua script); skipped without a Redis server"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import redis
+        cls.redis_url = settings.REDIS_URL or 'redis://localhost:6379'
+        try:
+            redis.Redis.from_url(cls.redis_url, socket_connect_timeout=0.5).ping()
+        except redis.exceptions.ConnectionError:
+            raise unittest.SkipTest(f'No Redis server at {cls.redis_url}')
+
+    def setUp(self):
+        shared = override_settings(CHAT_RATE_LIMIT_REDIS_URL=self.redis_url)
+        shared.enable()
+        self.addCleanup(shared.disable)
+        self.reset_script()
+        self.addCleanup(self.reset_script)
+        self.addCleanup(rate_limit.clear)
+        # Fresh ids so runs do not share buckets
+        self.user_id, self.friend_id, self.conversation_id = (uuid.uuid4().int for _ in range(3))
+        errors = mock.patch.object(rate_limit.logger, 'error')
+        self.logged_error = errors.start()
+        self.addCleanup(errors.stop)
+
+    def reset_script(self):
+        rate_limit._redis = rate_limit._script = None
+        rate_limit._redis_down_until = 0
+
+    def test_user_and_conversation_buckets(self):
+        self.assertEqual(rate_limit.hit('message', self.user_id, self.conversation_id), 0)
+        self.assertEqual(rate_limit.hit('message', self.user_id, self.conversation_id), 0)
+        self.assertGreater(rate_limit.hit('message', self.user_id, self.conversation_id), 0)
+        # The refused message took no token from the room
+        self.assertEqual(rate_limit.hit('message', self.friend_id, self.conversation_id), 0)
+        self.assertGreater(rate_limit.hit('message', self.friend_id, self.conversation_id), 0)
+        self.logged_error.assert_not_called()
+
+    def test_buckets_are_shared_and_refill(self):
+        self.assertEqual(rate_limit.hit('typing', self.user_id), 0)
+        # Another process has no local buckets, but sees the same Redis ones
+        rate_limit.clear()
+        self.reset_script()
+        wait = rate_limit.hit('typing', self.user_id)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.05)
+        time.sleep(wait + 0.01)
+        self.assertEqual(rate_limit.hit('typing', self.user_id), 0)
+        self.logged_error.assert_not_called()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE_SECONDS=0,
+)
+class ConversationMembershipTests(TestCase):
+    def setUp(self):
+        rate_limit.clear()
+        self.user = User.objects.create_user(username='alice', password='pass12345')
+        self.friend = User.objects.create_user(username='bob')
+        self.stranger = User.objects.create_user(username='mallory', password='pass12345')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        self.addCleanup(presence.flush)
+
+    def connect(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_membership_is_cached_and_invalidated(self):
+        self.assertEqual(get_participant_ids(self.conversation.id), {self.user.id, self.friend.id})
+        with self.assertNumQueries(0):
+            get_participant_ids(self.conversation.id)
+
+        self.conversation.participants.remove(self.friend)
+        self.assertEqual(get_participant_ids(self.conversation.id), {self.user.id})
+
+        self.stranger.conversations.add(self.conversation)
+        self.assertEqual(get_participant_ids(self.conversation.id), {self.user.id, self.stranger.id})
+
+        conversation_id = self.conversation.id
+        self.conversation.delete()
+        self.assertEqual(get_participant_ids(conversation_id), set())
+
+    async def test_non_participants_are_rejected_at_connect(self):
+        communicator = self.connect(self.stranger)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_participants_send_without_loading_the_conversation(self):
+        communicator = self.connect(self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'type': 'chat_message', 'message': {'content': 'hi'}})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'message_ack')
+        self.assertEqual(response['message']['content'], 'hi')
+        await communicator.disconnect()
+        await presence.wait_for_announcements()
+
+    def test_send_message_view_checks_membership(self):
+        self.client.login(username='mallory', password='pass12345')
+        response = self.client.post(
+            reverse('chat:send_message'), {'conversation_id': self.conversation.id, 'content': 'hi'}
+        )
+        self.assertEqual(response.status_code, 404)
+
+        self.client.login(username='alice', password='pass12345')
+        response = self.client.post(
+            reverse('chat:send_message'), {'conversation_id': self.conversation.id, 'content': 'hi'}
+        )
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.conversation.messages.get().content, 'hi')
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_DEBOUNCE_SECONDS=0,
+    TYPING_BROADCAST_INTERVAL=10,
+    TYPING_TIMEOUT=0.1,
+)
+class ChatConsumerTests(TestCase):
+    def setUp(self):
+        rate_limit.clear()
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+        self.addCleanup(presence.flush)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_messages_are_acked_to_the_sender_instead_of_echoed(self):
+        sender = await self.connect(self.user)
+        other_tab = await self.connect(self.user)
+        reader = await self.connect(self.friend)
+
+        await sender.send_json_to({'type': 'chat_message', 'message': {'content': 'hi', 'client_id': 'c1'}})
+        ack = await sender.receive_json_from()
+        self.assertEqual((ack['type'], ack['client_id']), ('message_ack', 'c1'))
+        message_id = ack['message']['id']
+        self.assertTrue(await sender.receive_nothing())
+        for communicator in (other_tab, reader):
+            event = await communicator.receive_json_from()
+            self.assertEqual((event['type'], event['message']['id']), ('chat_message', message_id))
+
+        await sender.send_json_to({'type': 'unsend_message', 'message': {'id': message_id}})
+        self.assertEqual((await sender.receive_json_from())['type'], 'message_unsent')
+        self.assertTrue(await sender.receive_nothing())
+        self.assertEqual((await reader.receive_json_from())['type'], 'message_unsent')
+
+        for communicator in (sender, other_tab, reader):
+            await communicator.disconnect()
+        await presence.wait_for_announcements()
+
+    async def test_msgpack_subprotocol(self):
+        sender = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/',
+            subprotocols=[MSGPACK_SUBPROTOCOL]
+        )
+        sender.scope['user'] = self.user
+        connected, subprotocol = await sender.connect()
+        self.assertEqual((connected, subprotocol), (True, MSGPACK_SUBPROTOCOL))
+        reader = await self.connect(self.friend)
+
+        await sender.send_to(bytes_data=msgpack.packb({'t': 'chat_message', 'm': {'c': 'hi', 'ci': 'c1'}}))
+        ack = msgpack.unpackb(await sender.receive_from())
+        self.assertEqual((ack['t'], ack['ci'], ack['m']['c']), ('message_ack', 'c1', 'hi'))
+        self.assertEqual(decode_frame(msgpack.packb(ack))['message']['content'], 'hi')
+
+        # JSON clients in the same room still get JSON
+        event = await reader.receive_json_from()
+        self.assertEqual((event['type'], event['message']['id']), ('chat_message', ack['m']['i']))
+
+        await reader.send_json_to({'type': 'typing'})
+        typing = msgpack.unpackb(await sender.receive_from())
+        self.assertEqual((typing['t'], typing['u']), ('typing', self.friend.id))
+
+        await sender.disconnect()
+        await reader.disconnect()
+        await presence.wait_for_announcements()
+
+    def test_group_events_are_encoded_once_per_process_and_format(self):
+        event = prepare_event({'type': 'user_stop_typing', 'user_id': self.user.id})
+        # Only the fields go through the channel layer, and each socket gets its own copy
+        self.assertEqual(set(event), {'type', 'user_id', 'event_id'})
+        copies = [dict(event) for _ in range(3)]
+        with mock.patch.object(wire, 'encode_frame', wraps=wire.encode_frame) as encode:
+            texts = {event_frame(copy, False) for copy in copies}
+            binaries = {event_frame(copy, True) for copy in copies}
+        self.assertEqual(encode.call_count, 2)
+        self.assertEqual(json.loads(texts.pop()), {'type': 'stop_typing', 'user_id': self.user.id})
+        self.assertEqual(decode_frame(binaries.pop()), {'type': 'stop_typing', 'user_id': self.user.id})
+
+    async def test_frames_within_the_batch_window_share_one_frame(self):
+        sender = await self.connect(self.user)
+        reader = await self.connect(self.friend)
+
+        with self.settings(CHAT_FRAME_BATCH_WINDOW=50):
+            await sender.send_json_to({'type': 'typing'})
+            await sender.send_json_to({'type': 'chat_message', 'message': {'content': 'hi'}})
+            frames = await reader.receive_json_from()
+            self.assertEqual([frame['type'] for frame in frames], ['typing', 'chat_message'])
+            # A lone frame is sent as is
+            self.assertEqual((await sender.receive_json_from())['type'], 'message_ack')
+
+        await sender.disconnect()
+        await reader.disconnect()
+        await presence.wait_for_announcements()
+
+    async def test_messages_within_the_write_window_are_saved_together(self):
+        sender = await self.connect(self.user)
+        reader = await self.connect(self.friend)
+
+        with self.settings(CHAT_WRITE_BATCH_WINDOW=50), \
+                mock.patch.object(write_combiner, 'write_messages', wraps=write_combiner.write_messages) as write:
+            await sender.send_json_to({'type': 'chat_message', 'message': {'content': 'first'}})
+            await reader.send_json_to({'type': 'chat_message', 'message': {'content': 'second'}})
+            acks = [await sender.receive_json_from(), await reader.receive_json_from()]
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual([ack['type'] for ack in acks], ['message_ack', 'message_ack'])
+
+        saved = await database_sync_to_async(list)(
+            self.conversation.messages.order_by('id').values_list('id', 'content', 'expires_at')
+        )
+        self.assertEqual(
+            [row[:2] for row in saved],
+            [(acks[0]['message']['id'], 'first'), (acks[1]['message']['id'], 'second')]
+        )
+        self.assertTrue(all(row[2] for row in saved))
+        await database_sync_to_async(self.conversation.refresh_from_db)()
+        self.assertEqual(self.conversation.last_message_id, acks[1]['message']['id'])
+
+        await sender.disconnect()
+        await reader.disconnect()
+        await presence.wait_for_announcements()
+
+    def create_gap(self):
+        seen = Message.objects.create(conversation=self.conversation, sender=self.user, content='seen')
+        edited = Message.objects.create(conversation=self.conversation, sender=self.friend, content='old')
+        since = timezone.now()
+        edited.edit_message('new')
+        missed = [
+            Message.objects.create(conversation=self.conversation, sender=self.friend, content=f'missed {i}')
+            for i in range(2)
+        ]
+        missed[1].unsend_message()
+        return seen, edited, missed, since
+
+    def test_resume_delta(self):
+        seen, edited, missed, since = self.create_gap()
+
+        new_rows, changed_rows, complete = get_resume_delta(self.conversation.id, self.user, edited.id, since)
+        self.assertTrue(complete)
+        # Unsent messages of others are not replayed as new
+        self.assertEqual([row['id'] for row in new_rows], [missed[0].id])
+        self.assertEqual([(row['id'], row['content']) for row in changed_rows], [(edited.id, 'new')])
+
+        self.assertFalse(get_resume_delta(self.conversation.id, self.user, 0, since, limit=1)[2])
+
+    async def test_resume_replays_the_gap(self):
+        seen, edited, missed, since = await database_sync_to_async(self.create_gap)()
+        reader = await self.connect(self.user)
+
+        await reader.send_json_to({'type': 'resume', 'last_message_id': edited.id, 'since': since.isoformat()})
+        frames = [await reader.receive_json_from() for _ in range(3)]
+        self.assertEqual(
+            [(frame['type'], frame.get('message', {}).get('id')) for frame in frames],
+            [('chat_message', missed[0].id), ('message_edited', edited.id), ('resumed', None)]
+        )
+        self.assertEqual(frames[1]['message']['content'], 'new')
+
+        # A naive time is read in the current time zone
+        naive = timezone.make_naive(since).isoformat()
+        await reader.send_json_to({'type': 'resume', 'last_message_id': missed[1].id, 'since': naive})
+        frames = [await reader.receive_json_from() for _ in range(3)]
+        self.assertEqual(
+            [(frame['type'], frame.get('message', {}).get('id')) for frame in frames],
+            [('message_edited', edited.id), ('message_unsent', missed[1].id), ('resumed', None)]
+        )
+
+        # A malformed time cannot tell which edits and unsends were missed
+        await reader.send_json_to({'type': 'resume', 'last_message_id': missed[1].id, 'since': 'not a date'})
+        self.assertEqual((await reader.receive_json_from())['type'], 'resync_required')
+
+        await reader.disconnect()
+        await presence.wait_for_announcements()
+
+    async def test_typing_is_throttled_expires_and_is_not_echoed(self):
+        typist = await self.connect(self.user)
+        reader = await self.connect(self.friend)
+
+        for _ in range(5):
+            await typist.send_json_to({'type': 'typing'})
+
+        typing = await reader.receive_json_from()
+        self.assertEqual((typing['type'], typing['user_id'], typing['timeout']), ('typing', self.user.id, 0.1))
+        # No stop_typing frame from the client: the server expires the state
+        stop = await reader.receive_json_from(timeout=1)
+        self.assertEqual((stop['type'], stop['user_id']), ('stop_typing', self.user.id))
+        self.assertTrue(await reader.receive_nothing())
+        self.assertTrue(await typist.receive_nothing())
+
+        # Explicit stop_typing after expiry is not broadcast again
+        await typist.send_json_to({'type': 'stop_typing'})
+        self.assertTrue(await reader.receive_nothing())
+
+        await typist.disconnect()
+        await reader.disconnect()
+        await presence.wait_for_announcements()
@@ -13,6 +13,8 @@ urlpatterns = [
     path('send-message/', views.send_message, name='send_message'),
     path('edit-message/', views.edit_message, name='edit_message'),
     path('unsend-message/', views.unsend_message, name='unsend_message'),
+    path('api/conversations/', views.get_conversations, name='get_conversations'),
     path('api/messages/<int:conversation_id>/', views.get_messages, name='get_messages'),
     path('mark-messages-read/', views.mark_messages_read, name='mark_messages_read'),
+    path('api/room-buffer-stats/', views.room_buffer_stats, name='room_buffer_stats'),
 ]
\ No newline at end of file
@@ -1,54 +1,51 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
-from django.core.paginator import Paginator
-from django.db.models import Q, Max
+from django.db.models import Q
+from django.utils import timezone
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from .models import Conversation, Message, MessageReadStatus
+from . import rate_limit, room_buffer
+from .cache import is_participant
+from .models import Conversation, Message
+from .services import (
+    broadcast_read_receipt,
+    get_conversation_list,
+    get_latest_message_page,
+    get_latest_message_page_values,
+    get_message_page,
+    get_message_page_values,
+    get_read_cursor,
+    iter_message_page_json,
+    mark_conversation_read,
+    serialize_conversation_row,
+)
+from .wire import prepare_event
+from accounts import presence
+from accounts.cache import get_profile_summary
 from accounts.models import FriendRequest
 import json
+import math
 
 @login_required
 def dashboard(request):
-    # Get conversations where user is a participant
-    conversations = Conversation.objects.filter(
-        participants=request.user
-    ).annotate(
-        last_message_time=Max('messages__timestamp')
-    ).order_by('-last_message_time')
-    
-    # Get unread message counts for each conversation
-    conversation_data = []
-    for conv in conversations:
-        unread_count = Message.objects.filter(
-            conversation=conv
-        ).exclude(
-            messagereadstatus__user=request.user,
-            messagereadstatus__is_read=True
-        ).count()
-        
-        # Get the other participant
-        other_participant = conv.participants.exclude(id=request.user.id).first()
-        
-        # Get last message
-        last_message = conv.messages.order_by('-timestamp').first()
-        
-        conversation_data.append({
-            'conversation': conv,
-            'other_participant': other_participant,
-            'unread_count': unread_count,
-            'last_message': last_message
-        })
-    
     context = {
-        'conversation_data': conversation_data
+        'conversation_data': get_conversation_list(request.user)
     }
     
     return render(request, 'chat/dashboard.html', context)
 
+@login_required
+def get_conversations(request):
+    """API endpoint to get the conversation list (for AJAX updates)"""
+    conversation_data = get_conversation_list(request.user)
+    return JsonResponse({
+        'conversations': [serialize_conversation_row(row) for row in conversation_data]
+    })
+
 @login_required
 def conversation_detail(request, conversation_id):
     conversation = get_object_or_404(
@@ -57,43 +54,42 @@ def conversation_detail(request, conversation_id):
         participants=request.user
     )
     
+    # Server time the page is rendered from; the chat socket resumes from it
+    synced_at = timezone.now()
+    
     # Get the other participant
     other_participant = conversation.participants.exclude(id=request.user.id).first()
     
-    # Get messages with pagination
-    messages = conversation.messages.select_related(
-        'sender__userprofile'
-    ).order_by('-timestamp')
-    
-    # Filter out unsent messages for other users
-    messages = messages.filter(
-        Q(is_unsent=False) | Q(sender=request.user)
-    )
-    
-    paginator = Paginator(messages, 50)  # Show 50 messages per page
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    # Get the latest page of messages (or the page before ?before=<message_id>)
+    try:
+        before = _message_id_param(request, 'before')
+    except ValueError:
+        before = None
+    page = get_latest_message_page(conversation, request.user) if before is None else None
+    if page is not None:
+        # Served from the room buffer: resume from when it was read instead
+        messages, has_more, synced_at = page
+    else:
+        messages, has_more = get_message_page(conversation, request.user, before=before)
     
     # Mark messages as read
-    unread_messages = Message.objects.filter(
-        conversation=conversation
-    ).exclude(
-        messagereadstatus__user=request.user,
-        messagereadstatus__is_read=True
-    )
-    
-    for message in unread_messages:
-        MessageReadStatus.objects.update_or_create(
-            message=message,
-            user=request.user,
-            defaults={'is_read': True}
-        )
+    last_read_message_id = mark_conversation_read(request.user, conversation.id)
+    if last_read_message_id:
+        broadcast_read_receipt(request.user, conversation.id, last_read_message_id)
     
     context = {
         'conversation': conversation,
         'other_participant': other_participant,
-        'messages': page_obj,
-        'page_obj': page_obj
+        'synced_at': synced_at.isoformat(),
+        'other_is_online': (
+            other_participant is not None
+            and other_participant.userprofile.show_online_status
+            and presence.is_online(other_participant.id)
+        ),
+        'other_last_read_message_id': get_read_cursor(other_participant, conversation.id) if other_participant else 0,
+        'messages': messages,
+        'has_more': has_more,
+        'oldest_message_id': messages[0].id if messages else None,
     }
     
     return render(request, 'chat/conversation_detail.html', context)
@@ -117,11 +113,23 @@ def send_message(request):
     if not conversation_id:
         return JsonResponse({'success': False, 'message': 'Conversation ID required'})
     
-    conversation = get_object_or_404(
-        Conversation, 
-        id=conversation_id, 
-        participants=request.user
-    )
+    # Membership comes from the shared cache instead of a participants join
+    try:
+        conversation_id = int(conversation_id)
+    except ValueError:
+        raise Http404
+    if not is_participant(conversation_id, request.user.id):
+        raise Http404
+    
+    # Same message limits as the chat socket
+    retry_after = rate_limit.hit('message', request.user.id, conversation_id)
+    if retry_after:
+        response = JsonResponse({
+            'success': False,
+            'message': 'You are sending messages too fast. Please wait a moment.',
+        }, status=429)
+        response['Retry-After'] = str(math.ceil(retry_after))
+        return response
     
     # Validate that there's content or media
     if not content and not image and not video:
@@ -154,7 +162,7 @@ def send_message(request):
     
     # Create message
     message = Message.objects.create(
-        conversation=conversation,
+        conversation_id=conversation_id,
         sender=request.user,
         content=content,
         image=image,
@@ -164,24 +172,17 @@ def send_message(request):
     
     print(f"DEBUG: Message created with ID: {message.id}")
     
-    # Mark as read for sender
-    MessageReadStatus.objects.create(
-        message=message,
-        user=request.user,
-        is_read=True
-    )
-    
     # Broadcast the message via WebSocket
     try:
         channel_layer = get_channel_layer()
         
-        sender_profile_pic_url = request.user.userprofile.profile_picture.url if request.user.userprofile.profile_picture else None
+        sender_profile_pic_url = get_profile_summary(request.user.id)['profile_picture_url']
         image_url = message.image.url if message.image else None
         video_url = message.video.url if message.video else None
 
         async_to_sync(channel_layer.group_send)(
-            f'chat_{conversation.id}',
-            {
+            f'chat_{conversation_id}',
+            prepare_event({
                 'type': 'chat_message',
                 'message': {
                     'id': message.id,
@@ -196,7 +197,7 @@ def send_message(request):
                     'is_unsent': message.is_unsent,
                     'edited_at': message.edited_at.isoformat() if message.edited_at else None,
                 }
-            }
+            })
         )
     except Exception as e:
         # Log error but don't prevent the HTTP response
@@ -222,43 +223,35 @@ def get_messages(request, conversation_id):
         participants=request.user
     )
     
-    # Get messages after a certain timestamp if provided
-    after_timestamp = request.GET.get('after')
-    messages_query = conversation.messages.select_related(
-        'sender__userprofile'
-    ).order_by('timestamp')
-    
-    if after_timestamp:
-        from django.utils.dateparse import parse_datetime
-        after_dt = parse_datetime(after_timestamp)
-        if after_dt:
-            messages_query = messages_query.filter(timestamp__gt=after_dt)
-    
-    messages = messages_query[:50]  # Limit to 50 messages
-    
-    messages_data = []
-    for message in messages:
-        # Check if message is read by current user
-        is_read = MessageReadStatus.objects.filter(
-            message=message,
-            user=request.user,
-            is_read=True
-        ).exists()
-        
-        message_data = {
-            'id': message.id,
-            'content': message.content,
-            'sender_id': message.sender.id,
-            'sender_username': message.sender.username,
-            'sender_profile_picture': message.sender.userprofile.profile_picture.url if message.sender.userprofile.profile_picture else None,
-            'timestamp': message.timestamp.isoformat(),
-            'is_read': is_read,
-            'image_url': message.image.url if message.image else None,
-            'video_url': message.video.url if message.video else None
-        }
-        messages_data.append(message_data)
-    
-    return JsonResponse({'messages': messages_data})
+    # Page through history by message id: ?before=<id> for older messages,
+    # ?after=<id> for newer ones, neither for the latest page
+    try:
+        before = _message_id_param(request, 'before')
+        after = _message_id_param(request, 'after')
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid message ID'}, status=400)
+    
+    page = None
+    if before is None and after is None:
+        page = get_latest_message_page_values(conversation, request.user)
+    if page is not None:
+        rows, has_more = page
+    else:
+        rows, has_more = get_message_page_values(conversation, request.user, before=before, after=after)
+    
+    return StreamingHttpResponse(
+        iter_message_page_json(rows, has_more),
+        content_type='application/json'
+    )
+
+def _message_id_param(request, name):
+    """Read an optional message id query parameter"""
+    value = request.GET.get(name)
+    if not value:
+        return None
+    if not value.isdigit():
+        raise ValueError(f"Invalid {name} parameter")
+    return int(value)
 
 @login_required
 @require_POST
@@ -276,19 +269,9 @@ def mark_messages_read(request):
     )
     
     # Mark all unread messages in this conversation as read
-    unread_messages = Message.objects.filter(
-        conversation=conversation
-    ).exclude(
-        messagereadstatus__user=request.user,
-        messagereadstatus__is_read=True
-    )
-    
-    for message in unread_messages:
-        MessageReadStatus.objects.update_or_create(
-            message=message,
-            user=request.user,
-            defaults={'is_read': True}
-        )
+    last_read_message_id = mark_conversation_read(request.user, conversation.id)
+    if last_read_message_id:
+        broadcast_read_receipt(request.user, conversation.id, last_read_message_id)
     
     return JsonResponse({'success': True})
 
@@ -347,7 +330,7 @@ def edit_message(request):
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 f'chat_{message.conversation.id}',
-                {
+                prepare_event({
                     'type': 'message_edited',
                     'message': {
                         'id': message.id,
@@ -355,7 +338,7 @@ def edit_message(request):
                         'is_edited': message.is_edited,
                         'edited_at': message.edited_at.isoformat() if message.edited_at else None,
                     }
-                }
+                })
             )
         except Exception as e:
             print(f"Error sending edit via WebSocket: {e}")
@@ -397,13 +380,13 @@ def unsend_message(request):
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 f'chat_{message.conversation.id}',
-                {
+                prepare_event({
                     'type': 'message_unsent',
                     'message': {
                         'id': message.id,
                         'is_unsent': message.is_unsent,
                     }
-                }
+                })
             )
         except Exception as e:
             print(f"Error sending unsend via WebSocket: {e}")
@@ -418,3 +401,8 @@ def unsend_message(request):
         return JsonResponse({'success': False, 'message': 'Message not found'})
     except Exception as e:
         return JsonResponse({'success': False, 'message': f'Error unsending message: {str(e)}'})
+
+@staff_member_required
+def room_buffer_stats(request):
+    """Room buffer counters of the process serving the request (staff only)"""
+    return JsonResponse(room_buffer.stats())
@@ -0,0 +1,137 @@
+"""
+Wire format of ChatConsumer frames.
+
+Clients speak JSON text frames by default. A client that offers the
+MSGPACK_SUBPROTOCOL when opening ``ws/chat/<id>/`` gets binary msgpack frames
+with the short field codes of FIELD_CODES instead, and may send msgpack too.
+
+Group events travel through the channel layer as plain fields tagged with an
+id by ``prepare_event``. The first socket of a process to deliver an event
+encodes it in its own format and the others reuse those bytes
+(``event_frame``), so each event is encoded at most once per process and per
+format actually in use, and the channel layer carries it only once.
+
+With CHAT_FRAME_BATCH_WINDOW set, frames for the same socket within the window
+are sent together as one array frame (see ``batch_frames``).
+"""
+from collections import OrderedDict
+import json
+import msgpack
+import threading
+import uuid
+
+MSGPACK_SUBPROTOCOL = 'kothakow.msgpack.v1'
+
+# Encoded group event frames kept per process, most recent first out last
+ENCODED_EVENT_CACHE_SIZE = 1024
+
+# Field name -> short code used in msgpack frames
+FIELD_CODES = {
+    'type': 't',
+    'message': 'm',
+    'id': 'i',
+    'sender_id': 's',
+    'sender_username': 'su',
+    'sender_profile_picture_url': 'sp',
+    'content': 'c',
+    'timestamp': 'ts',
+    'image_url': 'im',
+    'video_url': 'vu',
+    'is_edited': 'e',
+    'is_unsent': 'x',
+    'edited_at': 'ea',
+    'client_id': 'ci',
+    'user_id': 'u',
+    'username': 'un',
+    'timeout': 'to',
+    'last_read_message_id': 'lr',
+    'message_id': 'mi',
+    'last_message_id': 'lm',
+    'since': 'si',
+    'synced_at': 'sa',
+    'code': 'co',
+    'retry_after': 'ra',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+_encoded_events = OrderedDict()  # (event id, binary) -> encoded frame
+_encoded_events_lock = threading.Lock()
+
+
+def _rename(value, names):
+    if isinstance(value, dict):
+        return {names.get(key, key): _rename(item, names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rename(item, names) for item in value]
+    return value
+
+
+def encode_frame(frame, binary):
+    """Encode a client frame as msgpack bytes if ``binary``, else as a JSON str"""
+    if binary:
+        return msgpack.packb(_rename(frame, FIELD_CODES))
+    return json.dumps(frame)
+
+
+def decode_frame(data):
+    """Decode a msgpack frame sent by a client into the JSON frame shape"""
+    return _rename(msgpack.unpackb(data), FIELD_NAMES)
+
+
+def client_frame(event):
+    """The frame a ChatConsumer group event is delivered to sockets as"""
+    event_type = event['type']
+    if event_type in ('chat_message', 'message_edited', 'message_unsent'):
+        return {'type': event_type, 'message': event['message']}
+    if event_type == 'read_receipt':
+        return {
+            'type': 'read_receipt',
+            'user_id': event['user_id'],
+            'last_read_message_id': event['last_read_message_id'],
+        }
+    if event_type == 'user_typing':
+        return {
+            'type': 'typing',
+            'user_id': event['user_id'],
+            'username': event['username'],
+            'timeout': event['timeout'],
+        }
+    if event_type == 'user_stop_typing':
+        return {'type': 'stop_typing', 'user_id': event['user_id']}
+    raise ValueError(f'No client frame for event type {event_type!r}')
+
+
+def prepare_event(event):
+    """Tag a group event with an id before sending it, so each process encodes its frame once"""
+    event['event_id'] = uuid.uuid4().hex
+    return event
+
+
+def event_frame(event, binary):
+    """
+    The client frame of a group event, encoded as for ``encode_frame``: once
+    per process and format, then reused for every other socket of the process
+    """
+    event_id = event.get('event_id')
+    if event_id is None:
+        return encode_frame(client_frame(event), binary)
+    key = (event_id, binary)
+    with _encoded_events_lock:
+        data = _encoded_events.get(key)
+    if data is None:
+        data = encode_frame(client_frame(event), binary)
+        with _encoded_events_lock:
+            _encoded_events[key] = data
+            if len(_encoded_events) > ENCODED_EVENT_CACHE_SIZE:
+                _encoded_events.popitem(last=False)
+    return data
+
+
+def batch_frames(frames, binary):
+    """
+    Join already encoded frames into one array frame (a JSON array of the
+    frames, or a msgpack array) without decoding them
+    """
+    if binary:
+        return msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames)
+    return '[' + ','.join(frames) + ']'
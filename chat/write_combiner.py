@@ -0,0 +1,116 @@
+"""
+Write combiner: text messages received by ChatConsumer are saved in batches.
+
+With CHAT_WRITE_BATCH_WINDOW (milliseconds) set, ``save_message`` holds each
+message for at most that long, collecting the messages of every socket served
+by the process, then inserts them with one ``bulk_create`` in a single
+transaction. A batch is written early once it reaches CHAT_WRITE_BATCH_SIZE
+messages, so a message waits for at most the window plus one batch write.
+
+Rows are written the way ``Message.save`` writes them: ``expires_at`` is set
+from the sender's profile, each conversation records its newest message, the
+recipients' unread counters go up and the room buffer gets the new rows once
+the transaction commits. Callers get
+the saved message back, with its id, before they broadcast it.
+"""
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from collections import Counter
+from datetime import timedelta
+import asyncio
+import weakref
+from . import room_buffer
+from .models import DEFAULT_MESSAGE_DELETION_HOURS, Conversation, Message, count_unread
+
+# One pending batch per event loop
+_batches = weakref.WeakKeyDictionary()
+
+
+def enabled():
+    return settings.CHAT_WRITE_BATCH_WINDOW > 0
+
+
+async def save_message(conversation_id, user, content):
+    """Queue a text message for the next batch and return it once it is saved"""
+    loop = asyncio.get_running_loop()
+    batch = _batches.get(loop)
+    if batch is None:
+        batch = _batches[loop] = {'messages': [], 'futures': [], 'flush': None}
+        batch['flush'] = loop.call_later(
+            settings.CHAT_WRITE_BATCH_WINDOW / 1000, _start_flush, loop
+        )
+
+    future = loop.create_future()
+    batch['messages'].append(Message(conversation_id=conversation_id, sender=user, content=content))
+    batch['futures'].append(future)
+    if len(batch['messages']) >= settings.CHAT_WRITE_BATCH_SIZE:
+        batch['flush'].cancel()
+        _start_flush(loop)
+    return await future
+
+
+def _start_flush(loop):
+    # The next message starts a new batch while this one is written
+    batch = _batches.pop(loop, None)
+    if batch is not None:
+        loop.create_task(_flush(batch))
+
+
+async def _flush(batch):
+    try:
+        await database_sync_to_async(write_messages)(batch['messages'])
+    except Exception as e:
+        for future in batch['futures']:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for future, message in zip(batch['futures'], batch['messages']):
+        if not future.done():
+            future.set_result(message)
+
+
+def write_messages(messages):
+    """Insert unsaved messages in one transaction, as ``Message.save`` would one by one"""
+    # Import here to avoid circular imports
+    from accounts.models import UserProfile
+
+    deletion_hours = dict(
+        UserProfile.objects.filter(
+            user_id__in={message.sender_id for message in messages}
+        ).values_list('user_id', 'message_deletion_hours')
+    )
+    now = timezone.now()
+    for message in messages:
+        if message.expires_at is None:
+            message.expires_at = now + timedelta(
+                hours=deletion_hours.get(message.sender_id, DEFAULT_MESSAGE_DELETION_HOURS)
+            )
+
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            Message.objects.bulk_create(messages)
+        else:
+            # Without ids from the insert, save one by one in the same transaction
+            for message in messages:
+                message.save_base()
+
+        newest = {}
+        for message in messages:
+            newest[message.conversation_id] = message
+        for conversation_id, message in newest.items():
+            Conversation.objects.filter(pk=conversation_id).record_message(message)
+        sent = Counter((message.conversation_id, message.sender_id) for message in messages)
+        for (conversation_id, sender_id), count in sent.items():
+            count_unread(conversation_id, sender_id, count)
+
+        if room_buffer.enabled():
+            rows = [(message.conversation_id, room_buffer.message_row(message)) for message in messages]
+            transaction.on_commit(lambda: _buffer_rows(rows))
+    return messages
+
+
+def _buffer_rows(rows):
+    for conversation_id, row in rows:
+        room_buffer.record_row(conversation_id, row, True)
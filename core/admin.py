@@ -1,3 +1,8 @@
 from django.contrib import admin
+from .models import OrphanedMedia
 
-# Register your models here.
+@admin.register(OrphanedMedia)
+class OrphanedMediaAdmin(admin.ModelAdmin):
+    list_display = ('name', 'attempts', 'created_at', 'updated_at')
+    search_fields = ('name', 'last_error')
+    readonly_fields = ('created_at', 'updated_at')
@@ -0,0 +1,475 @@
+"""
+Channel layer for single-host deployments without Redis.
+
+Every process using ``UnixSocketChannelLayer`` connects to one broker over a
+Unix socket (``path``). The broker keeps channel queues and groups in memory
+and hands messages straight to waiting receivers, so sending is one local
+round trip and a group_send one round trip whatever the group size. Nothing
+goes through the database.
+
+Semantics follow channels_redis: a channel holds at most ``capacity``
+messages (``channel_capacity`` overrides it per channel name pattern) and
+``send`` raises ChannelFull beyond that, while ``group_send`` skips full
+channels; messages expire after ``expiry`` seconds and group memberships
+after ``group_expiry`` seconds. These are enforced by the broker with the
+configuration of the process that started it (the same CHANNEL_LAYERS for
+every process).
+
+With ``embedded`` (the default) the first process that finds no broker
+starts one on a background thread, and another process takes over when it
+exits. Alternatively run a dedicated broker with
+``python manage.py run_channel_broker``. Like a restarted Redis, a new
+broker starts empty and queued messages are lost, but every layer records
+the group memberships it added and replays them (with their age) on each
+new connection, so consumers in the other processes stay in their groups.
+
+Only ``receive`` is retried when the connection is lost mid-request: a
+``send`` or ``group_send`` may already have been applied by the broker, so
+retrying it could deliver twice, and the ConnectionError is raised instead.
+"""
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from collections import deque
+import asyncio
+import fcntl
+import logging
+import msgpack
+import os
+import struct
+import threading
+import time
+import uuid
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Frames on the socket are a 4-byte length followed by a msgpack array
+FRAME_HEADER = struct.Struct('!I')
+
+# Attempts to reach the broker (starting one if embedded) before giving up
+CONNECT_ATTEMPTS = 20
+
+# Embedded brokers started by this process, by socket path
+_embedded = {}
+_embedded_lock = threading.Lock()
+
+
+def _pack(frame):
+    data = msgpack.packb(frame, use_bin_type=True)
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    data = await reader.readexactly(FRAME_HEADER.unpack(header)[0])
+    return msgpack.unpackb(data, raw=False)
+
+
+class ChannelBroker:
+    """
+    The broker process-side: channel queues, pending receives and groups of
+    every connected layer. All state is owned by the broker's event loop.
+    """
+
+    def __init__(self, path, get_capacity, expiry=60, group_expiry=86400):
+        self.path = path
+        self.get_capacity = get_capacity
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.channels = {}  # channel -> deque of (deadline, data)
+        self.waiters = {}  # channel -> deque of (peer, request_id)
+        self.groups = {}  # group -> {channel: joined_at}
+        self.peers = set()
+        self.loop = None
+        self.stopped = None
+
+    async def serve(self, ready=None):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        self.schedule_sweep()
+        if ready is not None:
+            ready.set()
+        async with server:
+            await self.stopped.wait()
+            handlers = [peer.handler for peer in self.peers]
+            for peer in list(self.peers):
+                peer.writer.close()
+            await asyncio.gather(*handlers, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def run(self, ready=None):
+        asyncio.run(self.serve(ready))
+
+    def stop(self):
+        """Stop serving and disconnect every layer (callable from any thread)"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def handle(self, reader, writer):
+        peer = _Peer(writer)
+        self.peers.add(peer)
+        try:
+            while True:
+                self.dispatch(peer, await _read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            peer.open = False
+            self.peers.discard(peer)
+            for request_id, channel in peer.receiving.items():
+                self.drop_waiter(channel, peer, request_id)
+            writer.close()
+
+    def dispatch(self, peer, request):
+        op, request_id, *args = request
+        if op == 'receive':
+            message = self.take(args[0])
+            if message is None:
+                self.waiters.setdefault(args[0], deque()).append((peer, request_id))
+                peer.receiving[request_id] = args[0]
+            else:
+                peer.reply(request_id, None, message)
+        elif op == 'cancel':
+            channel = peer.receiving.pop(request_id, None)
+            if channel is not None:
+                self.drop_waiter(channel, peer, request_id)
+        elif op == 'send':
+            try:
+                self.put(*args)
+            except ChannelFull:
+                peer.reply(request_id, 'full', None)
+            else:
+                peer.reply(request_id, None, None)
+        elif op == 'group_add':
+            # A replayed membership carries its age, so it expires when it would have
+            group, channel, *age = args
+            self.groups.setdefault(group, {})[channel] = time.monotonic() - (age[0] if age else 0)
+            peer.reply(request_id, None, None)
+        elif op == 'group_discard':
+            group, channel = args
+            members = self.groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del self.groups[group]
+            peer.reply(request_id, None, None)
+        elif op == 'group_send':
+            group, data = args
+            for channel in list(self.expire_group(group)):
+                try:
+                    self.put(channel, data)
+                except ChannelFull:
+                    pass
+            peer.reply(request_id, None, None)
+        elif op == 'flush':
+            self.channels.clear()
+            self.groups.clear()
+            peer.reply(request_id, None, None)
+        else:
+            peer.reply(request_id, 'error', f'Unknown operation {op!r}')
+
+    def put(self, channel, data):
+        # A waiting receiver gets the message directly
+        waiting = self.waiters.get(channel)
+        while waiting:
+            peer, request_id = waiting.popleft()
+            if not waiting:
+                del self.waiters[channel]
+            if peer.open:
+                del peer.receiving[request_id]
+                peer.reply(request_id, None, data)
+                return
+
+        queue = self.expire_channel(channel)
+        if queue is None:
+            queue = self.channels[channel] = deque()
+        if len(queue) >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.append((time.monotonic() + self.expiry, data))
+
+    def take(self, channel):
+        queue = self.expire_channel(channel)
+        if not queue:
+            return None
+        _, data = queue.popleft()
+        if not queue:
+            del self.channels[channel]
+        return data
+
+    def drop_waiter(self, channel, peer, request_id):
+        waiting = self.waiters.get(channel)
+        if waiting is not None:
+            try:
+                waiting.remove((peer, request_id))
+            except ValueError:
+                pass
+            if not waiting:
+                del self.waiters[channel]
+
+    def expire_channel(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            return None
+        now = time.monotonic()
+        while queue and queue[0][0] < now:
+            queue.popleft()
+        if not queue:
+            del self.channels[channel]
+            return None
+        return queue
+
+    def expire_group(self, group):
+        members = self.groups.get(group, {})
+        joined_after = time.monotonic() - self.group_expiry
+        for channel, joined_at in list(members.items()):
+            if joined_at < joined_after:
+                del members[channel]
+        if not members:
+            self.groups.pop(group, None)
+        return members
+
+    def schedule_sweep(self):
+        # Queues nobody receives from any more are only dropped here
+        def sweep():
+            for channel in list(self.channels):
+                self.expire_channel(channel)
+            for group in list(self.groups):
+                self.expire_group(group)
+            self.schedule_sweep()
+        asyncio.get_running_loop().call_later(min(self.expiry, 60), sweep)
+
+
+class _Peer:
+    def __init__(self, writer):
+        self.writer = writer
+        self.open = True
+        self.receiving = {}  # request_id -> channel of pending receives
+        self.handler = asyncio.current_task()
+
+    def reply(self, request_id, error, result):
+        if self.open:
+            self.writer.write(_pack([request_id, error, result]))
+
+
+def acquire_broker_lock(path):
+    """
+    Take the lock that makes this process the broker for ``path``. Returns the
+    lock file, to be kept open while the broker runs, or None if another
+    process holds it.
+    """
+    lock = open(f'{path}.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def start_embedded_broker(path, get_capacity, expiry, group_expiry):
+    """
+    Start a broker on a background thread unless another process holds the
+    broker lock for ``path``. Returns True if a broker now runs in this process.
+    """
+    with _embedded_lock:
+        if path in _embedded:
+            return True
+        lock = acquire_broker_lock(path)
+        if lock is None:
+            return False
+        broker = ChannelBroker(path, get_capacity, expiry=expiry, group_expiry=group_expiry)
+        ready = threading.Event()
+        thread = threading.Thread(target=broker.run, args=(ready,), name='channel-broker', daemon=True)
+        # The lock file stays open (and locked) until the broker is stopped
+        _embedded[path] = (broker, lock, thread)
+        thread.start()
+        ready.wait(5)
+        logger.info(f"Started embedded channel broker on {path}")
+        return True
+
+
+def stop_embedded_brokers():
+    """Stop the brokers started by this process and release their locks"""
+    with _embedded_lock:
+        brokers = list(_embedded.values())
+        _embedded.clear()
+    for broker, lock, thread in brokers:
+        broker.stop()
+        thread.join(5)
+        lock.close()
+
+
+class _Connection:
+    """One event loop's connection to the broker, multiplexing requests by id"""
+
+    def __init__(self, reader, writer):
+        self.writer = writer
+        self.pending = {}
+        self.next_id = 0
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self.read(reader))
+
+    async def read(self, reader):
+        try:
+            while True:
+                request_id, error, result = await _read_frame(reader)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((error, result))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Channel broker connection lost'))
+            self.pending.clear()
+            self.writer.close()
+
+    async def request(self, op, *args):
+        if self.closed:
+            raise ConnectionError('Channel broker connection lost')
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(_pack([op, request_id, *args]))
+        try:
+            await self.writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            # Withdraw a pending receive so the broker does not hand it a message
+            self.pending.pop(request_id, None)
+            if op == 'receive' and not self.closed:
+                self.writer.write(_pack(['cancel', request_id]))
+            raise
+
+    def close(self):
+        self.closed = True
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        path=None,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        embedded=True,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path or os.path.join('/tmp', 'kothakow-channels.sock')
+        self.group_expiry = group_expiry
+        self.embedded = embedded
+        self.client_prefix = uuid.uuid4().hex
+        # One connection per event loop, like channels_redis' connection pools
+        self.connections = weakref.WeakKeyDictionary()
+        # Group memberships added through this layer, replayed to every new
+        # connection in case it reaches a new (empty) broker
+        self.groups = {}  # (group, channel) -> joined_at
+
+    def start_broker(self):
+        return start_embedded_broker(self.path, self.get_capacity, self.expiry, self.group_expiry)
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is not None and not connection.closed:
+            return connection
+
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.embedded and await loop.run_in_executor(None, self.start_broker):
+                    continue
+                await asyncio.sleep(0.05 * (attempt + 1))
+            else:
+                connection = self.connections[loop] = _Connection(reader, writer)
+                await self.replay_groups(connection)
+                return connection
+        raise ConnectionError(f'No channel broker at {self.path}')
+
+    async def replay_groups(self, connection):
+        now = time.monotonic()
+        for key, joined_at in list(self.groups.items()):
+            if joined_at < now - self.group_expiry:
+                self.groups.pop(key, None)
+        await asyncio.gather(*[
+            connection.request('group_add', group, channel, now - joined_at)
+            for (group, channel), joined_at in list(self.groups.items())
+        ])
+
+    async def call(self, op, *args):
+        # A receive cut off by a lost connection (the broker went away) is
+        # retried once through a new connection, which starts a broker here if
+        # none is left. Other operations may have been applied before the
+        # connection was lost, so they are not repeated.
+        for attempt in range(2):
+            connection = await self.connection()
+            try:
+                error, result = await connection.request(op, *args)
+            except ConnectionError:
+                if attempt or op != 'receive':
+                    raise
+                continue
+            if error == 'full':
+                raise ChannelFull(args[0])
+            if error:
+                raise RuntimeError(result)
+            return result
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        assert '__asgi_channel__' not in message
+        await self.call('send', channel, msgpack.packb(message, use_bin_type=True))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        data = await self.call('receive', channel)
+        return msgpack.unpackb(data, raw=False)
+
+    async def new_channel(self, prefix='specific'):
+        return f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex}'
+
+    async def flush(self):
+        self.groups.clear()
+        await self.call('flush')
+
+    async def close(self):
+        connection = self.connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            connection.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self.call('group_add', group, channel)
+        self.groups[(group, channel)] = time.monotonic()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self.groups.pop((group, channel), None)
+        await self.call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        await self.call('group_send', group, msgpack.packb(message, use_bin_type=True))
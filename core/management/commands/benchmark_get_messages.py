@@ -0,0 +1,118 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from chat.models import Conversation, Message
+from chat.services import get_message_page, get_message_page_values, iter_message_page_json
+from chat.views import get_messages
+import statistics
+import time
+
+
+class BenchmarkRollback(Exception):
+    """Raised to roll back the benchmark data"""
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the get_messages poll endpoint at different conversation sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[50, 500, 5000],
+            help='Messages per conversation to benchmark (default: 50 500 5000)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=50,
+            help='Requests per measurement (default: 50)',
+        )
+
+    def handle(self, *args, **options):
+        # Everything runs in a transaction that is rolled back at the end,
+        # so the benchmark leaves no users or messages behind.
+        try:
+            with transaction.atomic():
+                self.run(options['sizes'], options['repeat'])
+                raise BenchmarkRollback
+        except BenchmarkRollback:
+            pass
+
+    def run(self, sizes, repeat):
+        user = User.objects.create_user(username='benchmark_reader')
+        sender = User.objects.create_user(username='benchmark_sender')
+        factory = RequestFactory()
+
+        self.stdout.write(
+            f'{"messages":>9} {"page":>7} {"endpoint ms":>12} {"queries":>8} '
+            f'{"model path ms":>14} {"values path ms":>15}'
+        )
+        for size in sizes:
+            conversation = Conversation.objects.create()
+            conversation.participants.add(user, sender)
+            Message.objects.bulk_create(
+                [
+                    Message(conversation=conversation, sender=sender, content=f'benchmark message {i}')
+                    for i in range(size)
+                ],
+                batch_size=1000,
+            )
+            # The latest page and, where there is one, a page near the start of the history
+            pages = [('latest', {})]
+            if size > 60:
+                deep_id = conversation.messages.order_by('timestamp', 'id').values_list('id', flat=True)[60]
+                pages.append(('deep', {'before': deep_id}))
+
+            for page, params in pages:
+                request = factory.get(reverse('chat:get_messages', args=[conversation.id]), params)
+                request.user = user
+
+                def call_endpoint():
+                    response = get_messages(request, conversation.id)
+                    b''.join(response.streaming_content)
+
+                with CaptureQueriesContext(connection) as queries:
+                    call_endpoint()
+
+                before = params.get('before')
+                endpoint_ms = self.measure(call_endpoint, repeat)
+                model_ms = self.measure(
+                    lambda: self.serialize_models(conversation, user, before), repeat
+                )
+                values_ms = self.measure(
+                    lambda: ''.join(iter_message_page_json(
+                        *get_message_page_values(conversation, user, before=before)
+                    )),
+                    repeat
+                )
+                self.stdout.write(
+                    f'{size:>9} {page:>7} {endpoint_ms:>12.2f} {len(queries):>8} '
+                    f'{model_ms:>14.2f} {values_ms:>15.2f}'
+                )
+
+    def serialize_models(self, conversation, user, before):
+        """The model-instance path the endpoint used before the values pipeline"""
+        messages, has_more = get_message_page(conversation, user, before=before)
+        return [
+            {
+                'id': message.id,
+                'content': message.content,
+                'sender_username': message.sender.username,
+                'sender_profile_picture': message.sender.userprofile.get_profile_picture_url(),
+                'timestamp': message.timestamp.isoformat(),
+            }
+            for message in messages
+        ]
+
+    def measure(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
@@ -0,0 +1,122 @@
+from copy import deepcopy
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from accounts import counters
+from accounts.models import FriendRequest
+from chat.models import Conversation, Message
+from kothakow.context_processors import navbar_counts
+
+# Views whose GET changes the session of the signed-in client
+SKIPPED_URL_NAMES = {'logout'}
+
+
+class BenchmarkRollback(Exception):
+    """Raised to roll back the benchmark data"""
+
+
+def eager_navbar_counts(request):
+    """navbar_counts as it was before it was lazy: looked up on every render"""
+    context = navbar_counts(request)
+    for value in context.values():
+        str(value)
+    return context
+
+
+class Command(BaseCommand):
+    help = (
+        'Count the queries of a GET to every view, anonymous and signed in, with the navbar '
+        'counts looked up eagerly and lazily (counter cache cold on each request)'
+    )
+
+    def handle(self, *args, **options):
+        # Everything runs in a transaction that is rolled back at the end,
+        # so the benchmark leaves no users or messages behind.
+        try:
+            with transaction.atomic():
+                self.run()
+                raise BenchmarkRollback
+        except BenchmarkRollback:
+            pass
+
+    def run(self):
+        user = User.objects.create_user(username='benchmark_viewer')
+        friend = User.objects.create_user(username='benchmark_friend')
+        stranger = User.objects.create_user(username='benchmark_stranger')
+        FriendRequest.objects.create(from_user=user, to_user=friend, status='accepted')
+        FriendRequest.objects.create(from_user=stranger, to_user=user)
+        conversation = Conversation.objects.create()
+        conversation.participants.add(user, friend)
+        for i in range(20):
+            Message.objects.create(conversation=conversation, sender=friend, content=f'benchmark message {i}')
+        # The counters row exists, as it does once a user has loaded a page
+        counters.get_counts(user.id)
+
+        url_kwargs = {
+            'conversation_id': conversation.id,
+            'user_id': friend.id,
+            'uidb64': urlsafe_base64_encode(force_bytes(user.pk)),
+            'token': default_token_generator.make_token(user),
+        }
+        # Failing views are reported with their status rather than stopping the run
+        anonymous = Client(raise_request_exception=False)
+        signed_in = Client(raise_request_exception=False)
+        signed_in.force_login(user)
+
+        eager_templates = deepcopy(settings.TEMPLATES)
+        for engine in eager_templates:
+            processors = engine.get('OPTIONS', {}).get('context_processors', [])
+            engine['OPTIONS']['context_processors'] = [
+                f'{__name__}.eager_navbar_counts' if path == 'kothakow.context_processors.navbar_counts' else path
+                for path in processors
+            ]
+
+        self.stdout.write(f'{"url":<45} {"client":>10} {"status":>7} {"eager":>6} {"lazy":>6}')
+        totals = {'eager': 0, 'lazy': 0}
+        for url in self.urls(url_kwargs):
+            for name, client in (('anonymous', anonymous), ('signed in', signed_in)):
+                # Views like conversation_detail write on the first visit only (marking messages read)
+                self.count_queries(client, url)
+                cache.delete(counters.counters_cache_key(user.id))
+                with override_settings(TEMPLATES=eager_templates):
+                    status, eager = self.count_queries(client, url)
+                cache.delete(counters.counters_cache_key(user.id))
+                status, lazy = self.count_queries(client, url)
+                totals['eager'] += eager
+                totals['lazy'] += lazy
+                self.stdout.write(f'{url:<45} {name:>10} {status:>7} {eager:>6} {lazy:>6}')
+        self.stdout.write(f'{"total":<45} {"":>10} {"":>7} {totals["eager"]:>6} {totals["lazy"]:>6}')
+
+    def urls(self, url_kwargs):
+        """Every named view outside the admin, with its URL arguments filled in"""
+        urls = []
+
+        def walk(patterns, namespace):
+            for pattern in patterns:
+                if isinstance(pattern, URLResolver):
+                    if pattern.namespace != 'admin':
+                        walk(pattern.url_patterns, pattern.namespace or namespace)
+                elif isinstance(pattern, URLPattern) and pattern.name and pattern.name not in SKIPPED_URL_NAMES:
+                    name = f'{namespace}:{pattern.name}' if namespace else pattern.name
+                    kwargs = {key: url_kwargs[key] for key in pattern.pattern.converters}
+                    url = reverse(name, kwargs=kwargs)
+                    if url not in urls:
+                        urls.append(url)
+
+        walk(get_resolver().url_patterns, None)
+        return urls
+
+    def count_queries(self, client, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, HTTP_HOST='localhost')
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return response.status_code, len(queries)
@@ -0,0 +1,118 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.test import override_settings
+from accounts import presence
+from chat.models import Conversation
+from chat.routing import websocket_urlpatterns
+import asyncio
+import time
+
+
+class Command(BaseCommand):
+    help = 'Load-test ChatConsumer with simulated typists and count channel layer traffic'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clients',
+            type=int,
+            default=10,
+            help='Sockets connected to the conversation (default: 10)',
+        )
+        parser.add_argument(
+            '--frames',
+            type=int,
+            default=100,
+            help='Typing frames sent by each socket (default: 100)',
+        )
+        parser.add_argument(
+            '--delay',
+            type=float,
+            default=20,
+            help='Milliseconds between the typing frames of a socket (default: 20)',
+        )
+
+    def handle(self, *args, **options):
+        # The consumers run against an in-memory channel layer so only the
+        # consumer's own traffic is measured
+        with override_settings(
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+            PRESENCE_DEBOUNCE_SECONDS=0,
+            # Measure the typing debounce alone, not the typing rate limit
+            CHAT_RATE_LIMITS={},
+        ):
+            users = [
+                User.objects.create_user(username=f'benchmark_typist_{i}')
+                for i in range(options['clients'])
+            ]
+            conversation = Conversation.objects.create()
+            conversation.participants.add(*users)
+            try:
+                self.stdout.write(
+                    f'{"mode":>14} {"frames in":>10} {"group_sends":>12} {"frames out":>11} {"seconds":>8}'
+                )
+                modes = [
+                    ('every frame', 0),
+                    ('throttled', settings.TYPING_BROADCAST_INTERVAL),
+                ]
+                for mode, interval in modes:
+                    with override_settings(TYPING_BROADCAST_INTERVAL=interval):
+                        frames_in, group_sends, frames_out, seconds = async_to_sync(self.run)(
+                            conversation, users, options['frames'], options['delay'] / 1000
+                        )
+                    self.stdout.write(
+                        f'{mode:>14} {frames_in:>10} {group_sends:>12} {frames_out:>11} {seconds:>8.2f}'
+                    )
+            finally:
+                presence.flush()
+                conversation.delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    async def run(self, conversation, users, frames, delay):
+        channel_layer = get_channel_layer()
+        group_sends = 0
+        group_send = channel_layer.group_send
+
+        async def counting_group_send(group, message):
+            nonlocal group_sends
+            group_sends += 1
+            await group_send(group, message)
+
+        channel_layer.group_send = counting_group_send
+
+        communicators = []
+        for user in users:
+            communicator = WebsocketCommunicator(
+                URLRouter(websocket_urlpatterns), f'/ws/chat/{conversation.id}/'
+            )
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'{user.username} could not connect')
+            communicators.append(communicator)
+
+        start = time.perf_counter()
+        group_sends = 0
+        for _ in range(frames):
+            for communicator in communicators:
+                await communicator.send_json_to({'type': 'typing'})
+            await asyncio.sleep(delay)
+        for communicator in communicators:
+            await communicator.send_json_to({'type': 'stop_typing'})
+
+        frames_out = 0
+        for communicator in communicators:
+            while not await communicator.receive_nothing(timeout=0.05):
+                await communicator.receive_from()
+                frames_out += 1
+        seconds = time.perf_counter() - start
+        sends = group_sends
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        await presence.wait_for_announcements()
+        return frames * len(communicators), sends, frames_out, seconds
@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand
+from chat.wire import client_frame, encode_frame, event_frame, prepare_event
+import json
+import msgpack
+import statistics
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare bytes on the wire, bytes through the channel layer and CPU per delivered '
+        'message of the JSON and msgpack chat frames'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--recipients',
+            type=int,
+            nargs='+',
+            default=[2, 10, 100],
+            help='Sockets in the room (default: 2 10 100)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=2000,
+            help='Group events per measurement (default: 2000)',
+        )
+
+    def handle(self, *args, **options):
+        event = {
+            'type': 'chat_message',
+            'message': {
+                'id': 123456,
+                'sender_id': 42,
+                'sender_username': 'benchmark_sender',
+                'sender_profile_picture_url': '/media/profile_pics/benchmark_sender.jpg',
+                'content': 'How about lunch at the usual place tomorrow?',
+                'timestamp': '2025-01-01T12:00:00.000000+00:00',
+                'image_url': None,
+                'video_url': None,
+                'is_edited': False,
+                'is_unsent': False,
+                'edited_at': None,
+            },
+        }
+        frame = client_frame(event)
+        text, binary = encode_frame(frame, False), encode_frame(frame, True)
+        self.stdout.write(f'bytes per frame: json {len(text.encode())}, msgpack {len(binary)}')
+        # What a group_send hands the channel layer (serialized with msgpack by every backend)
+        with_frames = dict(event, frames={'text': text, 'bytes': binary})
+        self.stdout.write(
+            f'bytes per group_send: with both encodings {len(msgpack.packb(with_frames))}, '
+            f'fields only {len(msgpack.packb(prepare_event(dict(event))))}'
+        )
+
+        self.stdout.write(
+            f'{"recipients":>10} {"json per socket us":>19} {"json once us":>13} {"msgpack once us":>16}'
+        )
+        for recipients in options['recipients']:
+            # Before: every consumer serialized the event for its own socket
+            per_socket = self.measure(
+                lambda: [json.dumps(client_frame(event)) for _ in range(recipients)],
+                options['repeat'], recipients
+            )
+            # Now: the first consumer of the process encodes, the others reuse its frame
+            json_once = self.measure(
+                lambda: [event_frame(prepared, False) for prepared in [prepare_event(dict(event))] * recipients],
+                options['repeat'], recipients
+            )
+            msgpack_once = self.measure(
+                lambda: [event_frame(prepared, True) for prepared in [prepare_event(dict(event))] * recipients],
+                options['repeat'], recipients
+            )
+            self.stdout.write(
+                f'{recipients:>10} {per_socket:>19.2f} {json_once:>13.2f} {msgpack_once:>16.2f}'
+            )
+        self.stdout.write('(CPU in microseconds per delivered message)')
+
+    def measure(self, func, repeat, recipients):
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func()
+            timings.append((time.perf_counter() - start) / (repeat * recipients) * 1e6)
+        return statistics.median(timings)
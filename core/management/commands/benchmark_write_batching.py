@@ -0,0 +1,113 @@
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from chat import write_combiner
+from chat.models import Conversation, Message
+import asyncio
+import statistics
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare transactions and save latency of per-message and batched chat message writes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rate',
+            type=int,
+            default=5000,
+            help='Messages per second offered (default: 5000)',
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=5000,
+            help='Messages per measurement (default: 5000)',
+        )
+        parser.add_argument(
+            '--rooms',
+            type=int,
+            default=50,
+            help='Conversations the messages are spread over (default: 50)',
+        )
+        parser.add_argument(
+            '--window',
+            type=int,
+            nargs='+',
+            default=[5, 20],
+            help='Batch windows to measure, in milliseconds (default: 5 20)',
+        )
+
+    def handle(self, *args, **options):
+        users = [
+            User.objects.create_user(username=f'benchmark_writer_{i}')
+            for i in range(options['rooms'] * 2)
+        ]
+        conversations = []
+        for i in range(options['rooms']):
+            conversation = Conversation.objects.create()
+            conversation.participants.add(users[2 * i], users[2 * i + 1])
+            conversations.append(conversation)
+        # Every message goes out from one of the two participants of its room
+        senders = [(conversation.id, users[2 * i + j]) for i, conversation in enumerate(conversations) for j in (0, 1)]
+
+        # Transactions are counted at the connection every write goes through
+        commits = 0
+        commit = connection.commit
+
+        def counting_commit():
+            nonlocal commits
+            commits += 1
+            commit()
+
+        connection.commit = counting_commit
+        try:
+            self.stdout.write(
+                f'{"mode":>14} {"transactions":>13} {"msgs/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}'
+            )
+            modes = [('per message', 0)] + [(f'batched {window}ms', window) for window in options['window']]
+            for mode, window in modes:
+                with override_settings(CHAT_WRITE_BATCH_WINDOW=window):
+                    commits = 0
+                    latencies, seconds = async_to_sync(self.run)(senders, options['messages'], options['rate'])
+                    transactions = commits
+                latencies.sort()
+                self.stdout.write(
+                    f'{mode:>14} {transactions:>13} {len(latencies) / seconds:>8.0f} '
+                    f'{statistics.median(latencies):>8.1f} '
+                    f'{latencies[int(len(latencies) * 0.99) - 1]:>8.1f} {latencies[-1]:>8.1f}'
+                )
+        finally:
+            connection.commit = commit
+            Message.objects.filter(conversation__in=conversations).delete()
+            Conversation.objects.filter(id__in=[conversation.id for conversation in conversations]).delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+    async def run(self, senders, messages, rate):
+        # The consumer's save when batching is off
+        save_one = database_sync_to_async(
+            lambda conversation_id, user, content: Message.objects.create(
+                conversation_id=conversation_id, sender=user, content=content
+            )
+        )
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        latencies = []
+
+        async def send(i):
+            # Messages arrive at a steady rate; latency counts from arrival
+            arrival = start + i / rate
+            await asyncio.sleep(max(0, arrival - loop.time()))
+            conversation_id, user = senders[i % len(senders)]
+            if write_combiner.enabled():
+                await write_combiner.save_message(conversation_id, user, f'message {i}')
+            else:
+                await save_one(conversation_id, user, f'message {i}')
+            latencies.append((loop.time() - arrival) * 1000)
+
+        began = time.perf_counter()
+        await asyncio.gather(*[send(i) for i in range(messages)])
+        return latencies, time.perf_counter() - began
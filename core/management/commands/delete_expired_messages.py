@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from chat.models import Message
+from core.tasks import EXPIRED_MESSAGE_BATCH_SIZE
 from datetime import timedelta
 import logging
 
@@ -28,15 +29,8 @@ class Command(BaseCommand):
         
         self.stdout.write(f'{"[DRY RUN] " if dry_run else ""}Deleting messages older than {hours} hours...')
         
-        # Get all messages that should be deleted
-        messages_to_delete = []
-        
-        # Get messages with their sender profiles to check deletion settings
-        messages = Message.objects.select_related('sender__userprofile').all()
-        
-        for message in messages:
-            if message.should_be_deleted():
-                messages_to_delete.append(message)
+        # Get all messages whose deletion time has passed
+        messages_to_delete = list(Message.objects.expired().select_related('sender'))
         
         self.stdout.write(f'Found {len(messages_to_delete)} messages to delete')
         
@@ -74,15 +68,15 @@ class Command(BaseCommand):
         deleted_count = 0
         error_count = 0
         
-        for message in messages_to_delete:
+        message_ids = [message.id for message in messages_to_delete]
+        for start in range(0, len(message_ids), EXPIRED_MESSAGE_BATCH_SIZE):
+            batch_ids = message_ids[start:start + EXPIRED_MESSAGE_BATCH_SIZE]
             try:
-                self.stdout.write(f'Deleting message {message.id}...')
-                message.delete_with_media()
-                deleted_count += 1
-                self.stdout.write(self.style.SUCCESS(f'Successfully deleted message {message.id}'))
+                self.stdout.write(f'Deleting {len(batch_ids)} messages...')
+                deleted_count += Message.objects.filter(id__in=batch_ids).delete_with_media()
             except Exception as e:
                 error_count += 1
-                self.stdout.write(self.style.ERROR(f'Error deleting message {message.id}: {str(e)}'))
+                self.stdout.write(self.style.ERROR(f'Error deleting {len(batch_ids)} messages: {str(e)}'))
         
         self.stdout.write(f'\nDeletion completed: {deleted_count} messages deleted, {error_count} errors')
         
@@ -0,0 +1,27 @@
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from core.channel_layer import ChannelBroker, UnixSocketChannelLayer, acquire_broker_lock
+
+
+class Command(BaseCommand):
+    help = 'Run the broker of the Unix socket channel layer in the foreground'
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        if not isinstance(layer, UnixSocketChannelLayer):
+            raise CommandError('The default channel layer is not UnixSocketChannelLayer')
+
+        lock = acquire_broker_lock(layer.path)
+        if lock is None:
+            raise CommandError(f'A channel broker is already running on {layer.path}')
+
+        self.stdout.write(f'Channel broker listening on {layer.path}')
+        broker = ChannelBroker(
+            layer.path, layer.get_capacity, expiry=layer.expiry, group_expiry=layer.group_expiry
+        )
+        try:
+            broker.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            lock.close()
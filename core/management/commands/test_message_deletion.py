@@ -4,6 +4,7 @@ from django.utils import timezone
 from datetime import timedelta
 from chat.models import Conversation, Message
 from accounts.models import UserProfile
+from core import media_reaper
 import os
 
 class Command(BaseCommand):
@@ -159,7 +160,8 @@ class Command(BaseCommand):
         for message in remaining_messages:
             self.stdout.write(f'Message {message.id}: {message.content[:50]}... ({message.timestamp})')
         
-        # Check if media files were deleted
+        # Check if media files were deleted (the media reaper deletes them in the background)
+        media_reaper.drain()
         self.stdout.write('\n--- Media file verification ---')
         if os.path.exists(image_path):
             self.stdout.write(self.style.WARNING(f'Image file still exists: {image_path}'))
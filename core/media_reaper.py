@@ -0,0 +1,130 @@
+"""
+Media reaper: deletes chat media files from storage in a thread pool.
+
+Message rows are deleted in bulk first and only their storage keys are handed
+over here, once the transaction deleting the rows commits, so deleting many messages is bounded by storage I/O parallelism
+instead of per-row ORM work. Failed deletions are retried with backoff and
+then recorded in the OrphanedMedia ledger for reap_orphaned_media to retry.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'MEDIA_REAPER_WORKERS', 8),
+                thread_name_prefix='media-reaper'
+            )
+        return _executor
+
+
+def delete_file(name):
+    """Delete one storage key, retrying failures. Returns the last error, or None on success."""
+    retries = getattr(settings, 'MEDIA_REAPER_RETRIES', 3)
+    delay = getattr(settings, 'MEDIA_REAPER_RETRY_DELAY', 0.5)
+    error = None
+    for attempt in range(retries):
+        try:
+            default_storage.delete(name)
+            return None
+        except Exception as e:
+            error = e
+            if attempt < retries - 1:
+                time.sleep(delay * 2 ** attempt)
+    return error
+
+
+def record_orphans(failures):
+    """Add failed deletions (name -> error) to the orphan ledger"""
+    from .models import OrphanedMedia
+
+    for name, error in failures.items():
+        logger.error(f"Could not delete media file {name}: {error}")
+        updated = OrphanedMedia.objects.filter(name=name).update(
+            attempts=F('attempts') + 1,
+            last_error=str(error),
+            updated_at=timezone.now()
+        )
+        if not updated:
+            OrphanedMedia.objects.bulk_create(
+                [OrphanedMedia(name=name, last_error=str(error))],
+                ignore_conflicts=True
+            )
+
+
+def _reap_in_background(name):
+    error = delete_file(name)
+    if error is None:
+        return True
+    try:
+        record_orphans({name: error})
+    finally:
+        # Worker threads outlive requests, so don't keep their connection open
+        connection.close()
+    return False
+
+
+def enqueue(names):
+    """
+    Schedule deletion of storage keys without waiting for it, once the
+    surrounding transaction commits (right away outside one): if it rolls
+    back, the restored rows keep their files. Failures are recorded in the
+    orphan ledger by the worker.
+    """
+    names = [name for name in names if name]
+    if names:
+        transaction.on_commit(lambda: _submit(names))
+
+
+def _submit(names):
+    executor = _get_executor()
+    futures = [executor.submit(_reap_in_background, name) for name in names]
+    with _pending_lock:
+        _pending.update(futures)
+    for future in futures:
+        future.add_done_callback(_discard_pending)
+    return futures
+
+
+def _discard_pending(future):
+    with _pending_lock:
+        _pending.discard(future)
+
+
+def drain(timeout=None):
+    """Wait for every enqueued deletion to finish"""
+    with _pending_lock:
+        futures = list(_pending)
+    wait(futures, timeout=timeout)
+
+
+def reap(names):
+    """
+    Delete storage keys concurrently and wait for the result. Failures are
+    recorded in the orphan ledger from the calling thread.
+    Returns ``(deleted_count, failed_names)``.
+    """
+    names = [name for name in names if name]
+    executor = _get_executor()
+    errors = dict(zip(names, executor.map(delete_file, names)))
+    failures = {name: error for name, error in errors.items() if error is not None}
+    if failures:
+        record_orphans(failures)
+    return len(names) - len(failures), list(failures)
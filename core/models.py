@@ -1,3 +1,16 @@
 from django.db import models
 
-# Create your models here.
+
+class OrphanedMedia(models.Model):
+    """Media file the reaper failed to delete from storage; retried by reap_orphaned_media"""
+    name = models.CharField(max_length=255, unique=True)
+    attempts = models.PositiveIntegerField(default=1)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name_plural = 'orphaned media'
+    
+    def __str__(self):
+        return f"{self.name} ({self.attempts} failed attempts)"
@@ -0,0 +1,155 @@
+"""
+Redis channel layer sharded over several Redis servers with a hash ring.
+
+channels_redis already spreads groups over its ``hosts``, but by cutting the
+hash space into equal ranges, so adding a server moves about half of all
+groups to another one. ``ShardedRedisChannelLayer`` places each host on a
+hash ring at VIRTUAL_NODES points instead: adding or removing a server only
+moves the groups it takes over or gave up (about 1/N of them), and a group's
+server does not depend on the order of the hosts or on credentials in their
+URLs. Normal channels are placed on the ring like groups (channels_redis sends
+them to each host in turn). Keys are the same as channels_redis', derived
+from the group or channel name only.
+
+Process-specific channels, which carry most of the traffic, are not placed
+by the ring: each process picks its server once, from its own ring, and
+names it in its client prefix (``<uuid>.s<tag>``). Senders deliver to the
+server named by the tag whatever their own host list is, so a process keeps
+receiving its messages while the ring changes around it. Channels without a
+tag (from layers that do not add one) are placed on the ring, the previous
+one while it is set, since that is where their process listens.
+
+While the ring changes, group members joined through the old ring are still
+on the old server. List the old hosts as ``previous_hosts`` during the
+rollout: groups whose server changed then also get members from their old
+server, discards reach both, and untagged process channels are sent to
+their old server. Drop ``previous_hosts`` once every process runs the new
+ring and its sockets have reconnected (or after group_expiry).
+
+Configured from REDIS_CHANNEL_URLS and REDIS_CHANNEL_PREVIOUS_URLS in
+settings.
+"""
+from bisect import bisect
+from channels_redis.core import RedisChannelLayer
+from channels_redis.utils import decode_hosts
+from urllib.parse import urlsplit
+import hashlib
+import itertools
+import re
+
+# Points per host on the ring; more points spread groups more evenly
+VIRTUAL_NODES = 160
+
+# Most group and channel names whose host is remembered
+INDEX_CACHE_SIZE = 100000
+
+# Server tag at the end of a client prefix: "<prefix>.<uuid>.s<tag>!"
+SERVER_TAG = re.compile(r'\.s([0-9a-f]{8})!')
+
+
+def _hash(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+def server_tag(name):
+    """Tag naming a ring node in process channel names"""
+    return f'{_hash(name):016x}'[:8]
+
+
+def node_name(host):
+    """Ring name of a host (as returned by decode_hosts): its address without credentials"""
+    if 'address' in host:
+        parts = urlsplit(host['address'])
+        return f'{parts.hostname}:{parts.port or 6379}{parts.path or "/0"}'
+    return f'{host.get("host", "localhost")}:{host.get("port", 6379)}/{host.get("db", 0)}'
+
+
+class HashRing:
+    """Consistent hash ring over named nodes"""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        points = sorted(
+            (_hash(f'{node}#{i}'), node) for node in set(nodes) for i in range(virtual_nodes)
+        )
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def get(self, value):
+        """The node ``value`` belongs to"""
+        return self.nodes[bisect(self.points, _hash(value)) % len(self.points)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, previous_hosts=None, virtual_nodes=VIRTUAL_NODES, **kwargs):
+        hosts = decode_hosts(hosts)
+        names = [node_name(host) for host in hosts]
+        # Hosts only in the previous ring get connections too, after the current ones
+        previous = decode_hosts(previous_hosts) if previous_hosts else []
+        removed = [host for host in previous if node_name(host) not in names]
+        super().__init__(hosts=hosts + removed, **kwargs)
+
+        self.ring = HashRing(names, virtual_nodes)
+        self.previous_ring = HashRing([node_name(host) for host in previous], virtual_nodes) if previous else None
+        self.host_index = {node_name(host): index for index, host in enumerate(self.hosts)}
+        self.tag_index = {server_tag(name): index for name, index in self.host_index.items()}
+        self.index_cache = {}
+        # This process receives on one server of the current ring, named in its channels
+        self.client_prefix = f'{self.client_prefix}.s{server_tag(self.ring.get(self.client_prefix))}'
+
+    def consistent_hash(self, value):
+        if '!' in value:
+            # Process channel: strip the per-socket part so all of a process' channels share a server
+            value = value[:value.index('!') + 1]
+        index = self.index_cache.get(value)
+        if index is None:
+            if len(self.index_cache) >= INDEX_CACHE_SIZE:
+                self.index_cache.clear()
+            index = self.index_cache[value] = self._server_index(value)
+        return index
+
+    def _server_index(self, value):
+        if value.endswith('!'):
+            match = SERVER_TAG.search(value)
+            if match and match.group(1) in self.tag_index:
+                return self.tag_index[match.group(1)]
+            if self.previous_ring is not None:
+                return self.host_index[self.previous_ring.get(value)]
+        return self.host_index[self.ring.get(value)]
+
+    async def send(self, channel, message):
+        # Normal channels are placed on the ring too (channels_redis cycles
+        # through the hosts), so their capacity and order hold. The index is
+        # taken from the generator before send's first await.
+        self._send_index_generator = itertools.repeat(self.consistent_hash(channel))
+        await super().send(channel, message)
+
+    async def receive_single(self, channel):
+        self._receive_index_generator = itertools.repeat(self.consistent_hash(channel))
+        return await super().receive_single(channel)
+
+    def previous_index(self, group):
+        """Index of the group's server in the previous ring, if it moved"""
+        if self.previous_ring is None:
+            return None
+        index = self.host_index[self.previous_ring.get(group)]
+        return None if index == self.consistent_hash(group) else index
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        previous = self.previous_index(group)
+        if previous is not None:
+            await self.connection(previous).zrem(self._group_key(group), channel)
+
+    async def group_send(self, group, message):
+        previous = self.previous_index(group)
+        if previous is not None:
+            # Copy members that joined through the previous ring, keeping newer joins
+            key = self._group_key(group)
+            members = await self.connection(previous).zrange(key, 0, -1, withscores=True)
+            if members:
+                connection = self.connection(self.consistent_hash(group))
+                await connection.zadd(key, dict(members), nx=True)
+                await connection.expire(key, self.group_expiry)
+        await super().group_send(group, message)
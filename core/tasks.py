@@ -1,48 +1,68 @@
 from celery import shared_task
+from django.db.models import F
 from django.utils import timezone
 from chat.models import Message
+from core import media_reaper
 from datetime import timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Messages deleted per DELETE statement by delete_expired_messages
+EXPIRED_MESSAGE_BATCH_SIZE = 1000
+
 @shared_task
-def delete_expired_messages():
+def delete_expired_messages(batch_size=EXPIRED_MESSAGE_BATCH_SIZE):
     """
     Delete messages that have exceeded their deletion time based on user settings
+    
+    Expired messages are found through the indexed expires_at column and
+    deleted in fixed-size batches, so the cost follows the number of expired
+    messages rather than the size of the message table.
     """
     logger.info("Starting expired message deletion task")
     deleted_count = 0
     error_count = 0
-    
-    # Get all messages that should be deleted
-    messages_to_delete = []
-    
-    # More efficient query to get messages that should be deleted
     current_time = timezone.now()
     
-    # Get messages with their sender profiles to check deletion settings
-    messages = Message.objects.select_related('sender__userprofile').all()
-    
-    for message in messages:
-        if message.should_be_deleted():
-            messages_to_delete.append(message)
-    
-    logger.info(f"Found {len(messages_to_delete)} messages to delete")
+    schedule_missing_expiries()
     
-    # Delete messages with their media files
-    for message in messages_to_delete:
+    while True:
+        batch_ids = list(
+            Message.objects.expired(current_time).order_by('expires_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not batch_ids:
+            break
+        
         try:
-            message.delete_with_media()
-            deleted_count += 1
-            logger.info(f"Successfully deleted message {message.id} with media files")
+            deleted_count += Message.objects.filter(id__in=batch_ids).delete_with_media()
         except Exception as e:
             error_count += 1
-            logger.error(f"Error deleting message {message.id}: {str(e)}")
+            logger.error(f"Error deleting batch of {len(batch_ids)} messages: {str(e)}")
+            break
+        
+        logger.info(f"Deleted batch of {len(batch_ids)} expired messages")
+    
+    # Media files of each batch are deleted concurrently while the next batch
+    # is being selected; wait for the reaper before reporting
+    media_reaper.drain()
     
     logger.info(f"Task completed: {deleted_count} messages deleted, {error_count} errors")
     return f"Deleted {deleted_count} expired messages, {error_count} errors"
 
+def schedule_missing_expiries():
+    """Set expires_at on messages created without one (e.g. through bulk_create)"""
+    from accounts.models import UserProfile
+    
+    sender_ids = Message.objects.filter(
+        expires_at__isnull=True
+    ).values_list('sender_id', flat=True).distinct().order_by()
+    
+    for profile in UserProfile.objects.filter(user_id__in=list(sender_ids)):
+        Message.objects.filter(sender_id=profile.user_id, expires_at__isnull=True).update(
+            expires_at=F('timestamp') + timedelta(hours=profile.message_deletion_hours)
+        )
+
 @shared_task
 def cleanup_empty_conversations():
     """
@@ -55,4 +75,31 @@ def cleanup_empty_conversations():
     empty_conversations.delete()
     
     logger.info(f"Deleted {count} empty conversations")
-    return f"Deleted {count} empty conversations"
\ No newline at end of file
+    return f"Deleted {count} empty conversations"
+
+@shared_task
+def reap_orphaned_media(limit=1000):
+    """
+    Retry deleting media files the media reaper failed to delete earlier
+    """
+    from core.models import OrphanedMedia
+    
+    orphans = list(OrphanedMedia.objects.order_by('updated_at').values_list('name', flat=True)[:limit])
+    deleted_count, failed = media_reaper.reap(orphans)
+    OrphanedMedia.objects.filter(name__in=set(orphans) - set(failed)).delete()
+    
+    logger.info(f"Deleted {deleted_count} orphaned media files, {len(failed)} still failing")
+    return f"Deleted {deleted_count} orphaned media files, {len(failed)} still failing"
+
+@shared_task
+def reconcile_presence():
+    """
+    Clear is_online on profiles whose connections are gone (e.g. the process
+    holding them died before its presence changes were flushed)
+    """
+    from accounts import presence
+    
+    fixed = presence.reconcile()
+    
+    logger.info(f"Marked {fixed} stale online users offline")
+    return f"Marked {fixed} stale online users offline"
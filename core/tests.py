@@ -1,3 +1,435 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import unittest
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from chat.models import Conversation, Message
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+from . import media_reaper
+from .channel_layer import UnixSocketChannelLayer, _Connection, stop_embedded_brokers
+from .sharded_channel_layer import HashRing, ShardedRedisChannelLayer, node_name, server_tag
+from .models import OrphanedMedia
+from .tasks import delete_expired_messages, reap_orphaned_media
+
+
+class ExpiredMessageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice')
+        self.friend = User.objects.create_user(username='bob')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user, self.friend)
+
+    def send(self, sender, content='hello'):
+        return Message.objects.create(conversation=self.conversation, sender=sender, content=content)
+
+    def test_expiry_follows_sender_setting(self):
+        profile = self.friend.userprofile
+        profile.message_deletion_hours = 48
+        profile.save()
+
+        message = self.send(self.friend)
+        self.assertAlmostEqual(
+            message.expires_at, message.timestamp + timedelta(hours=48), delta=timedelta(seconds=5)
+        )
+
+    def test_changing_setting_reschedules_existing_messages(self):
+        message = self.send(self.user)
+        profile = User.objects.get(id=self.user.id).userprofile
+        profile.message_deletion_hours = 1
+        profile.save()
+
+        message.refresh_from_db()
+        self.assertEqual(message.expires_at, message.timestamp + timedelta(hours=1))
+
+    def test_task_deletes_expired_messages_in_batches(self):
+        expired = [self.send(self.user, f'old {i}') for i in range(5)]
+        current = self.send(self.friend, 'new')
+        Message.objects.filter(id__in=[m.id for m in expired]).update(
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        # Messages created without going through save() get scheduled too
+        Message.objects.bulk_create([Message(conversation=self.conversation, sender=self.user, content='bulk')])
+        Message.objects.filter(content='bulk').update(timestamp=timezone.now() - timedelta(days=2))
+
+        result = delete_expired_messages(batch_size=2)
+
+        self.assertEqual(result, 'Deleted 6 expired messages, 0 errors')
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [current.id])
+
+
+@override_settings(MEDIA_REAPER_RETRY_DELAY=0)
+class MediaReaperTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(username='alice')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user)
+
+    def test_delete_with_media_removes_rows_then_files(self):
+        names = [default_storage.save(f'chat_media/images/photo{i}.jpg', ContentFile(b'jpg')) for i in range(3)]
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=self.user, message_type='image', image=name)
+            for name in names
+        ])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(Message.objects.all().delete_with_media(), 3)
+        media_reaper.drain()
+
+        self.assertFalse(Message.objects.exists())
+        for name in names:
+            self.assertFalse(os.path.exists(os.path.join(self.media_root.name, name)))
+
+    def test_rolled_back_deletion_keeps_the_files(self):
+        name = default_storage.save('chat_media/images/photo.jpg', ContentFile(b'jpg'))
+        message = Message.objects.create(
+            conversation=self.conversation, sender=self.user, message_type='image', image=name
+        )
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    message.delete_with_media()
+                    raise DatabaseError('unfriend failed')
+            except DatabaseError:
+                pass
+        media_reaper.drain()
+
+        self.assertEqual(callbacks, [])
+        self.assertTrue(Message.objects.filter(image=name).exists())
+        self.assertTrue(os.path.exists(os.path.join(self.media_root.name, name)))
+
+    def test_failed_deletions_go_to_the_orphan_ledger(self):
+        def flaky_delete(name):
+            if name == 'broken.jpg':
+                raise OSError('storage unavailable')
+
+        with mock.patch.object(default_storage, 'delete', side_effect=flaky_delete) as delete:
+            deleted_count, failed = media_reaper.reap(['ok.jpg', 'broken.jpg'])
+
+        self.assertEqual((deleted_count, failed), (1, ['broken.jpg']))
+        self.assertEqual(delete.call_count, 1 + 3)
+        orphan = OrphanedMedia.objects.get()
+        self.assertEqual(orphan.name, 'broken.jpg')
+        self.assertEqual(orphan.last_error, 'storage unavailable')
+
+        self.assertEqual(reap_orphaned_media(), 'Deleted 1 orphaned media files, 0 still failing')
+        self.assertFalse(OrphanedMedia.objects.exists())
+
+
+class ChannelLayerConformanceMixin:
+    """Channel layer behaviour the app relies on, run against each backend"""
+
+    def make_layer(self, **config):
+        raise NotImplementedError
+
+    async def assert_nothing(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.2)
+
+    async def test_send_and_receive(self):
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        message = {'type': 'chat.message', 'text': 'hi', 'frames': {'bytes': b'\x81\xa1t'}, 'ids': [1, 2]}
+        await layer.send(channel, message)
+        self.assertEqual(await layer.receive(channel), message)
+
+    async def test_receive_waits_for_a_message(self):
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0.05)
+        await layer.send(channel, {'type': 'late'})
+        self.assertEqual(await receiving, {'type': 'late'})
+
+    async def test_new_channels_are_unique(self):
+        layer = self.make_layer()
+        channels = {await layer.new_channel() for _ in range(10)}
+        self.assertEqual(len(channels), 10)
+        for channel in channels:
+            layer.require_valid_channel_name(channel)
+
+    async def test_capacity(self):
+        layer = self.make_layer(capacity=2, channel_capacity={'limited.*': 1})
+        # Plain channel names: channels_redis counts capacity per process for specific channels
+        channel = f'worker.{uuid.uuid4().hex}'
+        await layer.send(channel, {'type': 'one'})
+        await layer.send(channel, {'type': 'two'})
+        with self.assertRaises(ChannelFull):
+            await layer.send(channel, {'type': 'three'})
+        limited = f'limited.{uuid.uuid4().hex}'
+        await layer.send(limited, {'type': 'one'})
+        with self.assertRaises(ChannelFull):
+            await layer.send(limited, {'type': 'two'})
+
+    async def test_messages_expire(self):
+        layer = self.make_layer(expiry=1, capacity=1)
+        channel = await layer.new_channel()
+        await layer.send(channel, {'type': 'stale'})
+        await asyncio.sleep(1.5)
+        # The expired message frees its slot
+        await layer.send(channel, {'type': 'fresh'})
+        self.assertEqual(await layer.receive(channel), {'type': 'fresh'})
+
+    async def test_groups(self):
+        layer = self.make_layer()
+        group = f'chat_{uuid.uuid4().hex}'
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add(group, first)
+        await layer.group_add(group, second)
+        await layer.group_send(group, {'type': 'everyone'})
+        self.assertEqual(await layer.receive(first), {'type': 'everyone'})
+        self.assertEqual(await layer.receive(second), {'type': 'everyone'})
+
+        await layer.group_discard(group, first)
+        await layer.group_send(group, {'type': 'second only'})
+        self.assertEqual(await layer.receive(second), {'type': 'second only'})
+        await self.assert_nothing(layer, first)
+
+    async def test_group_send_skips_full_channels(self):
+        layer = self.make_layer(capacity=1)
+        group = f'chat_{uuid.uuid4().hex}'
+        full, free = f'worker.{uuid.uuid4().hex}', f'worker.{uuid.uuid4().hex}'
+        await layer.group_add(group, full)
+        await layer.group_add(group, free)
+        await layer.send(full, {'type': 'waiting'})
+        await layer.group_send(group, {'type': 'broadcast'})
+        self.assertEqual(await layer.receive(full), {'type': 'waiting'})
+        self.assertEqual(await layer.receive(free), {'type': 'broadcast'})
+        await self.assert_nothing(layer, full)
+
+    async def test_group_membership_expires(self):
+        layer = self.make_layer(group_expiry=1)
+        group = f'chat_{uuid.uuid4().hex}'
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        await asyncio.sleep(1.5)
+        await layer.group_send(group, {'type': 'too late'})
+        await self.assert_nothing(layer, channel)
+
+    async def test_processes_share_channels_and_groups(self):
+        layer = self.make_layer()
+        # A second layer with the same configuration stands in for another process
+        other = self.make_layer(**self.config)
+        group = f'chat_{uuid.uuid4().hex}'
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        await other.group_send(group, {'type': 'from elsewhere'})
+        self.assertEqual(await layer.receive(channel), {'type': 'from elsewhere'})
+        await other.send(channel, {'type': 'direct'})
+        self.assertEqual(await layer.receive(channel), {'type': 'direct'})
+
+
+class UnixSocketChannelLayerTests(ChannelLayerConformanceMixin, SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.config = None
+        self.addCleanup(stop_embedded_brokers)
+
+    def make_layer(self, **config):
+        # A broker per configuration: capacity and expiry are enforced by the broker
+        if self.config is None:
+            self.config = dict(config, path=os.path.join(self.directory, 'channels.sock'))
+        return UnixSocketChannelLayer(**self.config)
+
+    async def test_lost_connection_is_replaced(self):
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        (await layer.connection()).close()
+        await layer.send(channel, {'type': 'after reconnect'})
+        self.assertEqual(await layer.receive(channel), {'type': 'after reconnect'})
+
+    async def test_group_memberships_survive_a_broker_restart(self):
+        layer = self.make_layer()
+        other = self.make_layer()
+        group = f'chat_{uuid.uuid4().hex}'
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0.05)
+
+        # The process running the broker restarts: the receive reconnects to a
+        # new, empty broker and re-adds the layer's memberships
+        stop_embedded_brokers()
+        await asyncio.sleep(0.2)
+        await other.group_send(group, {'type': 'after restart'})
+        self.assertEqual(await asyncio.wait_for(receiving, 2), {'type': 'after restart'})
+
+    async def test_only_receive_is_retried(self):
+        layer = self.make_layer()
+        channel = await layer.new_channel()
+        await layer.connection()
+        lost = mock.AsyncMock(side_effect=ConnectionError('Channel broker connection lost'))
+        with mock.patch.object(_Connection, 'request', lost):
+            with self.assertRaises(ConnectionError):
+                await layer.send(channel, {'type': 'maybe delivered'})
+            self.assertEqual(lost.call_count, 1)
+            with self.assertRaises(ConnectionError):
+                await layer.receive(channel)
+            self.assertEqual(lost.call_count, 3)
+
+
+def require_redis(*urls):
+    import redis
+    for url in urls:
+        try:
+            redis.Redis.from_url(url, socket_connect_timeout=0.5).ping()
+        except redis.exceptions.ConnectionError:
+            raise unittest.SkipTest(f'No Redis server at {url}')
+
+
+class RedisChannelLayerTests(ChannelLayerConformanceMixin, SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.redis_url = settings.REDIS_URL or 'redis://localhost:6379'
+        require_redis(cls.redis_url)
+
+    def setUp(self):
+        self.config = None
+        self.prefix = f'test_{uuid.uuid4().hex}'
+
+    def make_layer(self, **config):
+        if self.config is None:
+            self.config = config
+        return RedisChannelLayer(hosts=[self.redis_url], prefix=self.prefix, **config)
+
+
+class HashRingTests(SimpleTestCase):
+    names = [f'chat_{i}' for i in range(10000)]
+
+    def test_groups_spread_evenly(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = {node: 0 for node in 'abc'}
+        for name in self.names:
+            counts[ring.get(name)] += 1
+        for count in counts.values():
+            self.assertAlmostEqual(count / len(self.names), 1 / 3, delta=0.08)
+
+    def test_adding_a_node_only_moves_groups_to_it(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [name for name in self.names if before.get(name) != after.get(name)]
+        self.assertTrue(all(after.get(name) == 'd' for name in moved))
+        self.assertAlmostEqual(len(moved) / len(self.names), 1 / 4, delta=0.08)
+
+    def test_layer_routes_by_host_address(self):
+        layer = ShardedRedisChannelLayer(hosts=['redis://:secret@one:6379/0', 'redis://two:6379'])
+        reordered = ShardedRedisChannelLayer(hosts=['redis://two:6379/0', 'redis://one:6379'])
+        for name in self.names[:100]:
+            self.assertEqual(
+                node_name(layer.hosts[layer.consistent_hash(name)]),
+                node_name(reordered.hosts[reordered.consistent_hash(name)])
+            )
+
+    def test_moved_groups_point_at_their_previous_host(self):
+        layer = ShardedRedisChannelLayer(
+            hosts=['redis://one:6379', 'redis://three:6379'],
+            previous_hosts=['redis://one:6379', 'redis://two:6379'],
+        )
+        previous = HashRing(['one:6379/0', 'two:6379/0'])
+        # The removed host gets a connection after the current ones
+        self.assertEqual(node_name(layer.hosts[2]), 'two:6379/0')
+        for name in self.names[:1000]:
+            current = layer.consistent_hash(name)
+            self.assertLess(current, 2)
+            index = layer.previous_index(name)
+            if previous.get(name) == node_name(layer.hosts[current]):
+                self.assertIsNone(index)
+            else:
+                self.assertEqual(node_name(layer.hosts[index]), previous.get(name))
+
+
+class ShardedProcessChannelTests(SimpleTestCase):
+    hosts = ['redis://one:6379', 'redis://two:6379', 'redis://three:6379']
+
+    def test_process_channels_go_to_the_server_in_their_tag(self):
+        receiver = ShardedRedisChannelLayer(hosts=self.hosts)
+        server = node_name(receiver.hosts[receiver.consistent_hash(f'specific.{receiver.client_prefix}!')])
+        self.assertEqual(receiver.client_prefix.rsplit('.s', 1)[1], server_tag(server))
+
+        # Senders with other host lists, in any order, deliver to the same server
+        for hosts in (self.hosts[::-1], self.hosts + ['redis://four:6379'], [self.hosts[1]]):
+            sender = ShardedRedisChannelLayer(hosts=hosts, previous_hosts=self.hosts)
+            for name in (f'specific.{receiver.client_prefix}!', f'specific.{receiver.client_prefix}!abc'):
+                self.assertEqual(node_name(sender.hosts[sender.consistent_hash(name)]), server)
+
+    def test_untagged_process_channels_use_the_previous_ring(self):
+        layer = ShardedRedisChannelLayer(hosts=self.hosts + ['redis://four:6379'], previous_hosts=self.hosts)
+        previous = HashRing([f'{name}:6379/0' for name in ('one', 'two', 'three')])
+        for i in range(200):
+            name = f'specific.{uuid.uuid4().hex}!'
+            self.assertEqual(node_name(layer.hosts[layer.consistent_hash(name + 'socket')]), previous.get(name))
+
+
+class ShardedRedisChannelLayerTests(ChannelLayerConformanceMixin, SimpleTestCase):
+    """
+    Needs two Redis servers, e.g. ``redis-server --port 6379`` and
+    ``redis-server --port 6380``, or REDIS_TEST_URLS listing others
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.redis_urls = os.environ.get(
+            'REDIS_TEST_URLS', 'redis://localhost:6379/0,redis://localhost:6380/0'
+        ).split(',')
+        require_redis(*cls.redis_urls)
+
+    def setUp(self):
+        self.config = None
+        self.prefix = f'test_{uuid.uuid4().hex}'
+
+    def make_layer(self, **config):
+        if self.config is None:
+            self.config = config
+        return ShardedRedisChannelLayer(hosts=self.redis_urls, prefix=self.prefix, **config)
+
+    async def test_members_joined_through_the_previous_ring_still_receive(self):
+        old = ShardedRedisChannelLayer(hosts=self.redis_urls[:1], prefix=self.prefix)
+        new = ShardedRedisChannelLayer(hosts=self.redis_urls, previous_hosts=self.redis_urls[:1], prefix=self.prefix)
+        # An untagged process of the old ring whose channels the new ring alone would send elsewhere
+        old.client_prefix = next(
+            prefix for prefix in (uuid.uuid4().hex for _ in range(1000))
+            if new.host_index[new.ring.get(f'specific.{prefix}!')] != 0
+        )
+        group = next(
+            name for name in (f'chat_{i}' for i in range(1000)) if new.previous_index(name) is not None
+        )
+        channel = await old.new_channel()
+        await old.group_add(group, channel)
+        await new.group_send(group, {'type': 'after resharding'})
+        self.assertEqual(await asyncio.wait_for(old.receive(channel), 2), {'type': 'after resharding'})
+        await new.send(channel, {'type': 'direct'})
+        self.assertEqual(await asyncio.wait_for(old.receive(channel), 2), {'type': 'direct'})
+
+        await new.group_discard(group, channel)
+        await new.group_send(group, {'type': 'gone'})
+        await self.assert_nothing(old, channel)
+
+    async def test_process_channels_follow_their_tag_across_rings(self):
+        receiver = ShardedRedisChannelLayer(hosts=self.redis_urls, prefix=self.prefix)
+        sender = ShardedRedisChannelLayer(hosts=self.redis_urls[::-1][:1], previous_hosts=self.redis_urls, prefix=self.prefix)
+        channel = await receiver.new_channel()
+        await sender.send(channel, {'type': 'tagged'})
+        self.assertEqual(await asyncio.wait_for(receiver.receive(channel), 2), {'type': 'tagged'})
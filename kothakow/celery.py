@@ -24,6 +24,14 @@ app.conf.beat_schedule = {
         'task': 'core.tasks.cleanup_empty_conversations',
         'schedule': 86400.0,  # Run every 24 hours
     },
+    'reap-orphaned-media': {
+        'task': 'core.tasks.reap_orphaned_media',
+        'schedule': 86400.0,  # Run every 24 hours
+    },
+    'reconcile-presence': {
+        'task': 'core.tasks.reconcile_presence',
+        'schedule': 300.0,  # Run every 5 minutes
+    },
 }
 
 app.conf.timezone = 'Asia/Dhaka'
@@ -1,16 +1,24 @@
-from accounts.models import FriendRequest
-from chat.models import MessageReadStatus, Conversation
-from django.db.models import Q
+from django.utils.functional import SimpleLazyObject
+from accounts import counters
+
+def get_navbar_counts(request):
+    """The user's navbar counts, looked up once per request"""
+    if not hasattr(request, '_navbar_counts'):
+        if request.user.is_authenticated:
+            # Maintained per user as requests and messages come and go
+            request._navbar_counts = counters.get_counts(request.user.id)
+        else:
+            request._navbar_counts = dict.fromkeys(counters.COUNTER_FIELDS, 0)
+    return request._navbar_counts
 
 def navbar_counts(request):
-    friend_request_count = 0
-    unread_message_count = 0
-    if request.user.is_authenticated:
-        # Pending friend requests sent TO the user
-        friend_request_count = FriendRequest.objects.filter(to_user=request.user, status='pending').count()
-        # Unread messages in conversations
-        unread_message_count = MessageReadStatus.objects.filter(user=request.user, is_read=False).count()
+    # Lazy, so templates that never show the navbar (and requests whose user
+    # is never loaded) do not pay for the lookup
     return {
-        'navbar_friend_request_count': friend_request_count,
-        'navbar_unread_message_count': unread_message_count,
-    } 
\ No newline at end of file
+        'navbar_friend_request_count': SimpleLazyObject(
+            lambda: get_navbar_counts(request)['pending_friend_requests']
+        ),
+        'navbar_unread_message_count': SimpleLazyObject(
+            lambda: get_navbar_counts(request)['unread_messages']
+        ),
+    }
@@ -0,0 +1,44 @@
+"""
+Daphne launcher with optional WebSocket compression.
+
+Daphne does not expose autobahn's permessage-deflate options, so this wraps
+its command line: with WEBSOCKET_COMPRESSION=1 in the environment, sockets
+whose client offers permessage-deflate (all current browsers do) get their
+frames compressed. Arguments are the same as for ``daphne``::
+
+    python -m kothakow.serve -b 0.0.0.0 -p 8000 kothakow.asgi:application
+"""
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne import server
+from daphne.cli import CommandLineInterface
+from daphne.ws_protocol import WebSocketFactory
+import os
+
+
+def accept_deflate(offers):
+    """Accept the client's first permessage-deflate offer, if any"""
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+
+class CompressingWebSocketFactory(WebSocketFactory):
+    def setProtocolOptions(self, **options):
+        options.setdefault('perMessageCompressionAccept', accept_deflate)
+        super().setProtocolOptions(**options)
+
+
+def compression_enabled():
+    return os.environ.get('WEBSOCKET_COMPRESSION', '').lower() in ('1', 'true', 'yes')
+
+
+def main():
+    if compression_enabled():
+        # daphne.server builds its factory from this module-level name
+        server.WebSocketFactory = CompressingWebSocketFactory
+    CommandLineInterface.entrypoint()
+
+
+if __name__ == '__main__':
+    main()
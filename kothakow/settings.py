@@ -88,9 +88,26 @@ TEMPLATES = [
 WSGI_APPLICATION = 'kothakow.wsgi.application'
 ASGI_APPLICATION = 'kothakow.asgi.application'
 
-# Channels: Use Redis if available, otherwise fall back to InMemoryChannelLayer (for local/dev or if Redis fails)
+# Channels: Use Redis if available (sharded over several servers with
+# REDIS_CHANNEL_URLS), otherwise the Unix socket channel layer, which
+# connects every process on this host to one in-memory broker
 REDIS_URL = os.environ.get('REDIS_URL')
-if REDIS_URL:
+# Comma separated Redis URLs to shard channel layer traffic over (see
+# core/sharded_channel_layer.py); while changing them, set the previous list
+# in REDIS_CHANNEL_PREVIOUS_URLS until every process runs the new one
+REDIS_CHANNEL_URLS = [url for url in os.environ.get('REDIS_CHANNEL_URLS', '').split(',') if url]
+REDIS_CHANNEL_PREVIOUS_URLS = [url for url in os.environ.get('REDIS_CHANNEL_PREVIOUS_URLS', '').split(',') if url]
+if REDIS_CHANNEL_URLS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "core.sharded_channel_layer.ShardedRedisChannelLayer",
+            "CONFIG": {
+                "hosts": REDIS_CHANNEL_URLS,
+                "previous_hosts": REDIS_CHANNEL_PREVIOUS_URLS,
+            },
+        }
+    }
+elif REDIS_URL:
     CHANNEL_LAYERS = {
         "default": {
             "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -100,17 +117,32 @@ if REDIS_URL:
         }
     }
 else:
-    # Use DatabaseChannelLayer as fallback if Redis is not set (for multi-process production like Render)
+    # The first process to start runs the broker (see core/channel_layer.py)
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels.layers.DatabaseChannelLayer",
+            "BACKEND": "core.channel_layer.UnixSocketChannelLayer",
             "CONFIG": {
-                "expiry": 60 * 60,  # 1 hour expiry for messages
+                "path": os.environ.get('CHANNEL_BROKER_PATH', '/tmp/kothakow-channels.sock'),
             },
         }
     }
 
 
+# Cache: shared Redis cache when available, per-process memory otherwise
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -164,6 +196,52 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Media reaper: background deletion of media files of deleted messages
+MEDIA_REAPER_WORKERS = int(os.environ.get('MEDIA_REAPER_WORKERS', 8))
+MEDIA_REAPER_RETRIES = 3
+MEDIA_REAPER_RETRY_DELAY = 0.5  # seconds, doubled after each failed attempt
+
+# Presence: seconds between background writes of is_online/last_seen, and the
+# window within which a user's presence changes are pushed to friends once
+PRESENCE_FLUSH_INTERVAL = 5
+PRESENCE_DEBOUNCE_SECONDS = 10
+
+# Typing indicators: a typist is announced to the room at most once per
+# interval, and the indicator expires after the timeout without a new frame
+TYPING_BROADCAST_INTERVAL = 2
+TYPING_TIMEOUT = 5
+
+# WebSocket frame batching: chat events for the same socket within this many
+# milliseconds are sent as one array frame (0 sends every frame at once).
+# Compression is enabled at the server, see kothakow/serve.py.
+CHAT_FRAME_BATCH_WINDOW = int(os.environ.get('CHAT_FRAME_BATCH_WINDOW', 0))
+
+# Room buffer: the newest messages of recently opened conversations kept in
+# memory for the first page of a conversation (see chat/room_buffer.py).
+# SIZE messages per room (0 disables the buffer), at most ROOMS rooms per
+# process, each served for up to TTL seconds before it is reloaded. With a
+# Redis URL the rooms are shared between processes too.
+CHAT_ROOM_BUFFER_SIZE = int(os.environ.get('CHAT_ROOM_BUFFER_SIZE', 100))
+CHAT_ROOM_BUFFER_ROOMS = int(os.environ.get('CHAT_ROOM_BUFFER_ROOMS', 1000))
+CHAT_ROOM_BUFFER_TTL = 5
+CHAT_ROOM_BUFFER_REDIS_URL = os.environ.get('CHAT_ROOM_BUFFER_REDIS_URL', REDIS_URL)
+
+# Write batching: text messages received over chat sockets are held for up to
+# this many milliseconds and saved together (0 saves each message at once),
+# in batches of at most CHAT_WRITE_BATCH_SIZE (see chat/write_combiner.py)
+CHAT_WRITE_BATCH_WINDOW = int(os.environ.get('CHAT_WRITE_BATCH_WINDOW', 0))
+CHAT_WRITE_BATCH_SIZE = 500
+
+# Rate limits on what clients send (see chat/rate_limit.py): per action and
+# scope, (burst, tokens refilled per second). Messages over the limit are
+# refused with an error; typing and read frames are dropped.
+CHAT_RATE_LIMITS = {
+    'message': {'user': (20, 2), 'conversation': (60, 10)},
+    'typing': {'user': (10, 2)},
+    'mark_read': {'user': (20, 5)},
+}
+CHAT_RATE_LIMIT_REDIS_URL = os.environ.get('CHAT_RATE_LIMIT_REDIS_URL', REDIS_URL)
+
 
 # Crispy Forms
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"